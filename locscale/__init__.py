@@ -26,12 +26,21 @@
 # **************************************************************************
 
 import os
+import time
+import fcntl
+import logging
+import socket
+import tempfile
+import subprocess
 
 import pwem
 import pyworkflow.utils as pwutils
 from pyworkflow import Config
 
 from .constants import *
+from . import worker, environment
+
+logger = logging.getLogger(__name__)
 
 __version__ = '3.1.2'
 _logo = "locscale_logo.jpg"
@@ -41,10 +50,18 @@ _references = ['Jakobi2017', 'Bharadwaj2022']
 class Plugin(pwem.Plugin):
     _supportedVersions = [V2_1, V2_2_3]
     _url = "https://github.com/scipion-em/scipion-em-locscale"
+    # Lookups memoised in this process, see invalidateCache
+    _lookups = {}
 
     @classmethod
     def _defineVariables(cls):
+        cls.invalidateCache()
         cls._defineVar(LOCSCALE_ENV_ACTIVATION, DEFAULT_ACTIVATION_CMD)
+        cls._defineVar(LOCSCALE_CACHE_DIR, '')
+        cls._defineVar(LOCSCALE_CACHE_SIZE, DEFAULT_CACHE_SIZE)
+        cls._defineVar(LOCSCALE_WORKER_SOCKET, '')
+        cls._defineVar(LOCSCALE_SCRATCH_DIR, '')
+        cls._defineVar(LOCSCALE_BROKER_DIR, '')
 
     @classmethod
     def getEnviron(cls, useCcp4=False):
@@ -62,16 +79,28 @@ class Plugin(pwem.Plugin):
 
         return environ
 
+    @classmethod
+    def invalidateCache(cls):
+        """ Forget the memoised lookups (CCP4 plugin, active version), e.g.
+        after the variables are defined again or plugins are installed.
+        """
+        cls._lookups.clear()
+
     @classmethod
     def getCcp4Plugin(cls):
-        try:
-            ccp4Plugin = pwem.Domain.importFromPlugin("ccp4", "Plugin",
-                                                      doRaise=False)
-            ccp4Plugin._defineVariables()
-        except:
-            return False
+        """ Return the CCP4 plugin, or False if it is not installed.
+        The lookup is memoised, see invalidateCache.
+        """
+        if 'ccp4' not in cls._lookups:
+            try:
+                ccp4Plugin = pwem.Domain.importFromPlugin("ccp4", "Plugin",
+                                                          doRaise=False)
+                ccp4Plugin._defineVariables()
+            except:
+                ccp4Plugin = False
+            cls._lookups['ccp4'] = ccp4Plugin
 
-        return ccp4Plugin
+        return cls._lookups['ccp4']
 
     @classmethod
     def getDependencies(cls):
@@ -87,8 +116,10 @@ class Plugin(pwem.Plugin):
     @classmethod
     def getActiveVersion(cls, *args):
         """ Return the env name that is currently active. """
-        envVar = cls.getVar(LOCSCALE_ENV_ACTIVATION)
-        return envVar.split()[-1].split("-")[-1]
+        if 'version' not in cls._lookups:
+            envVar = cls.getVar(LOCSCALE_ENV_ACTIVATION)
+            cls._lookups['version'] = envVar.split()[-1].split("-")[-1]
+        return cls._lookups['version']
 
     @classmethod
     def getLocscaleEnvActivation(cls):
@@ -105,9 +136,130 @@ class Plugin(pwem.Plugin):
                           cls.getLocscaleEnvActivation())
 
     @classmethod
-    def getProgram(cls, program=""):
-        """ Create LocScale command line. """
-        return f"{cls.getActivationCmd()} && locscale {program} "
+    def getEnvironFn(cls):
+        """ Return the file with the resolved LocScale environment. """
+        return cls.getCachePath(tempfile.gettempdir(), 'locscale-%s-%d-%s.env'
+                                % (socket.gethostname(), os.getuid(),
+                                   cls.getActiveVersion()))
+
+    @classmethod
+    def getLauncher(cls, useCcp4=False):
+        """ Return the prefix of the commands and the environment to run
+        programs of the LocScale environment. The environment activated
+        once and cached by environment.getResolvedEnviron is used, so the
+        programs are launched directly (empty prefix). If it cannot be
+        resolved, the prefix is the shell activation of the environment.
+        """
+        try:
+            resolved = environment.getResolvedEnviron(
+                cls.getEnvironFn(), cls.getActivationCmd(), cls.getEnviron())
+        except Exception as e:
+            logger.warning("Cannot resolve the LocScale environment (%s), it "
+                           "will be activated for every program" % e)
+            return f"{cls.getActivationCmd()} && ", cls.getEnviron(useCcp4)
+
+        # the LocScale environment goes on top of CCP4 (refmac5), as with
+        # the shell activation, so its programs are found first
+        return '', environment.applyEnviron(cls.getEnviron(useCcp4), resolved)
+
+    @classmethod
+    def getProgram(cls, program="", prefix=None):
+        """ Create LocScale command line. The prefix of getLauncher
+        replaces the shell activation of the environment.
+        """
+        if prefix is None:
+            prefix = f"{cls.getActivationCmd()} && "
+        return f"{prefix}locscale {program} "
+
+    @classmethod
+    def getProfiledProgram(cls, program, profileFn, prefix=None):
+        """ Create LocScale command line running it under cProfile, which
+        writes its statistics to profileFn.
+        """
+        if prefix is None:
+            prefix = f"{cls.getActivationCmd()} && "
+        return (f"{prefix}python -m cProfile -o {profileFn} "
+                f"\"$(command -v locscale)\" {program} ")
+
+    @classmethod
+    def getWorkerSocket(cls):
+        """ Return the Unix socket of the LocScale worker. """
+        return (cls.getVar(LOCSCALE_WORKER_SOCKET) or
+                os.path.join(tempfile.gettempdir(), 'locscale-%d-%s.sock'
+                             % (os.getuid(), cls.getActiveVersion())))
+
+    @classmethod
+    def startWorker(cls, timeout=600):
+        """ Start the LocScale worker in its environment, unless it is
+        already running. Return the worker socket.
+        """
+        socketFn = cls.getWorkerSocket()
+        # several protocols may try to start the worker at the same time
+        with open(socketFn + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if worker.isAlive(socketFn):
+                return socketFn
+
+            logFn = socketFn + '.log'
+            prefix, environ = cls.getLauncher()
+            cmd = f"{prefix}python {worker.__file__} --socket {socketFn}"
+            with open(logFn, 'a') as log:
+                subprocess.Popen(cmd, shell=True, executable='/bin/bash',
+                                 env=environ, stdout=log,
+                                 stderr=subprocess.STDOUT,
+                                 start_new_session=True)
+
+            start = time.time()
+            while not worker.isAlive(socketFn):
+                if time.time() - start > timeout:
+                    raise Exception("LocScale worker did not start, "
+                                    "see %s" % logFn)
+                time.sleep(1)
+
+        return socketFn
+
+    @classmethod
+    def getWorkerJobEnviron(cls, useCcp4=False):
+        """ Return the variables added to the worker environment
+        for a job. """
+        if not useCcp4:
+            return {}
+        environ = {k: v for k, v in cls.getCcp4Plugin().getEnviron().items()
+                   if os.environ.get(k) != v
+                   and k not in ['PATH', 'PYTHONPATH', 'PYTHONHOME']}
+        environ['PATH'] = cls.getCcp4Plugin().getHome("bin")
+        return environ
+
+    @classmethod
+    def getCachePath(cls, defaultPath, *paths):
+        """ Return the folder of the cache shared between runs.
+        LOCSCALE_CACHE_DIR is used if defined, otherwise defaultPath
+        (usually inside the project Tmp folder).
+        """
+        return os.path.join(cls.getVar(LOCSCALE_CACHE_DIR) or defaultPath,
+                            *paths)
+
+    @classmethod
+    def getScratchRoot(cls):
+        """ Return the node-local folder where protocols can run LocScale:
+        LOCSCALE_SCRATCH_DIR if defined, otherwise the system temporary
+        folder (TMPDIR).
+        """
+        return cls.getVar(LOCSCALE_SCRATCH_DIR) or tempfile.gettempdir()
+
+    @classmethod
+    def getBrokerPath(cls):
+        """ Return the folder of the broker of cores and memory shared by
+        the LocScale runs of the host: LOCSCALE_BROKER_DIR if defined,
+        otherwise a folder in the system temporary folder.
+        """
+        return (cls.getVar(LOCSCALE_BROKER_DIR) or
+                os.path.join(tempfile.gettempdir(), 'locscale-broker'))
+
+    @classmethod
+    def getCacheSize(cls):
+        """ Return the maximum size of the cache in bytes. """
+        return int(float(cls.getVar(LOCSCALE_CACHE_SIZE)) * 1024 ** 3)
 
     @classmethod
     def defineBinaries(cls, env):
@@ -0,0 +1,262 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Host level broker of cores and memory shared by the LocScale runs of all
+protocols (and users) of a node. Before launching, a run queues a request
+in the broker folder and waits until it is the first of the queue and its
+cores and memory fit next to the granted ones, so requests are served in
+order of arrival.
+
+Requests and grants are files locked by the process that holds them. The
+lock is released by the system when the process ends, so the files of
+crashed jobs are detected and removed by the next process that looks at
+the broker. A grant also records the processes that use the resources
+(the LocScale job or the worker child running it), and is kept while any
+of them is alive, even if the protocol that requested it ended first.
+
+The files are readable by all the users of the host and the lock of the
+broker is taken on a read-only descriptor, so the folder can be shared
+by several users.
+
+The state of the broker can be shown with:
+    python -m locscale.broker <broker folder>
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import threading
+import argparse
+from glob import glob
+from contextlib import contextmanager
+
+import psutil
+
+from locscale.planner import MEMORY_MARGIN
+
+# Seconds between checks of a request waiting in the queue
+POLL_INTERVAL = 1.
+# Mode of the request and grant files, read by the jobs of other users
+ENTRY_MODE = 0o644
+
+
+def getHostCapacity():
+    """ Return the cores and memory (bytes) that the broker grants. """
+    cores = (len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity')
+             else os.cpu_count())
+    return cores, int(psutil.virtual_memory().total * MEMORY_MARGIN)
+
+
+def _isRunning(record):
+    """ Return True if any of the processes attached to a grant is alive. """
+    for pid, createTime in record.get('processes', []):
+        try:
+            process = psutil.Process(pid)
+            if (process.create_time() == createTime
+                    and process.status() != psutil.STATUS_ZOMBIE):
+                return True
+        except psutil.Error:
+            pass
+    return False
+
+
+class Grant:
+    """ Cores and memory granted to a request. """
+    def __init__(self, broker, entryFile, record, waitTime):
+        self._broker = broker
+        self._file = entryFile  # locked file of the grant
+        self.record = record
+        self.waitTime = waitTime
+
+    def attach(self, pid):
+        """ Hold the grant until the process pid ends too. """
+        try:
+            createTime = psutil.Process(pid).create_time()
+        except psutil.Error:
+            return
+        with self._broker._lockedBroker():
+            self.record.setdefault('processes', []).append([pid, createTime])
+            self._file.seek(0)
+            self._file.truncate()
+            json.dump(self.record, self._file)
+            self._file.flush()
+
+    def isRunning(self):
+        """ Return True if any of the attached processes is alive. """
+        return _isRunning(self.record)
+
+
+class ResourceBroker:
+    """ Queue of requests of cores and memory in a folder. """
+    LOCK = 'broker.lock'
+
+    def __init__(self, path, cores=None, memory=None):
+        """
+        Params:
+            path: broker folder, shared by all the jobs of the host.
+            cores, memory: capacity of the host, by default its cores and
+                most of its physical memory.
+        """
+        self.path = path
+        hostCores, hostMemory = getHostCapacity()
+        self.cores = cores or hostCores
+        self.memory = memory or hostMemory
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+            try:  # shared by the users of the host, like /tmp
+                os.chmod(path, 0o1777)
+            except OSError:
+                pass
+
+    def _readEntries(self, prefix):
+        """ Return the live requests (or grants) sorted by arrival, as
+        (file name, record) tuples, removing those of ended processes.
+        """
+        entries = []
+        for fn in sorted(glob(os.path.join(self.path, prefix + '_*.json'))):
+            try:
+                with open(fn) as f:
+                    record = json.load(f)
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                    except OSError:  # locked by its live process
+                        entries.append((fn, record))
+                        continue
+                if _isRunning(record):  # its jobs outlived the process
+                    entries.append((fn, record))
+                    continue
+                os.remove(fn)
+            except (OSError, ValueError):
+                pass
+        return entries
+
+    @contextmanager
+    def _lockedBroker(self):
+        fn = os.path.join(self.path, self.LOCK)
+        # flock works on read-only descriptors, so the lock file created by
+        # another user can be used, and it is only opened with O_CREAT when
+        # missing (protected_regular forbids it on files of other users)
+        try:
+            fd = os.open(fn, os.O_RDONLY)
+        except FileNotFoundError:
+            fd = os.open(fn, os.O_RDONLY | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)  # releases the lock
+
+    def _fits(self, record, grants):
+        """ Return True if the request fits next to the grants. A request
+        larger than the host is granted when nothing else is.
+        """
+        if not grants:
+            return True
+        cores = sum(g['cores'] for _, g in grants) + record['cores']
+        memory = sum(g['memory'] for _, g in grants) + record['memory']
+        return cores <= self.cores and memory <= self.memory
+
+    @contextmanager
+    def request(self, cores, memory, label=''):
+        """ Wait until cores and memory (bytes) are granted and yield the
+        Grant. The grant is released on exit, or when the processes
+        attached to it end if they are still running.
+        """
+        record = {'cores': min(cores, self.cores),
+                  'memory': min(int(memory), self.memory),
+                  'label': label, 'pid': os.getpid(), 'time': time.time()}
+        name = '%020d_%d_%d.json' % (time.time_ns(), os.getpid(),
+                                     threading.get_ident())
+        queueFn = os.path.join(self.path, 'queue_' + name)
+        grantFn = os.path.join(self.path, 'grant_' + name)
+        start = time.time()
+
+        # the file is locked before it gets its name, so it is never taken
+        # for the one of an ended process
+        fd = os.open(queueFn + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                     ENTRY_MODE)
+        os.fchmod(fd, ENTRY_MODE)  # regardless of the umask
+        f = os.fdopen(fd, 'w')
+        grant = None
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            json.dump(record, f)
+            f.flush()
+            os.rename(queueFn + '.tmp', queueFn)
+            while True:
+                with self._lockedBroker():
+                    queue = self._readEntries('queue')
+                    if queue and queue[0][0] == queueFn and self._fits(
+                            record, self._readEntries('grant')):
+                        os.rename(queueFn, grantFn)
+                        break
+                time.sleep(POLL_INTERVAL)
+            grant = Grant(self, f, record, time.time() - start)
+            yield grant
+        finally:
+            fileNames = [queueFn + '.tmp', queueFn]
+            if grant is None or not grant.isRunning():
+                fileNames.append(grantFn)
+            for fn in fileNames:
+                if os.path.exists(fn):
+                    try:
+                        os.remove(fn)
+                    except OSError:
+                        pass
+            f.close()
+
+    def getStatus(self):
+        """ Return the capacity, the granted requests and the queue. """
+        with self._lockedBroker():
+            return {'cores': self.cores, 'memory': self.memory,
+                    'grants': [r for _, r in self._readEntries('grant')],
+                    'queue': [r for _, r in self._readEntries('queue')]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Show the runs granted and queued by a LocScale broker.")
+    parser.add_argument('path', help="broker folder (see LOCSCALE_BROKER_DIR)")
+    args = parser.parse_args(argv)
+
+    status = ResourceBroker(args.path).getStatus()
+    now = time.time()
+    print("Capacity: %d cores, %.1f GB" % (status['cores'],
+                                           status['memory'] / 1024 ** 3))
+    for title, key in (('Running', 'grants'), ('Waiting', 'queue')):
+        print("%s (%d):" % (title, len(status[key])))
+        for record in status[key]:
+            pids = [record['pid']] + [p for p, _ in record.get('processes', [])]
+            print("   %3d cores %6.1f GB  %6.0f s  pid %s  %s"
+                  % (record['cores'], record['memory'] / 1024 ** 3,
+                     now - record['time'], ','.join(map(str, pids)),
+                     record['label']))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
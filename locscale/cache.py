@@ -0,0 +1,189 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Project level cache of files produced by LocScale runs, shared
+between protocol runs. Cached files are handed back by hard link.
+"""
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def fileDigest(fn):
+    """ Return the sha256 digest of the file content. """
+    sha = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def fileStatKey(fn):
+    """ Return a fast key of the file based on inode, mtime and size. """
+    st = os.stat(fn)
+    return '%d-%d-%d-%d' % (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def linkOrCopy(src, dst):
+    """ Hard link src to dst, copying the file if linking is not
+    possible (e.g. different file systems).
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def replaceFile(src, dst):
+    """ Link (or copy) src to dst through a temporary file with a unique
+    name, so concurrent writers of dst never use the same temporary file
+    and readers never see a partial one.
+    """
+    fd, tmpFn = tempfile.mkstemp(dir=os.path.dirname(dst), suffix='.tmp')
+    os.close(fd)
+    try:
+        linkOrCopy(src, tmpFn)
+        os.replace(tmpFn, dst)
+    except BaseException:
+        if os.path.lexists(tmpFn):
+            os.remove(tmpFn)
+        raise
+
+
+class FileCache:
+    """ Directory of files indexed by a key, with a size limit.
+    The least recently used files are removed when the limit is reached.
+    The index is protected by a file lock, so several protocols (or
+    threads) can use the same cache at the same time.
+    """
+    INDEX = 'index.json'
+    LOCK = '.lock'
+
+    def __init__(self, path, maxSize, contentHash=False):
+        """
+        Params:
+            path: cache folder, created if it does not exist.
+            maxSize: maximum size of the cache in bytes.
+            contentHash: if True, files are identified by the hash of their
+                content, otherwise by inode, mtime and size.
+        """
+        self.path = path
+        self.maxSize = maxSize
+        self.contentHash = contentHash
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def getKey(self, fn, *extra):
+        """ Return the key of the file, optionally combined with other
+        values that affect the cached result.
+        """
+        fileKey = fileDigest(fn) if self.contentHash else fileStatKey(fn)
+        if not extra:
+            return fileKey
+        extraKey = json.dumps([str(e) for e in extra])
+        return hashlib.sha256((fileKey + extraKey).encode()).hexdigest()
+
+    @contextmanager
+    def _lockedIndex(self):
+        """ Yield the index dict while holding the cache lock.
+        Changes done to the dict are written back on exit.
+        """
+        with open(os.path.join(self.path, self.LOCK), 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                indexFn = os.path.join(self.path, self.INDEX)
+                index = {}
+                if os.path.exists(indexFn):
+                    with open(indexFn) as f:
+                        index = json.load(f)
+                yield index
+                with open(indexFn + '.tmp', 'w') as f:
+                    json.dump(index, f, indent=1)
+                os.replace(indexFn + '.tmp', indexFn)
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def get(self, key, outputFn):
+        """ Link the cached file for key to outputFn.
+        Return True on a cache hit, False otherwise.
+        """
+        with self._lockedIndex() as index:
+            entry = index.get(key)
+            cachedFn = os.path.join(self.path, entry['file']) if entry else None
+            if cachedFn is None or not os.path.exists(cachedFn):
+                index.pop(key, None)
+                self.misses += 1
+                return False
+
+            linkOrCopy(cachedFn, outputFn)
+            entry['lastUsed'] = time.time()
+            entry['hits'] = entry.get('hits', 0) + 1
+            self.hits += 1
+            return True
+
+    def put(self, key, fn):
+        """ Store a copy of fn in the cache under key. """
+        ext = os.path.splitext(fn)[1]
+        cachedName = hashlib.sha256(key.encode()).hexdigest()[:32] + ext
+        cachedFn = os.path.join(self.path, cachedName)
+        replaceFile(fn, cachedFn)
+
+        with self._lockedIndex() as index:
+            index[key] = {'file': cachedName,
+                          'size': os.path.getsize(cachedFn),
+                          'lastUsed': time.time(),
+                          'hits': 0}
+            self._evict(index)
+
+    def _evict(self, index):
+        """ Remove the least recently used entries until the cache
+        fits in its maximum size.
+        """
+        total = sum(e['size'] for e in index.values())
+        for key, entry in sorted(index.items(), key=lambda i: i[1]['lastUsed']):
+            if total <= self.maxSize:
+                break
+            cachedFn = os.path.join(self.path, entry['file'])
+            if os.path.exists(cachedFn):
+                os.remove(cachedFn)
+            total -= entry['size']
+            del index[key]
+
+    def getSize(self):
+        """ Return the number of entries and total size in bytes. """
+        with self._lockedIndex() as index:
+            return len(index), sum(e['size'] for e in index.values())
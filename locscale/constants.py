@@ -33,6 +33,33 @@ LOCSCALE_DEFAULT_VER_NUM = VERSIONS[-1]
 DEFAULT_ENV_NAME = f"locscale-{LOCSCALE_DEFAULT_VER_NUM}"
 DEFAULT_ACTIVATION_CMD = 'conda activate ' + DEFAULT_ENV_NAME
 LOCSCALE_ENV_ACTIVATION = 'LOCSCALE_ENV_ACTIVATION'
+LOCSCALE_CACHE_DIR = 'LOCSCALE_CACHE_DIR'
+LOCSCALE_CACHE_SIZE = 'LOCSCALE_CACHE_SIZE'  # in GB
+DEFAULT_CACHE_SIZE = '50'
+LOCSCALE_WORKER_SOCKET = 'LOCSCALE_WORKER_SOCKET'
+LOCSCALE_SCRATCH_DIR = 'LOCSCALE_SCRATCH_DIR'
+LOCSCALE_BROKER_DIR = 'LOCSCALE_BROKER_DIR'
+
+# scaling engines
+ENGINE_LOCSCALE = 0
+ENGINE_NUMPY = 1
+
+# crop modes
+CROP_NONE = 0
+CROP_MASK = 1
+CROP_REGION = 2
+
+# Cached model maps and refined models
+MODEL_MAP_FN = 'model_map.mrc'
+MODEL_REFINED = 'model_refined'
+
+# Rough peak memory of a LocScale run per voxel of the map
+LOCSCALE_BYTES_PER_VOXEL = 160
+
+# Memory of each process of the NumPy engine, in MB
+DEFAULT_MEMORY = 512
+# Low resolution limit of the Guinier fit of the global sharpening, in A
+GUINIER_LOW_RES = 10.
 
 # reference types
 REF_NONE = 0
@@ -0,0 +1,293 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Helpers to stage input volumes in a format that LocScale can read.
+Files that are already valid MRC maps are linked; other formats are
+converted streaming one slice at a time through memory-mapped buffers.
+"""
+
+import os
+import struct
+import tempfile
+
+import numpy as np
+import mrcfile
+
+MRC_HEADER_SIZE = 1024
+# MRC modes that LocScale (mrcfile) reads as a map
+MRC_MODES = {0: np.int8, 1: np.int16, 2: np.float32, 6: np.uint16,
+             12: np.float16}
+MRC_FLOAT32 = 2
+MRC_FLOAT16 = 12
+
+SPIDER_VOLUME_IFORM = 3
+
+
+def cleanFileName(fn):
+    """ Remove Scipion format hints (e.g. map.map:mrc) from a file name. """
+    return fn.split(':')[0]
+
+
+def readMrcHeader(fn):
+    """ Read the main fields of an MRC header.
+    Return None if the file does not look like an MRC map.
+    """
+    if not os.path.isfile(fn) or os.path.getsize(fn) < MRC_HEADER_SIZE:
+        return None
+
+    with open(fn, 'rb') as f:
+        data = f.read(MRC_HEADER_SIZE)
+
+    if data[208:211] != b'MAP':
+        return None
+
+    # machine stamp: 0x44 (little endian) or 0x11 (big endian)
+    endian = '>' if data[212] == 0x11 else '<'
+    nx, ny, nz, mode = struct.unpack(endian + '4i', data[:16])
+    mapc, mapr, maps = struct.unpack(endian + '3i', data[64:76])
+    nsymbt, = struct.unpack(endian + 'i', data[92:96])
+
+    return {'dims': (nx, ny, nz), 'mode': mode,
+            'axes': (mapc, mapr, maps), 'nsymbt': nsymbt,
+            'endian': endian}
+
+
+def isMrcCompatible(fn):
+    """ Return True if the file is an MRC map that LocScale can read
+    directly, whatever its extension (.mrc, .map, .mrcs...).
+    """
+    header = readMrcHeader(fn)
+    if header is None or header['mode'] not in MRC_MODES:
+        return False
+
+    nx, ny, nz = header['dims']
+    if min(nx, ny, nz) <= 0 or header['axes'] != (1, 2, 3):
+        return False
+
+    dataSize = nx * ny * nz * np.dtype(MRC_MODES[header['mode']]).itemsize
+    return os.path.getsize(fn) >= MRC_HEADER_SIZE + header['nsymbt'] + dataSize
+
+
+def readSpiderHeader(fn):
+    """ Read the main fields of a Spider volume header.
+    Return None if the file is not a single Spider volume.
+    """
+    if not os.path.isfile(fn) or os.path.getsize(fn) < 256:
+        return None
+
+    with open(fn, 'rb') as f:
+        data = f.read(256)
+
+    for endian in '<>':
+        words = struct.unpack(endian + '64f', data)
+        nz, ny, iform = int(words[0]), int(words[1]), int(words[4])
+        nx, labbyt, istack = int(words[11]), int(words[21]), int(words[25])
+        if (iform == SPIDER_VOLUME_IFORM and istack == 0
+                and min(nx, ny, nz) > 0 and labbyt > 0
+                and os.path.getsize(fn) == labbyt + 4 * nx * ny * nz):
+            return {'dims': (nx, ny, nz), 'offset': labbyt,
+                    'endian': endian}
+
+    return None
+
+
+def updateHeaderStats(mrc):
+    """ Update the min, max, mean and rms of an MRC header. Statistics are
+    accumulated per section to avoid the full size temporaries of
+    mrc.update_header_stats() on memory-mapped volumes.
+    """
+    dmin, dmax, total, sqTotal = np.inf, -np.inf, 0., 0.
+    for section in mrc.data:
+        section = np.asarray(section, dtype=np.float64)
+        dmin = min(dmin, float(section.min()))
+        dmax = max(dmax, float(section.max()))
+        total += float(section.sum())
+        sqTotal += float(np.square(section).sum())
+
+    mean = total / mrc.data.size
+    mrc.header.dmin, mrc.header.dmax, mrc.header.dmean = dmin, dmax, mean
+    mrc.header.rms = np.sqrt(max(sqTotal / mrc.data.size - mean ** 2, 0.))
+
+
+def convertVolume(inputFn, outputFn, samplingRate=None):
+    """ Convert a volume to MRC format. Spider volumes are converted
+    slice by slice through memory-mapped buffers, so the whole map is
+    never loaded in memory. Other formats use the ImageHandler.
+    """
+    header = readSpiderHeader(inputFn)
+    if header is None:
+        from pwem.emlib.image import ImageHandler
+        ImageHandler().convert(inputFn, outputFn)
+        header = readMrcHeader(outputFn)
+        if header is not None and header['mode'] != MRC_FLOAT32:
+            normalizeVolume(outputFn, outputFn)
+        return
+
+    nx, ny, nz = header['dims']
+    inputData = np.memmap(inputFn, dtype=header['endian'] + 'f4', mode='r',
+                          offset=header['offset'], shape=(nz, ny, nx))
+    with mrcfile.new_mmap(outputFn, shape=(nz, ny, nx), mrc_mode=2,
+                          overwrite=True) as mrc:
+        for z in range(nz):
+            mrc.data[z] = inputData[z]
+        updateHeaderStats(mrc)
+        if samplingRate is not None:
+            mrc.voxel_size = samplingRate
+
+    del inputData
+
+
+def normalizeVolume(inputFn, outputFn, mode=MRC_FLOAT32):
+    """ Write an MRC volume with the data type of an MRC mode, section by
+    section through memory-mapped buffers. Voxel size and origin are kept.
+    The output is written to a temporary file first, so inputFn and
+    outputFn can be the same file. Raise ValueError if the values do not
+    fit in the data type.
+    """
+    dtype = np.dtype(MRC_MODES[mode])
+    limit = np.finfo(dtype).max if dtype.kind == 'f' else np.iinfo(dtype).max
+    tmpFn = outputFn + '.tmp'
+    try:
+        with mrcfile.mmap(inputFn, mode='r', permissive=True) as mrc:
+            with mrcfile.new_mmap(tmpFn, shape=mrc.data.shape, mrc_mode=mode,
+                                  overwrite=True) as output:
+                for z, section in enumerate(mrc.data):
+                    if np.abs(section, dtype=np.float64).max() > limit:
+                        raise ValueError("%s values exceed the range of %s"
+                                         % (inputFn, dtype.name))
+                    output.data[z] = section
+                output.voxel_size = mrc.voxel_size.copy()
+                output.header.origin = mrc.header.origin.copy()
+                updateHeaderStats(output)
+    except Exception:
+        if os.path.exists(tmpFn):
+            os.remove(tmpFn)
+        raise
+    os.replace(tmpFn, outputFn)
+
+
+def canReadFloat16(tmpDir=None):
+    """ Return True if the ImageHandler of Scipion reads float16 MRC maps
+    (mode 12) with their values; older Xmipp builds do not. A small probe
+    map is written in tmpDir.
+    """
+    from pwem.emlib.image import ImageHandler
+
+    data = np.linspace(-2, 2, 64, dtype=np.float16).reshape(4, 4, 4)
+    fd, probeFn = tempfile.mkstemp(suffix='.mrc', dir=tmpDir)
+    os.close(fd)
+    try:
+        mrcfile.write(probeFn, data, overwrite=True)
+        image = ImageHandler().read(probeFn + ':mrc')
+        return np.allclose(np.asarray(image.getData(), dtype=np.float32),
+                           data, atol=1e-3)
+    except Exception:
+        return False
+    finally:
+        os.remove(probeFn)
+
+
+def getMaskBox(maskFn, padding=0, threshold=0.5):
+    """ Return the bounding box of the mask, padded by padding voxels,
+    as ((z0, z1), (y0, y1), (x0, x1)). Return None for an empty mask.
+    """
+    with mrcfile.mmap(maskFn, mode='r', permissive=True) as mrc:
+        shape = mrc.data.shape
+        zMask = np.zeros(shape[0], dtype=bool)
+        yMask = np.zeros(shape[1], dtype=bool)
+        xMask = np.zeros(shape[2], dtype=bool)
+        for z, section in enumerate(mrc.data):
+            section = section > threshold
+            if section.any():
+                zMask[z] = True
+                yMask |= section.any(axis=1)
+                xMask |= section.any(axis=0)
+
+    if not zMask.any():
+        return None
+
+    box = []
+    for axisMask, size in zip((zMask, yMask, xMask), shape):
+        indexes = np.flatnonzero(axisMask)
+        box.append((max(int(indexes[0]) - padding, 0),
+                    min(int(indexes[-1]) + 1 + padding, size)))
+    return tuple(box)
+
+
+def makeCubicBox(box, shape):
+    """ Enlarge a box to a cube of even size centred on it, shifted to
+    stay inside a volume of the given shape when possible.
+    """
+    size = max(end - start for start, end in box)
+    size += size % 2
+    if size > min(shape):
+        return box
+    cubic = []
+    for (start, end), dim in zip(box, shape):
+        newStart = (start + end - size) // 2
+        newStart = min(max(newStart, 0), dim - size)
+        cubic.append((newStart, newStart + size))
+    return tuple(cubic)
+
+
+def cropVolume(inputFn, outputFn, box):
+    """ Write the region box of a volume to a new mrc file. The origin is
+    shifted so the cropped map keeps its position in space.
+    """
+    (z0, z1), (y0, y1), (x0, x1) = box
+    with mrcfile.mmap(inputFn, mode='r', permissive=True) as mrc:
+        voxelSize = mrc.voxel_size.copy()
+        origin = mrc.header.origin.copy()
+        with mrcfile.new_mmap(outputFn, shape=(z1 - z0, y1 - y0, x1 - x0),
+                              mrc_mode=2, overwrite=True) as output:
+            for z in range(z0, z1):
+                output.data[z - z0] = mrc.data[z, y0:y1, x0:x1]
+            output.voxel_size = voxelSize
+            output.header.origin.x = origin.x + x0 * voxelSize.x
+            output.header.origin.y = origin.y + y0 * voxelSize.y
+            output.header.origin.z = origin.z + z0 * voxelSize.z
+            updateHeaderStats(output)
+
+
+def pasteVolume(cropFn, outputFn, templateFn, box):
+    """ Paste a cropped volume back into a full size volume with the
+    shape, sampling and origin of templateFn. Voxels outside the box
+    are set to zero.
+    """
+    (z0, z1), (y0, y1), (x0, x1) = box
+    with mrcfile.mmap(templateFn, mode='r', permissive=True) as template:
+        shape = template.data.shape
+        voxelSize = template.voxel_size.copy()
+        origin = template.header.origin.copy()
+
+    with mrcfile.mmap(cropFn, mode='r', permissive=True) as crop:
+        with mrcfile.new_mmap(outputFn, shape=shape, mrc_mode=2,
+                              fill=0, overwrite=True) as output:
+            for z in range(z0, z1):
+                output.data[z, y0:y1, x0:x1] = crop.data[z - z0]
+            output.voxel_size = voxelSize
+            output.header.origin = origin
+            updateHeaderStats(output)
@@ -0,0 +1,122 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Run the work units of a plan file from several processes, usually the
+ranks of an MPI job spread over cluster nodes:
+
+    mpirun -np 4 python distribute.py plan.json
+
+Every process claims the next free unit by creating a claim file next
+to the plan, so units are balanced without any MPI communication and
+the same plan can also be run by independent processes. This module
+only uses the standard library, so it runs with any python.
+"""
+
+import os
+import sys
+import json
+import socket
+import subprocess
+
+CLAIM_EXT = '.claim'
+DONE_EXT = '.done'
+
+
+def writePlan(planFn, units):
+    """ Write a plan with a list of units. Each unit is a dict with the
+    shell 'command' to run and its working directory 'cwd'.
+    """
+    with open(planFn, 'w') as f:
+        json.dump({'units': units}, f, indent=1)
+
+    # remove claims of a previous execution of the plan
+    for i in range(len(units)):
+        for ext in (CLAIM_EXT, DONE_EXT):
+            fn = _unitFn(planFn, i, ext)
+            if os.path.exists(fn):
+                os.remove(fn)
+
+
+def _unitFn(planFn, index, ext):
+    return '%s.unit%03d%s' % (planFn, index, ext)
+
+
+def _claim(planFn, index):
+    """ Atomically claim a unit. Return False if already claimed. """
+    try:
+        fd = os.open(_unitFn(planFn, index, CLAIM_EXT),
+                     os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.write(fd, ('%s %d\n' % (socket.gethostname(), os.getpid())).encode())
+    os.close(fd)
+    return True
+
+
+def runPlan(planFn):
+    """ Run all the units of the plan that are not claimed by other
+    processes. Return the number of units run by this process.
+    """
+    with open(planFn) as f:
+        units = json.load(f)['units']
+
+    done = 0
+    for i, unit in enumerate(units):
+        if not _claim(planFn, i):
+            continue
+        with open(os.path.join(unit['cwd'], 'unit.log'), 'w') as log:
+            result = subprocess.call(unit['command'], shell=True,
+                                     cwd=unit['cwd'], stdout=log,
+                                     stderr=subprocess.STDOUT,
+                                     executable='/bin/bash')
+        with open(_unitFn(planFn, i, DONE_EXT), 'w') as f:
+            f.write('%d\n' % result)
+        done += 1
+    return done
+
+
+def getFailedUnits(planFn):
+    """ Return the indexes of the units that did not finish correctly. """
+    with open(planFn) as f:
+        nUnits = len(json.load(f)['units'])
+
+    failed = []
+    for i in range(nUnits):
+        doneFn = _unitFn(planFn, i, DONE_EXT)
+        if not os.path.exists(doneFn):
+            failed.append(i)
+        else:
+            with open(doneFn) as f:
+                if int(f.read().strip() or 1) != 0:
+                    failed.append(i)
+    return failed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit("Usage: %s plan.json" % sys.argv[0])
+    print("%s (pid %d) run %d units"
+          % (socket.gethostname(), os.getpid(), runPlan(sys.argv[1])))
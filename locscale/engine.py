@@ -0,0 +1,274 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+In-process implementation of the reference-based local amplitude scaling
+of LocScale (Jakobi et al. 2017). For every voxel, a cubic window of the
+map and of the reference is Fourier transformed, the radial amplitude
+profile of the map is scaled to the one of the reference and the scaled
+value of the central voxel is kept.
+
+Windows are taken from strided views of the maps and transformed in
+batches. Since only the central voxel of each scaled window is needed,
+the inverse transform is reduced to a weighted sum per resolution shell.
+The map is split in slabs along z that are processed in a process pool.
+"""
+
+import os
+import argparse
+
+import numpy as np
+import mrcfile
+from numpy.lib.stride_tricks import sliding_window_view
+
+from locscale.constants import DEFAULT_MEMORY
+from locscale.convert import updateHeaderStats
+
+DEFAULT_WINDOW_SIZE_A = 25.  # window size in Angstroms
+MIN_WINDOW_SIZE = 10  # in pixels
+
+# Maps opened by each worker process of the pool. In-process runs keep
+# their own maps, since several runs can share the process.
+_workerMaps = {}
+
+
+def getWindowSize(apix, windowSize=None):
+    """ Return the window size in pixels (always even). """
+    if not windowSize:
+        windowSize = int(round(DEFAULT_WINDOW_SIZE_A / apix))
+    windowSize = max(windowSize, MIN_WINDOW_SIZE)
+    return windowSize + windowSize % 2
+
+
+class ShellOperator:
+    """ Precomputed terms to scale the radial profile of a batch of
+    windows of size wn and evaluate the central voxel.
+    """
+    def __init__(self, wn):
+        self.wn = wn
+        fz = np.fft.fftfreq(wn) * wn
+        fx = np.fft.rfftfreq(wn) * wn
+        kz, ky, kx = np.meshgrid(fz, fz, fx, indexing='ij')
+        shells = np.round(np.sqrt(kz ** 2 + ky ** 2 + kx ** 2)).astype(int)
+        shells = shells.ravel()
+        self.nShells = shells.max() + 1
+
+        # Coefficients of the rfft half space count twice in the full
+        # transform, except the kx=0 and Nyquist planes, which have no
+        # Hermitian mate in the stored half
+        weights = np.full(kx.shape, 2.)
+        weights[..., 0] = 1.
+        if wn % 2 == 0:
+            weights[..., -1] = 1.
+
+        # one-hot matrix to sum the Fourier coefficients of each shell, and
+        # its rows weighted by the Hermitian mates, to average the shells
+        # over the full sphere
+        self.shellMatrix = np.zeros((shells.size, self.nShells), np.float32)
+        self.shellMatrix[np.arange(shells.size), shells] = 1.
+        self.profileMatrix = self.shellMatrix * weights.ravel()[:, None]
+        self.shellCounts = self.profileMatrix.sum(axis=0)
+
+        # Value at the window centre of the inverse transform
+        c = wn // 2
+        phase = np.exp(2j * np.pi * (kz + ky + kx) * c / wn)
+        self.phase = (weights * phase / wn ** 3).ravel().astype(np.complex64)
+
+    def transform(self, windows):
+        """ Return the flattened rfft of a batch of windows. """
+        ft = np.fft.rfftn(windows, axes=(1, 2, 3))
+        return ft.reshape(len(windows), -1)
+
+    def profile(self, ft):
+        """ Return the radial amplitude profile of the transformed windows. """
+        return (np.abs(ft) @ self.profileMatrix) / self.shellCounts
+
+    def scaleCentre(self, emWindows, refWindows):
+        """ Return the central voxel of each map window after scaling its
+        radial profile to the one of the reference window.
+        """
+        emFt = self.transform(emWindows)
+        emProfile = self.profile(emFt)
+        refProfile = self.profile(self.transform(refWindows))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = refProfile / emProfile
+        scale[~np.isfinite(scale)] = 0.
+
+        centreTerms = np.real(emFt * self.phase) @ self.shellMatrix
+        return (centreTerms * scale).sum(axis=1).astype(np.float32)
+
+
+def readSlab(data, z0, z1, before, after):
+    """ Read the z range [z0-before, z1+after) of a map, padded with
+    zeros outside the map and by (before, after) in y and x.
+    """
+    nz = data.shape[0]
+    start, end = max(z0 - before, 0), min(z1 + after, nz)
+    slab = np.asarray(data[start:end], dtype=np.float32)
+    pad = (start - (z0 - before), (z1 + after) - end)
+    return np.pad(slab, (pad, (before, after), (before, after)))
+
+
+def _openMaps(fileNames, maps):
+    """ Memory map the files missing in the maps dict. """
+    for fn in fileNames:
+        if fn and fn not in maps:
+            maps[fn] = mrcfile.mmap(fn, mode='r', permissive=True)
+    return maps
+
+
+def _closeMaps(maps):
+    for mrc in maps.values():
+        mrc.close()
+    maps.clear()
+
+
+def _initWorker(fileNames):
+    _openMaps(fileNames, _workerMaps)
+
+
+def _scaleWorkerSlab(*args):
+    return _scaleSlab(_workerMaps, *args)
+
+
+def _scaleSlab(maps, emFns, refFn, maskFn, z0, z1, wn, batchSize):
+    """ Scale the voxels of the slab [z0, z1) of the maps (a dict of
+    opened maps by file name). Return the scaled slab.
+    """
+    before, after = wn // 2, wn - wn // 2 - 1
+    emSlab = sum(readSlab(maps[fn].data, z0, z1, before, after)
+                 for fn in emFns)
+    emSlab /= len(emFns)
+    refSlab = readSlab(maps[refFn].data, z0, z1, before, after)
+
+    emViews = sliding_window_view(emSlab, (wn, wn, wn))
+    refViews = sliding_window_view(refSlab, (wn, wn, wn))
+    output = np.zeros(emViews.shape[:3], dtype=np.float32)
+
+    if maskFn:
+        mask = np.asarray(maps[maskFn].data[z0:z1]) > 0.5
+    else:
+        mask = np.ones(output.shape, dtype=bool)
+
+    locs = np.argwhere(mask)
+    operator = ShellOperator(wn)
+    for i in range(0, len(locs), batchSize):
+        z, y, x = locs[i:i + batchSize].T
+        output[z, y, x] = operator.scaleCentre(emViews[z, y, x],
+                                               refViews[z, y, x])
+    return z0, z1, output
+
+
+def getBatchSize(wn, memory=DEFAULT_MEMORY):
+    """ Number of windows transformed at once to fit in memory (MB). """
+    # real windows and (double precision) complex transforms of both
+    # map and reference, plus the temporaries of the profile computation
+    windowBytes = 2 * (4 * wn ** 3 + 16 * wn * wn * (wn // 2 + 1)) * 2
+    return max(1, int(memory * 1024 ** 2 // windowBytes))
+
+
+def runLocalScaling(emmapFns, refFn, outputFn, apix, maskFn=None,
+                    windowSize=None, numberOfProcs=1, memory=DEFAULT_MEMORY):
+    """ Run the local amplitude scaling.
+    Params:
+        emmapFns: list of input map files (half maps are averaged).
+        refFn: reference (model) map file.
+        outputFn: output mrc file.
+        apix: sampling rate in A/px.
+        maskFn: optional mask file, only voxels inside it are scaled.
+        windowSize: window size in pixels, computed from apix if None.
+        numberOfProcs: number of processes in the pool.
+        memory: memory used by each process, in MB.
+    """
+    wn = getWindowSize(apix, windowSize)
+    batchSize = getBatchSize(wn, memory)
+    fileNames = list(emmapFns) + [refFn, maskFn]
+
+    with mrcfile.mmap(emmapFns[0], mode='r', permissive=True) as mrc:
+        shape = mrc.data.shape
+        origin = mrc.header.origin.copy()
+
+    # slabs as thick as the window, but enough of them to feed all processes
+    nz = shape[0]
+    slabSize = max(1, min(wn, -(-nz // (4 * numberOfProcs))))
+    slabs = [(z, min(z + slabSize, nz)) for z in range(0, nz, slabSize)]
+
+    with mrcfile.new_mmap(outputFn, shape=shape, mrc_mode=2,
+                          overwrite=True) as output:
+        if numberOfProcs > 1:
+            # imported here, the protocol only needs the defaults of the module
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # spawn: the caller is usually a threaded steps executor
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(numberOfProcs, mp_context=context,
+                                     initializer=_initWorker,
+                                     initargs=(fileNames,)) as pool:
+                futures = [pool.submit(_scaleWorkerSlab, emmapFns, refFn,
+                                       maskFn, z0, z1, wn, batchSize)
+                           for z0, z1 in slabs]
+                for future in futures:
+                    z0, z1, slab = future.result()
+                    output.data[z0:z1] = slab
+        else:
+            maps = _openMaps(fileNames, {})
+            try:
+                for z0, z1 in slabs:
+                    output.data[z0:z1] = _scaleSlab(maps, emmapFns, refFn,
+                                                    maskFn, z0, z1, wn,
+                                                    batchSize)[2]
+            finally:
+                _closeMaps(maps)
+
+        output.voxel_size = apix
+        output.header.origin = origin
+        updateHeaderStats(output)
+
+    return os.path.exists(outputFn)
+
+
+def main():
+    """ Command line entry point, used to run the engine on work units
+    out of the Scipion process (e.g. distributed tiles).
+    """
+    parser = argparse.ArgumentParser(description="Local amplitude scaling")
+    parser.add_argument('--emmaps', nargs='+', required=True)
+    parser.add_argument('--ref', required=True)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--apix', type=float, required=True)
+    parser.add_argument('--mask', default=None)
+    parser.add_argument('--window_size', type=int, default=None)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--memory', type=int, default=DEFAULT_MEMORY)
+    args = parser.parse_args()
+
+    runLocalScaling(args.emmaps, args.ref, args.output, args.apix,
+                    maskFn=args.mask, windowSize=args.window_size,
+                    numberOfProcs=args.processes, memory=args.memory)
+
+
+if __name__ == '__main__':
+    main()
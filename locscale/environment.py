@@ -0,0 +1,179 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Resolution of the environment of LocScale. The variables set by the shell
+activation of the environment are resolved once, stored in a file and
+applied to the environment of the programs, which are then launched
+without activating it. The file is resolved again when the activation
+command changes or when packages are installed in the conda environment
+(its conda-meta folder changes).
+
+Path lists (variables ending in PATH) are stored as the entries added
+and removed by the activation, not as absolute values, so they can be
+applied to environments with other entries (e.g. the one of CCP4).
+"""
+
+import os
+import json
+import fcntl
+import subprocess
+
+# Marks the line with the resolved variables in the activation output
+MARKER = '__LOCSCALE_ENVIRON__'
+# Version of the stored changes, older files are resolved again
+FORMAT = 2
+# Variables of the shell that are not part of the environment
+SHELL_VARIABLES = ('_', 'SHLVL', 'PWD', 'OLDPWD')
+RESOLVE_SCRIPT = ("import json, os, sys; print(%r + json.dumps("
+                  "{'environ': dict(os.environ), 'python': sys.executable}))"
+                  % MARKER)
+
+
+def _getCondaMetaTime(resolved):
+    condaMeta = resolved['condaMeta']
+    return os.stat(condaMeta).st_mtime if condaMeta else None
+
+
+def _isPathList(key):
+    return key.endswith('PATH')
+
+
+def _splitPaths(value):
+    return [entry for entry in (value or '').split(os.pathsep) if entry]
+
+
+def diffEnviron(environ, changed):
+    """ Return the changes from environ to changed: the variables set,
+    the entries added to and removed from path lists and the variables
+    removed.
+    """
+    changes = {'set': {}, 'paths': {}, 'unset': []}
+    for key, value in changed.items():
+        old = environ.get(key)
+        if old == value or key in SHELL_VARIABLES:
+            continue
+        if _isPathList(key):
+            oldEntries, entries = _splitPaths(old), _splitPaths(value)
+            changes['paths'][key] = {
+                'add': [e for e in entries if e not in oldEntries],
+                'remove': [e for e in oldEntries if e not in entries]}
+        else:
+            changes['set'][key] = value
+    changes['unset'] = [key for key in environ if key not in changed
+                        and key not in SHELL_VARIABLES]
+    return changes
+
+
+def resolveEnviron(activationCmd, environ, timeout=600):
+    """ Return the changes that the activation command makes to environ
+    (see diffEnviron), together with the python of the activated
+    environment.
+    """
+    output = subprocess.run(
+        f"{activationCmd} && python -c \"{RESOLVE_SCRIPT}\"", shell=True,
+        executable='/bin/bash', env=environ, stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL, timeout=timeout, check=True).stdout
+    activated = None
+    for line in output.decode(errors='replace').splitlines():
+        if line.startswith(MARKER):
+            activated = json.loads(line[len(MARKER):])
+    if activated is None:
+        raise ValueError("The activation of the environment did not run "
+                         "python")
+
+    changes = diffEnviron(environ, activated['environ'])
+    changes.update(python=activated['python'], format=FORMAT)
+
+    prefix = activated['environ'].get('CONDA_PREFIX')
+    condaMeta = prefix and os.path.join(prefix, 'conda-meta')
+    changes['condaMeta'] = (condaMeta if condaMeta and os.path.isdir(condaMeta)
+                            else None)
+    changes['activation'] = activationCmd
+    changes['condaMetaTime'] = _getCondaMetaTime(changes)
+    return changes
+
+
+def isValid(resolved, activationCmd):
+    """ Return True if the resolved environment is the current one. """
+    try:
+        return (resolved.get('format') == FORMAT
+                and resolved['activation'] == activationCmd
+                and os.path.exists(resolved['python'])
+                and resolved['condaMetaTime'] == _getCondaMetaTime(resolved))
+    except (OSError, KeyError):
+        return False
+
+
+def readEnviron(environFn, activationCmd):
+    """ Return the resolved environment stored in environFn, or None if it
+    is missing or out of date.
+    """
+    try:
+        with open(environFn) as f:
+            resolved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return resolved if isValid(resolved, activationCmd) else None
+
+
+def getResolvedEnviron(environFn, activationCmd, environ):
+    """ Return the resolved environment stored in environFn, resolving it
+    again if it is out of date. Concurrent launches wait for the one
+    resolving it instead of activating the environment as well.
+    """
+    resolved = readEnviron(environFn, activationCmd)
+    if resolved is not None:
+        return resolved
+
+    os.makedirs(os.path.dirname(environFn), exist_ok=True)
+    with open(environFn + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        resolved = readEnviron(environFn, activationCmd)
+        if resolved is None:
+            resolved = resolveEnviron(activationCmd, environ)
+            with open(environFn + '.tmp', 'w') as f:
+                json.dump(resolved, f, indent=1)
+            os.replace(environFn + '.tmp', environFn)
+    return resolved
+
+
+def applyEnviron(environ, changes):
+    """ Apply the changes of a resolved environment (or diffEnviron) to
+    environ. Entries added to path lists go first, other entries keep
+    their order.
+    """
+    for key in changes['unset']:
+        environ.pop(key, None)
+    for key, paths in changes['paths'].items():
+        entries = [e for e in _splitPaths(environ.get(key))
+                   if e not in paths['add'] and e not in paths['remove']]
+        entries = paths['add'] + entries
+        if entries:
+            environ[key] = os.pathsep.join(entries)
+        else:
+            environ.pop(key, None)
+    environ.update(changes['set'])
+    return environ
@@ -0,0 +1,120 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Fourier space operations on maps: resizing by Fourier cropping or
+padding, which changes the sampling while keeping the extent of the map,
+and Fourier shell correlation.
+"""
+
+import numpy as np
+import mrcfile
+
+from locscale.convert import updateHeaderStats
+
+
+def getFourierCropSize(size, apix, resolution, margin=1.5):
+    """ Return the even box size of a map Fourier cropped to a sampling
+    whose Nyquist frequency is margin times beyond the target resolution,
+    or None if the map is not sampled finer than that.
+    """
+    cropApix = resolution / (2. * margin)
+    cropSize = 2 * int(np.ceil(size * apix / cropApix / 2.))
+    return cropSize if cropSize < size else None
+
+
+def _resizeSpectrum(ft, shape):
+    """ Crop or zero pad the (z, y shifted) rfft of a map to the rfft of
+    a map of the given shape.
+    """
+    output = np.zeros(shape[:2] + (shape[2] // 2 + 1,), dtype=ft.dtype)
+    src, dst = [], []
+    for axis in range(2):
+        n = min(ft.shape[axis], output.shape[axis])
+        src.append(slice(ft.shape[axis] // 2 - n // 2,
+                         ft.shape[axis] // 2 - n // 2 + n))
+        dst.append(slice(output.shape[axis] // 2 - n // 2,
+                         output.shape[axis] // 2 - n // 2 + n))
+    n = min(ft.shape[2], output.shape[2])
+    output[dst[0], dst[1], :n] = ft[src[0], src[1], :n]
+    return output
+
+
+def fourierResizeVolume(inputFn, outputFn, size, binary=False):
+    """ Write a volume resized to a cubic box of size by cropping or zero
+    padding its Fourier transform. The voxel size is scaled so the map
+    keeps its extent, origin and mean value. Binary volumes (masks) are
+    thresholded at 0.5 after resizing.
+    """
+    with mrcfile.open(inputFn, mode='r', permissive=True) as mrc:
+        data = np.asarray(mrc.data, dtype=np.float32)
+        voxelSize = mrc.voxel_size.copy()
+        origin = mrc.header.origin.copy()
+
+    inputShape, shape = data.shape, (size,) * 3
+    ft = np.fft.fftshift(np.fft.rfftn(data, norm='forward'), axes=(0, 1))
+    del data
+    ft = np.fft.ifftshift(_resizeSpectrum(ft, shape), axes=(0, 1))
+    resized = np.fft.irfftn(ft, s=shape, norm='forward').astype(np.float32)
+    del ft
+    if binary:
+        resized = (resized > 0.5).astype(np.float32)
+
+    with mrcfile.new(outputFn, overwrite=True) as output:
+        output.set_data(resized)
+        output.voxel_size = tuple(float(voxelSize[axis]) * n / size
+                                  for axis, n in zip('xyz',
+                                                     inputShape[::-1]))
+        output.header.origin = origin
+        updateHeaderStats(output)
+
+
+def getFsc(fn1, fn2):
+    """ Return the spatial frequencies (1/A) and the Fourier shell
+    correlation of two cubic maps of the same box and sampling.
+    """
+    with mrcfile.open(fn1, mode='r', permissive=True) as mrc:
+        ft1 = np.fft.rfftn(np.asarray(mrc.data, dtype=np.float32))
+        apix = float(mrc.voxel_size.x)
+    with mrcfile.open(fn2, mode='r', permissive=True) as mrc:
+        ft2 = np.fft.rfftn(np.asarray(mrc.data, dtype=np.float32))
+
+    n = ft1.shape[0]
+    f = np.fft.fftfreq(n) * n
+    fx = np.fft.rfftfreq(n) * n
+    shells = np.rint(np.sqrt(f[:, None, None] ** 2 + f[None, :, None] ** 2
+                             + fx[None, None, :] ** 2)).astype(int)
+    # frequencies beyond Nyquist (corners of the box) are left out
+    nShells = n // 2 + 1
+    shells = np.minimum(shells, nShells).ravel()
+
+    def _sum(values):
+        return np.bincount(shells, weights=values.ravel(),
+                           minlength=nShells + 1)[:nShells]
+
+    cross = _sum((ft1 * np.conj(ft2)).real)
+    power1, power2 = _sum(np.abs(ft1) ** 2), _sum(np.abs(ft2) ** 2)
+    fsc = cross / np.maximum(np.sqrt(power1 * power2), np.finfo(float).tiny)
+    return np.arange(nShells) / (n * apix), fsc
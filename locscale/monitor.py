@@ -0,0 +1,404 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Instrumentation of LocScale runs. The output of the program is followed
+to detect its stages and progress, while the process tree is sampled to
+record wall time, CPU time and peak memory of every stage. Jobs launched
+by Protocol.runJob are found among the children of this process by their
+working directory, and their output is followed in the file it is copied
+to.
+
+When profiling, the monitor also counts the samples of every program of
+the tree by state (running, waiting for I/O or sleeping) and, if py-spy
+is installed, records the Python stacks of the tree.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import threading
+import subprocess
+
+import psutil
+
+STARTUP_STAGE = 'start-up'
+# Stages of LocScale, detected from its verbose output
+STAGE_PATTERNS = [
+    ('pseudo-model', re.compile(r'pseudo.?(atom|model)', re.I)),
+    ('refmac', re.compile(r'refmac|refin', re.I)),
+    ('model map', re.compile(r'simulat|model.?map', re.I)),
+    ('scaling', re.compile(r'local.?scal|scaling|sharpen', re.I)),
+    ('emmernet', re.compile(r'emmernet|predict', re.I)),
+]
+# tqdm progress bars: " 45%|####      | 450/1000 [00:10<00:12, ...]"
+PROGRESS_PATTERN = re.compile(r'(\d+)%\|.*?<([\d:]+)')
+# Sampling rate (Hz) of py-spy when profiling
+PYSPY_RATE = 20
+
+
+class JobMonitor:
+    """ Follow a running job and write its statistics to a JSON file.
+    The file is updated periodically while the job runs, so the protocol
+    summary can show a live progress line.
+    """
+    def __init__(self, statsFn, output=sys.stdout, interval=2.,
+                 profile=False, stacksFn=None):
+        """
+        Params:
+            profile: count the samples of every program of the tree.
+            stacksFn: if py-spy is installed, record the Python stacks of
+                the tree in this file (folded stacks for flame graphs).
+        """
+        self.statsFn = statsFn
+        self.output = output
+        self.interval = interval
+        self.profile = profile
+        self.stacksFn = stacksFn
+        self._programs = {}  # program name -> sample counts by state
+        self._programPids = {}  # pid -> program name
+        self._pyspy = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._cpuTimes = {}  # last cpu time seen for every pid of the tree
+        self._buffer = ''
+        self._process = None
+        self._cwd = None  # working directory of the job to find
+        self._outputFn = None
+        self._outputFile = None
+        self._onAttach = None
+        self._startTime = time.time()
+        self._peakRss = 0
+        self._stages = {}
+        self._stageOrder = []
+        self._progress = None
+        self._enterStage(STARTUP_STAGE)
+
+    # ------------------------- stages ----------------------------------------
+    def _enterStage(self, name):
+        now = time.time()
+        cpu = self._treeCpuTime()
+        if self._stageOrder:
+            current = self._stages[self._stageOrder[-1]]
+            current['wallTime'] += now - current.pop('_start')
+            current['cpuTime'] += cpu - current.pop('_cpuStart')
+        if name not in self._stages:
+            self._stages[name] = {'wallTime': 0., 'cpuTime': 0., 'peakRss': 0}
+        self._stages[name].update({'_start': now, '_cpuStart': cpu})
+        if name in self._stageOrder:
+            self._stageOrder.remove(name)
+        self._stageOrder.append(name)
+        self._progress = None
+
+    def feedLine(self, line):
+        """ Process a line of the job output. """
+        with self._lock:
+            current = self._stageOrder[-1]
+            for name, pattern in STAGE_PATTERNS:
+                if name != current and pattern.search(line):
+                    self._enterStage(name)
+                    break
+            match = PROGRESS_PATTERN.search(line)
+            if match:
+                self._progress = {'percent': int(match.group(1)),
+                                  'eta': match.group(2)}
+
+    # file-like interface, to use the monitor as output of other runners
+    def write(self, text):
+        self.output.write(text)
+        self._feedText(text)
+
+    def _feedText(self, text):
+        self._buffer += text
+        *lines, self._buffer = re.split(r'[\r\n]', self._buffer)
+        for line in lines:
+            self.feedLine(line)
+
+    def flush(self):
+        self.output.flush()
+
+    # ------------------------- sampling --------------------------------------
+    def _treeProcesses(self):
+        if self._process is None:
+            return []
+        try:
+            return [self._process] + self._process.children(recursive=True)
+        except psutil.Error:
+            return []
+
+    def _treeCpuTime(self):
+        """ Return the CPU time used so far by the process tree, including
+        the processes that already finished.
+        """
+        for proc in self._treeProcesses():
+            try:
+                times = proc.cpu_times()
+                self._cpuTimes[proc.pid] = times.user + times.system
+            except psutil.Error:
+                pass
+        return sum(self._cpuTimes.values())
+
+    def _sampleProgram(self, proc):
+        """ Count a sample of the state of a process of the tree. """
+        name = self._programPids.get(proc.pid)
+        if name is None:
+            name = self._programPids[proc.pid] = proc.name()
+        status = proc.status()
+        counts = self._programs.setdefault(
+            name, {'samples': 0, 'running': 0, 'ioWait': 0})
+        counts['samples'] += 1
+        if status == psutil.STATUS_RUNNING:
+            counts['running'] += 1
+        elif status == psutil.STATUS_DISK_SLEEP:
+            counts['ioWait'] += 1
+
+    def _sample(self):
+        rss = 0
+        for proc in self._treeProcesses():
+            try:
+                rss += proc.memory_info().rss
+                if self.profile:
+                    with self._lock:
+                        self._sampleProgram(proc)
+            except psutil.Error:
+                pass
+        with self._lock:
+            self._treeCpuTime()
+            self._peakRss = max(self._peakRss, rss)
+            stage = self._stages[self._stageOrder[-1]]
+            stage['peakRss'] = max(stage['peakRss'], rss)
+
+    def _attach(self, process):
+        """ Sample the process tree of process from now on. """
+        self._process = process
+        if self._onAttach is not None:
+            self._onAttach(process.pid)
+        if self.stacksFn and shutil.which('py-spy'):
+            self._pyspy = subprocess.Popen(
+                ['py-spy', 'record', '--pid', str(process.pid),
+                 '--subprocesses', '--nonblocking', '--rate', str(PYSPY_RATE),
+                 '--format', 'raw', '--output', self.stacksFn],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _findJob(self):
+        """ Attach to the child of this process running in the working
+        directory of the job, once it is launched.
+        """
+        try:
+            for child in psutil.Process().children():
+                if child.cwd() == self._cwd:
+                    self._attach(child)
+                    return
+        except psutil.Error:
+            pass
+
+    def _readOutput(self):
+        """ Process the lines added to the output file of the job. """
+        if self._outputFile is None:
+            try:
+                self._outputFile = open(self._outputFn, errors='replace')
+            except OSError:
+                return
+        self._feedText(self._outputFile.read())
+
+    def _sampleLoop(self):
+        lastWrite = 0
+        while not self._stop.wait(self.interval / 4):
+            if self._process is None and self._cwd:
+                self._findJob()
+            if self._outputFn:
+                self._readOutput()
+            self._sample()
+            if time.time() - lastWrite > self.interval:
+                self.writeStats(running=True)
+                lastWrite = time.time()
+
+    def start(self, pid=None, cwd=None, outputFn=None, onAttach=None):
+        """ Start sampling the process tree of pid or, if cwd is given, of
+        the child of this process that will run in cwd. The stages and
+        progress are taken from the output written to the monitor or to
+        outputFn. Without pid or cwd (e.g. jobs run by the worker), only
+        stages and progress are followed. onAttach is called with the pid
+        of the sampled process.
+        """
+        self._onAttach = onAttach
+        if pid:
+            self._attach(psutil.Process(pid))
+        self._cwd = os.path.abspath(cwd) if cwd else None
+        self._outputFn = outputFn
+        self._thread = threading.Thread(target=self._sampleLoop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop sampling and write the final statistics. """
+        self._stop.set()
+        self._thread.join()
+        if self._outputFn:
+            self._readOutput()
+        if self._outputFile is not None:
+            self._outputFile.close()
+        if self._pyspy is not None:
+            # py-spy writes its output when the sampled process ends
+            try:
+                self._pyspy.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self._pyspy.terminate()
+                self._pyspy.wait()
+        with self._lock:
+            self._enterStage('_end')
+            del self._stages['_end']
+            self._stageOrder.remove('_end')
+        self.writeStats(running=False)
+
+    # ------------------------- results ---------------------------------------
+    def getStats(self, running=False):
+        with self._lock:
+            stages = [dict(name=name, **{k: v for k, v in self._stages[name].items()
+                                         if not k.startswith('_')})
+                      for name in self._stageOrder]
+            stats = {'running': running,
+                     'stage': self._stageOrder[-1] if running else None,
+                     'progress': self._progress if running else None,
+                     'wallTime': time.time() - self._startTime,
+                     'cpuTime': sum(self._cpuTimes.values()),
+                     'peakRss': self._peakRss,
+                     'stages': stages}
+            if self.profile:
+                programs = {name: dict(counts, cpuTime=0.)
+                            for name, counts in self._programs.items()}
+                for pid, cpu in self._cpuTimes.items():
+                    if pid in self._programPids:
+                        programs[self._programPids[pid]]['cpuTime'] += cpu
+                stats['programs'] = programs
+            return stats
+
+    def writeStats(self, running=False):
+        stats = self.getStats(running)
+        with open(self.statsFn + '.tmp', 'w') as f:
+            json.dump(stats, f, indent=1)
+        os.replace(self.statsFn + '.tmp', self.statsFn)
+
+
+def readStats(statsFn):
+    """ Return the statistics written by a JobMonitor, or None. """
+    try:
+        with open(statsFn) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def mergeStats(statsList):
+    """ Merge the statistics of several finished jobs: times are added
+    and the peak memory is the maximum of the jobs.
+    """
+    merged = {'running': False, 'wallTime': 0., 'cpuTime': 0., 'peakRss': 0,
+              'stages': []}
+    stages = {}
+    for stats in statsList:
+        merged['wallTime'] += stats['wallTime']
+        merged['cpuTime'] += stats['cpuTime']
+        merged['peakRss'] = max(merged['peakRss'], stats['peakRss'])
+        for stage in stats['stages']:
+            if stage['name'] not in stages:
+                stages[stage['name']] = dict(stage)
+                merged['stages'].append(stages[stage['name']])
+            else:
+                total = stages[stage['name']]
+                total['wallTime'] += stage['wallTime']
+                total['cpuTime'] += stage['cpuTime']
+                total['peakRss'] = max(total['peakRss'], stage['peakRss'])
+    return merged
+
+
+def formatStats(stats):
+    """ Return summary lines for the statistics of a job. """
+    if stats['running']:
+        line = "Running: %s" % stats['stage']
+        if stats['progress']:
+            line += " %d%% (ETA %s)" % (stats['progress']['percent'],
+                                        stats['progress']['eta'])
+        return [line]
+
+    lines = ["Total: %s wall, %s CPU, peak memory %s"
+             % (formatTime(stats['wallTime']), formatTime(stats['cpuTime']),
+                formatBytes(stats['peakRss']))]
+    for stage in stats['stages']:
+        lines.append("   %s: %s wall, %s CPU, peak memory %s"
+                     % (stage['name'], formatTime(stage['wallTime']),
+                        formatTime(stage['cpuTime']),
+                        formatBytes(stage['peakRss'])))
+    return lines
+
+
+def getHotFunctions(profileFn, n=15, sortKey='tottime'):
+    """ Return the n functions of a cProfile file with the highest sortKey
+    (tottime or cumtime), as (name, calls, tottime, cumtime) tuples.
+    """
+    import pstats  # only to show the profiles
+    stats = pstats.Stats(profileFn).stats
+    functions = [(pstats.func_std_string(func), calls, tottime, cumtime)
+                 for func, (_, calls, tottime, cumtime, _) in stats.items()]
+    index = 2 if sortKey == 'tottime' else 3
+    return sorted(functions, key=lambda f: f[index], reverse=True)[:n]
+
+
+def formatProfile(profileFn, n=15):
+    """ Return summary lines with the hot functions of a cProfile file. """
+    lines = ["   %10s %10s %10s  %s" % ('tottime', 'cumtime', 'calls',
+                                        'function')]
+    for name, calls, tottime, cumtime in getHotFunctions(profileFn, n):
+        lines.append("   %9.2fs %9.2fs %10d  %s" % (tottime, cumtime, calls,
+                                                    name))
+    return lines
+
+
+def formatPrograms(stats):
+    """ Return summary lines with the samples of the programs of a job. """
+    programs = stats.get('programs', {})
+    total = sum(p['samples'] for p in programs.values()) or 1
+    lines = []
+    for name, counts in sorted(programs.items(),
+                               key=lambda item: -item[1]['cpuTime']):
+        lines.append("   %s: %s CPU, %d%% of samples (%d%% running, "
+                     "%d%% I/O wait)"
+                     % (name, formatTime(counts['cpuTime']),
+                        100 * counts['samples'] / total,
+                        100 * counts['running'] / max(counts['samples'], 1),
+                        100 * counts['ioWait'] / max(counts['samples'], 1)))
+    return lines
+
+
+def formatTime(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%02d:%02d:%02d' % (hours, minutes, seconds)
+
+
+def formatBytes(nBytes):
+    return '%.2f GB' % (nBytes / 1024 ** 3)
@@ -0,0 +1,170 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Prediction of the peak memory and runtime of LocScale runs, used to
+choose the split of each run in MPI ranks and threads per rank, and to
+refuse runs that do not fit in memory. Both are linear models of the box
+size, ranks and threads, calibrated with least squares from the recorded
+past runs.
+"""
+
+import os
+import json
+import fcntl
+import socket
+
+import numpy as np
+import psutil
+
+from locscale.constants import LOCSCALE_BYTES_PER_VOXEL
+
+# Minimum number of recorded runs to calibrate the models
+MIN_RUNS = 8
+# Fraction of the available memory that the runs can use
+MEMORY_MARGIN = 0.9
+
+# Default coefficients, used until there are enough recorded runs.
+# memory of each rank: [bytes, bytes/voxel, bytes/voxel per extra thread,
+# x input bytes]
+DEFAULT_MEMORY_MODEL = [1024 ** 3, LOCSCALE_BYTES_PER_VOXEL,
+                        LOCSCALE_BYTES_PER_VOXEL / 4, 1.]
+# time: [seconds, seconds/voxel per thread, seconds/voxel]
+DEFAULT_TIME_MODEL = [120., 2e-5, 1e-7]
+
+
+def getHostResources():
+    """ Return the number of cores and the available memory (bytes). """
+    return (len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity')
+            else os.cpu_count(), psutil.virtual_memory().available)
+
+
+def _memoryFeatures(voxels, processes, inputBytes, ranks=1):
+    # every rank holds its own copy of the maps
+    return [ranks, ranks * voxels, ranks * voxels * (processes - 1),
+            ranks * inputBytes]
+
+
+def _timeFeatures(voxels, processes, ranks=1):
+    return [1., voxels / (ranks * processes), voxels]
+
+
+def recordRun(historyFn, voxels, processes, inputBytes, stats, ranks=1,
+              **extra):
+    """ Append a finished run to the history file.
+    Params:
+        voxels: number of voxels of the sharpened box.
+        processes: number of LocScale threads (processes) of each rank.
+        inputBytes: size of the input maps on disk.
+        stats: statistics recorded by the JobMonitor of the run.
+        ranks: number of MPI ranks of the run.
+        extra: other values to keep (e.g. version).
+    """
+    record = dict(extra, voxels=voxels, processes=processes, ranks=ranks,
+                  inputBytes=inputBytes, peakRss=stats['peakRss'],
+                  wallTime=stats['wallTime'], host=socket.gethostname())
+    os.makedirs(os.path.dirname(historyFn), exist_ok=True)
+    with open(historyFn, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(record) + '\n')
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def readHistory(historyFn):
+    """ Return the recorded runs, skipping those without memory data. """
+    if not os.path.exists(historyFn):
+        return []
+    records = []
+    with open(historyFn) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('peakRss', 0) > 0:
+                records.append(record)
+    return records
+
+
+def _fit(features, values, default):
+    """ Non negative least squares fit by clipping, or the default. """
+    if len(values) < MIN_RUNS:
+        return np.array(default, dtype=float)
+    coefs = np.linalg.lstsq(np.array(features), np.array(values),
+                            rcond=None)[0]
+    return np.maximum(coefs, 0.)
+
+
+class ResourcePlanner:
+    """ Predict and plan the resources of LocScale runs. """
+    def __init__(self, history=()):
+        self.nRuns = len(history)
+        self.memoryModel = _fit(
+            [_memoryFeatures(r['voxels'], r['processes'], r['inputBytes'],
+                             r.get('ranks', 1)) for r in history],
+            [r['peakRss'] for r in history], DEFAULT_MEMORY_MODEL)
+        self.timeModel = _fit(
+            [_timeFeatures(r['voxels'], r['processes'], r.get('ranks', 1))
+             for r in history],
+            [r['wallTime'] for r in history], DEFAULT_TIME_MODEL)
+
+    def isCalibrated(self):
+        return self.nRuns >= MIN_RUNS
+
+    def predictMemory(self, voxels, processes, inputBytes, ranks=1):
+        """ Return the predicted peak memory of a run in bytes. """
+        return float(np.dot(self.memoryModel, _memoryFeatures(
+            voxels, processes, inputBytes, ranks)))
+
+    def predictTime(self, voxels, processes, ranks=1):
+        """ Return the predicted wall time of a run in seconds. """
+        return float(np.dot(self.timeModel,
+                            _timeFeatures(voxels, processes, ranks)))
+
+    def plan(self, voxels, inputBytes, concurrent=1, cores=None, memory=None,
+             maxRanks=1):
+        """ Return the MPI ranks and threads per rank of each of the
+        concurrent runs: the cores are shared among the runs, and the
+        split with the shortest predicted time whose predicted memory fits
+        in the available one is chosen (the smallest memory among equally
+        fast ones). Return None if even a single thread per run does not
+        fit.
+        """
+        hostCores, hostMemory = getHostResources()
+        cores = max(1, (cores or hostCores) // concurrent)
+        memory = (memory or hostMemory) * MEMORY_MARGIN / concurrent
+        best, bestCost = None, None
+        for ranks in range(1, min(maxRanks, cores) + 1):
+            threads = cores // ranks
+            while threads > 0 and self.predictMemory(
+                    voxels, threads, inputBytes, ranks) > memory:
+                threads -= 1
+            if threads == 0:
+                continue
+            cost = (self.predictTime(voxels, threads, ranks),
+                    self.predictMemory(voxels, threads, inputBytes, ranks))
+            if bestCost is None or cost < bestCost:
+                best, bestCost = (ranks, threads), cost
+        return best
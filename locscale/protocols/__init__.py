@@ -25,3 +25,5 @@
 # **************************************************************************
 
 from .protocol_locscale import ProtLocScale
+from .protocol_locscale_streaming import ProtLocScaleStreaming
+from .protocol_locscale_sweep import ProtLocScaleSweep
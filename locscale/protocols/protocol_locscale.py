@@ -24,20 +24,56 @@
 # *
 # **************************************************************************
 import os
+import sys
+import json
+import math
+import time
+import shlex
+from glob import glob
 from enum import Enum
+from contextlib import contextmanager
+
+import numpy as np
+import mrcfile
 
 from pwem.protocols import ProtFilterVolumes
-from pwem.objects import Volume
-from pwem.emlib.image import ImageHandler
-from pyworkflow.protocol import params
+from pwem.objects import Volume, SetOfVolumes
+from pyworkflow.protocol import params, STEPS_PARALLEL
+from pyworkflow.object import Integer, Float
 import pyworkflow.utils as pwutils
 
-from locscale.constants import REF_VOL, REF_PDB, REF_NONE, V2_1
-from locscale import Plugin
+from locscale.constants import (REF_VOL, REF_PDB, REF_NONE, V2_1,
+                                ENGINE_LOCSCALE, ENGINE_NUMPY,
+                                CROP_NONE, CROP_MASK, CROP_REGION,
+                                LOCSCALE_BYTES_PER_VOXEL, MODEL_MAP_FN,
+                                MODEL_REFINED, DEFAULT_MEMORY,
+                                GUINIER_LOW_RES)
+from locscale import Plugin, worker
+from locscale.convert import (cleanFileName, isMrcCompatible, convertVolume,
+                              normalizeVolume, readMrcHeader, getMaskBox,
+                              makeCubicBox, cropVolume, pasteVolume,
+                              canReadFloat16, MRC_FLOAT32, MRC_FLOAT16)
+from locscale.cache import FileCache, fileDigest, linkOrCopy
+from locscale.results import ResultIndex, getFingerprint
+from locscale.engine import runLocalScaling, getWindowSize
+from locscale.fourier import getFourierCropSize, fourierResizeVolume, getFsc
+from locscale.symmetry import (getSymmetryMatrices, getAsymmetricUnitBox,
+                               expandAsymmetricUnit, getSymmetryError)
+from locscale.tiling import TileGrid, getTileSize, stitchTiles
+from locscale import distribute, scratch
+from locscale.distribute import writePlan, getFailedUnits
+from locscale.monitor import (JobMonitor, readStats, formatStats, mergeStats,
+                              formatProfile, formatPrograms, formatBytes,
+                              formatTime)
+from locscale.planner import (ResourcePlanner, getHostResources, recordRun,
+                              readHistory)
+from locscale.broker import ResourceBroker
+from locscale.sharpening import globalSharpen
 
 
 class outputs(Enum):
     Volume = Volume
+    Volumes = SetOfVolumes
 
 
 class ProtLocScale(ProtFilterVolumes):
@@ -46,6 +82,27 @@ class ProtLocScale(ProtFilterVolumes):
     """
     _label = 'local sharpening'
     _possibleOutputs = outputs
+    # parameters that change the sharpened map, part of the fingerprint of
+    # the runs in the results cache (inputs are identified by content)
+    _resultParams = ['useNNpredict', 'emmernetModel', 'symmetryGroup',
+                     'asymmetricUnit', 'asymmetricUnitPadding', 'refType',
+                     'incompletePdb', 'engine', 'windowSize', 'cropMode',
+                     'cropPadding', 'cropRegion', 'fourierCrop',
+                     'fourierCropMargin', 'resol', 'extraParams',
+                     'outputFloat16', 'globalSharpening', 'globalBfactor',
+                     'guinierLowRes']
+
+    def __init__(self, **kwargs):
+        ProtFilterVolumes.__init__(self, **kwargs)
+        self.stepsExecutionMode = STEPS_PARALLEL
+        self.cacheHits = Integer(0)
+        self.cacheMisses = Integer(0)
+        self.modelCacheHits = Integer(0)
+        self.modelCacheMisses = Integer(0)
+        self.resultCacheHits = Integer(0)
+        self.resultCacheMisses = Integer(0)
+        self.brokerWaits = Integer(0)
+        self.brokerWaitTime = Float(0)
 
     # --------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -59,9 +116,13 @@ class ProtLocScale(ProtFilterVolumes):
                             " set to i.e. *0 1 2*.")
 
         form.addParam('inputVolume', params.PointerParam,
-                      pointerClass='Volume',
-                      important=True, label='Input EM map',
-                      help='Input EM map, should be unsharpened and unfiltered.')
+                      pointerClass='Volume, SetOfVolumes',
+                      important=True, label='Input EM map(s)',
+                      help='Input EM map, should be unsharpened and unfiltered. '
+                           'If a set of volumes is provided, every map is '
+                           'sharpened independently with the same settings '
+                           'and the maps are processed concurrently, sharing '
+                           'the number of threads of the Parallelization tab.')
 
         form.addParam('useNNpredict', params.BooleanParam,
                       default=False, label="Use EMmerNet predictions?",
@@ -70,6 +131,31 @@ class ProtLocScale(ProtFilterVolumes):
                            "prediction method using our ensemble network "
                            "EMmerNet.")
 
+        form.addParam('globalSharpening', params.BooleanParam, default=False,
+                      condition='not useNNpredict',
+                      label='Quick global sharpening?',
+                      help='Sharpen with a single B-factor inside Scipion, in '
+                           'seconds and without the LocScale environment, '
+                           'for a quick look at a new map. The B-factor is '
+                           'fitted to the Guinier plot of the map (inside the '
+                           'mask, if any) up to the target resolution, where '
+                           'the map is low-pass filtered. With half maps the '
+                           'shells are also weighted by their FSC. References '
+                           'are not used.')
+
+        form.addParam('globalBfactor', params.FloatParam, default=0,
+                      condition='globalSharpening and not useNNpredict',
+                      label='B-factor (A^2)',
+                      help='Sharpening B-factor, negative to sharpen (e.g. '
+                           '-100). If 0, it is fitted from the Guinier plot.')
+
+        form.addParam('guinierLowRes', params.FloatParam,
+                      default=GUINIER_LOW_RES,
+                      condition='globalSharpening and not useNNpredict',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Guinier fit from (A)',
+                      help='Low resolution limit of the B-factor fit.')
+
         if self.isOldVersion():
             models = ['model_based', 'model_free', 'ensemble']
         else:
@@ -88,32 +174,95 @@ class ProtLocScale(ProtFilterVolumes):
                            "generator for produce a symmetrised reference "
                            "map for scaling.")
 
-        form.addParam('refType', params.EnumParam, default=REF_PDB,
+        form.addParam('asymmetricUnit', params.BooleanParam, default=False,
                       condition='not useNNpredict',
+                      label='Sharpen only the asymmetric unit?',
+                      help='Sharpen a cubic box around one asymmetric unit '
+                           'of the symmetry group (plus a margin) and fill '
+                           'the full map from it by applying the symmetry '
+                           'operators, with trilinear interpolation. The '
+                           'symmetry centre is the centre of the box; Cn and '
+                           'Dn axes are on z (2-fold on x), T, O and I follow '
+                           'the Relion I2 orientation. D, T, O and I groups '
+                           'need a box of about half the size; Cn groups '
+                           'only gain with a mask, which also bounds the '
+                           'asymmetric unit.')
+
+        form.addParam('asymmetricUnitPadding', params.IntParam, default=20,
+                      condition='asymmetricUnit and not useNNpredict',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Asymmetric unit margin (px)',
+                      help='Margin added around the asymmetric unit, so the '
+                           'LocScale window of its border voxels is inside '
+                           'the sharpened box.')
+
+        form.addParam('asymmetricUnitCheck', params.BooleanParam,
+                      default=False,
+                      condition='asymmetricUnit and not useNNpredict',
+                      label='Compare with the full map?',
+                      help='Also sharpen the full map, to report the speedup '
+                           'and the symmetry consistency error (relative RMS '
+                           'difference and correlation inside the mask or the '
+                           'sphere of the box) of the map filled from the '
+                           'asymmetric unit.')
+
+        form.addParam('refType', params.EnumParam, default=REF_PDB,
+                      condition='not useNNpredict and not globalSharpening',
                       choices=['None', 'PDB', 'Volume'],
                       display=params.EnumParam.DISPLAY_HLIST,
                       label='Reference type:')
 
         form.addParam('refPdb', params.PointerParam,
-                      condition='refType==1 and not useNNpredict',
+                      condition=('refType==1 and not useNNpredict '
+                                 'and not globalSharpening'),
                       label="Reference PDB model",
                       pointerClass="AtomStruct", allowsNull=True,
                       help="PDBx/mmCIF file of the reference atomic model.")
 
         form.addParam('incompletePdb', params.BooleanParam,
                       default=False,
-                      condition='refType==1 and not useNNpredict',
+                      condition=('refType==1 and not useNNpredict '
+                                 'and not globalSharpening'),
                       label="Is atomic model partial?",
                       help="Add pseudo-atoms to areas of the map "
                            "which are not modelled.")
 
         form.addParam('refObj', params.PointerParam,
-                      condition='refType==2 and not useNNpredict',
+                      condition=('refType==2 and not useNNpredict '
+                                 'and not globalSharpening'),
                       label="Reference volume",
                       pointerClass='Volume', allowsNull=True,
                       help='Model map file take it as reference '
                            '(usually this volume should come from a PDB).')
 
+        form.addParam('engine', params.EnumParam, default=ENGINE_LOCSCALE,
+                      condition=('refType==2 and not useNNpredict '
+                                 'and not globalSharpening'),
+                      choices=['LocScale program', 'NumPy (in-process)'],
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label='Scaling engine',
+                      help='With a reference volume, the local amplitude '
+                           'scaling can be computed inside Scipion with NumPy, '
+                           'without activating the LocScale environment. '
+                           'The NumPy engine only runs the reference-based '
+                           'scaling: symmetry and Refmac settings are ignored.')
+
+        form.addParam('windowSize', params.IntParam, default=0,
+                      condition=('refType==2 and not useNNpredict '
+                                 'and not globalSharpening and engine==1'),
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Window size (px)',
+                      help='Size of the moving window. If 0, a window of '
+                           'about 25 A is used.')
+
+        form.addParam('engineMemory', params.IntParam, default=DEFAULT_MEMORY,
+                      condition=('refType==2 and not useNNpredict '
+                                 'and not globalSharpening and engine==1'),
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Memory per process (MB)',
+                      help='Memory used by each process of the NumPy engine '
+                           'to transform windows in batches.')
+
         form.addSection(label='Extra')
         form.addParam('binaryMask', params.PointerParam,
                       condition='not useNNpredict',
@@ -121,10 +270,97 @@ class ProtLocScale(ProtFilterVolumes):
                       label='3D mask (optional)', allowsNull=True,
                       help='Binary mask')
 
+        form.addParam('cropMode', params.EnumParam, default=CROP_NONE,
+                      choices=['No', 'Mask bounding box', 'Custom region'],
+                      label='Crop before sharpening?',
+                      help='Sharpen only a box around the particle and paste '
+                           'the result back into a full size map (zero '
+                           'outside the box) with the original header. '
+                           'Runtime scales with the number of voxels, so '
+                           'this is much faster when the particle fills a '
+                           'small part of the box. The cropped box is cubic. '
+                           'With a PDB reference, LocScale must use the map '
+                           'origin to place the model.')
+
+        form.addParam('cropPadding', params.IntParam, default=20,
+                      condition='cropMode!=0',
+                      label='Crop padding (px)',
+                      help='Margin added around the mask or region.')
+
+        form.addParam('cropRegion', params.StringParam, default='',
+                      condition='cropMode==2',
+                      label='Crop region (px)',
+                      help='Corners of the region to sharpen as '
+                           '*x0 y0 z0 x1 y1 z1*, in voxels.')
+
+        form.addParam('fourierCrop', params.BooleanParam, default=False,
+                      condition='not useNNpredict',
+                      label='Fourier crop to the target resolution?',
+                      help='Resample the input maps, reference and mask by '
+                           'Fourier cropping to a sampling matched to the '
+                           'target resolution, sharpen the smaller box and '
+                           'Fourier pad the result back to the original box '
+                           'and sampling. Frequencies beyond the target '
+                           'resolution carry no signal for the scaling, and '
+                           'runtime scales with the number of voxels. Only '
+                           'used when the maps are sampled finer than needed.')
+
+        form.addParam('fourierCropMargin', params.FloatParam, default=1.5,
+                      condition='fourierCrop and not useNNpredict',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Nyquist margin',
+                      help='The Nyquist frequency of the cropped maps is this '
+                           'times the target resolution frequency (the '
+                           'cropped sampling is resolution / (2 x margin)).')
+
+        form.addParam('fourierCropCheck', params.BooleanParam, default=False,
+                      condition='fourierCrop and not useNNpredict',
+                      label='Compare with the full box?',
+                      help='Also sharpen the full box, to report the speedup '
+                           'of the Fourier cropped run and the FSC between '
+                           'both results. The full box result is kept in the '
+                           'tmp folder.')
+
+        form.addParam('useTiles', params.BooleanParam, default=False,
+                      label='Process in tiles?',
+                      help='Split large maps in overlapping tiles that are '
+                           'sharpened independently (and concurrently, '
+                           'depending on the threads) and stitched back with '
+                           'cosine feathered overlaps. Peak memory is bounded '
+                           'by the tile size instead of the box size.')
+
+        form.addParam('tileMemory', params.FloatParam, default=16,
+                      condition='useTiles',
+                      label='Memory per tile (GB)',
+                      help='Memory budget of the sharpening of each tile, '
+                           'used to choose the tile size.')
+
+        form.addParam('tileOverlap', params.IntParam, default=64,
+                      condition='useTiles',
+                      label='Tile overlap (px)',
+                      help='Minimum overlap between neighbour tiles. It should '
+                           'be larger than the LocScale window: half a '
+                           'window at the edge of each tile is discarded '
+                           'and the rest of the overlap is blended.')
+
+        form.addParam('distributeTiles', params.BooleanParam, default=False,
+                      condition='useTiles',
+                      label='Distribute tiles over MPI ranks?',
+                      help='Run the tiles of each map as work units spread '
+                           'over the MPI ranks of the host configuration '
+                           '(MPI command and number of MPI of the '
+                           'Parallelization tab), e.g. over several cluster '
+                           'nodes. Each rank uses the number of threads. '
+                           'To submit every tile as a queue job instead, '
+                           'leave this option off and use the queue for '
+                           'steps.')
+
         form.addParam('resol', params.IntParam, default=3,
                       condition='not useNNpredict',
                       label="Target resolution (A)",
-                      help="Resolution target for Refmac refinement.")
+                      help="Resolution target for Refmac refinement. In "
+                           "quick global sharpening, upper limit of the "
+                           "B-factor fit and of the low-pass filter.")
 
         form.addParam('extraParams', params.StringParam, default='',
                       expertLevel=params.LEVEL_ADVANCED,
@@ -132,87 +368,734 @@ class ProtLocScale(ProtFilterVolumes):
                       help="Extra command line parameters. "
                            "See *locscale run_locscale --help*.")
 
+        form.addParam('outputFloat16', params.BooleanParam, default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Store output as float16?',
+                      help="Write the sharpened maps as MRC mode 12 (16-bit "
+                           "floats), which halves their size on disk. The "
+                           "precision (3 significant digits) is enough for "
+                           "visualisation and model building. Maps whose "
+                           "values exceed the float16 range are kept as "
+                           "float32, as are all maps if the image library of "
+                           "Scipion (e.g. an older Xmipp) cannot read "
+                           "float16 maps.")
+
+        form.addParam('useScratch', params.BooleanParam, default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Run in local scratch?',
+                      help="Copy the inputs of each map to a node-local "
+                           "scratch folder (LOCSCALE_SCRATCH_DIR variable, "
+                           "or TMPDIR) and run LocScale there, instead of in "
+                           "the project tmp folder, which may be on a network "
+                           "file system. The sharpened map is written to the "
+                           "project, the intermediate files to keep are "
+                           "copied back in the background and the scratch "
+                           "folder is removed, also on failure. Tiles always "
+                           "run in the project.")
+
+        form.addParam('scratchCopyBack', params.StringParam,
+                      default='*.log processing_files/*.pdb '
+                              'processing_files/*.cif',
+                      condition='useScratch',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Files copied back',
+                      help="Glob patterns, relative to the scratch folder of "
+                           "each map, of the intermediate files copied back "
+                           "to the extra/vol_<id> folder of the protocol (** "
+                           "matches any subfolder).")
+
+        form.addParam('useWorker', params.BooleanParam, default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Use persistent worker?',
+                      help="Run LocScale in a long-lived worker started in "
+                           "the LocScale environment, which keeps the heavy "
+                           "imports (scikit-learn, gemmi...) loaded between "
+                           "runs. It avoids the environment activation and "
+                           "start-up time of every run. TensorFlow cannot be "
+                           "kept loaded in the worker, so EMmerNet runs "
+                           "still import it and load their model. The "
+                           "worker is shared by all protocols of the user "
+                           "and is not used with MPI.")
+        form.addParam('useProfiler', params.BooleanParam, default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Profile LocScale?',
+                      help="Run LocScale under cProfile (not with MPI, nor "
+                           "in the worker) and sample the programs it "
+                           "runs (e.g. refmac5) by CPU time and I/O wait. "
+                           "The profile is kept in extra/profile_<run>.prof "
+                           "and the hottest functions are shown in the "
+                           "summary. If py-spy is installed, the Python "
+                           "stacks of all the processes are recorded in "
+                           "extra/stacks_<run>.txt (folded format, for "
+                           "flame graphs).")
+        form.addParam('profileTop', params.IntParam, default=15,
+                      condition='useProfiler',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Functions in the summary',
+                      help="Number of functions with the highest own time "
+                           "shown in the summary.")
+
+        form.addParam('useCache', params.BooleanParam, default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Cache converted volumes?',
+                      help="Input volumes that need a conversion to mrc are "
+                           "stored in a cache shared by all runs of the "
+                           "project (see LOCSCALE_CACHE_DIR and "
+                           "LOCSCALE_CACHE_SIZE variables), so they are not "
+                           "converted again in later runs.")
+
+        form.addParam('cacheByContent', params.BooleanParam, default=False,
+                      condition='useCache',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Identify files by content?',
+                      help="If Yes, cached files are identified by a hash of "
+                           "their content. Otherwise the inode, modification "
+                           "time and size of the file are used, which is "
+                           "faster but misses copies of the same file.")
+
+        form.addParam('useModelCache', params.BooleanParam, default=True,
+                      condition='refType==1 and not useNNpredict',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Reuse model maps?',
+                      help="The model map generated by LocScale from the "
+                           "atomic model (and the refined model) is stored "
+                           "in the cache of the project. Later runs with the "
+                           "same model, sampling, box, resolution and model "
+                           "completion take it from the cache instead of "
+                           "generating it again. When the model is refined "
+                           "or completed, the input maps are also part of "
+                           "the key.")
+
+        form.addParam('useResultCache', params.BooleanParam, default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Reuse identical runs?',
+                      help="The sharpened map of every run is stored in the "
+                           "results folder of the cache (see "
+                           "LOCSCALE_CACHE_DIR and LOCSCALE_CACHE_SIZE), "
+                           "indexed by the content of its input maps, "
+                           "reference and mask, the parameters that affect "
+                           "the result (extra parameters included), the "
+                           "sampling and the LocScale version. A later run "
+                           "with the same inputs and parameters takes the "
+                           "stored map instead of running LocScale again. "
+                           "Runs sharpened by tiles are not stored.")
+
+        form.addParam('autoResources', params.BooleanParam, default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Plan processes automatically?',
+                      help="Choose the split of each LocScale run in MPI "
+                           "ranks (up to the MPI processes of the protocol) "
+                           "and threads per rank from the cores and "
+                           "available memory of the host, the box size and "
+                           "the size of the inputs, instead of sharing the "
+                           "threads. The fastest predicted split that fits "
+                           "in memory is used. The peak memory "
+                           "and time of the runs are predicted with a model "
+                           "calibrated with the past runs recorded in the "
+                           "cache folder (see LOCSCALE_CACHE_DIR). Runs that "
+                           "would not fit in the memory of this host are "
+                           "refused, unless submitted to a queue; without "
+                           "automatic planning they only get a warning.")
+
+        form.addParam('useBroker', params.BooleanParam, default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Share the host with other runs?',
+                      help="Before launching, every LocScale run reserves "
+                           "its processes and predicted peak memory from a "
+                           "broker shared by all the protocols (and users) "
+                           "of the host (see LOCSCALE_BROKER_DIR). Runs "
+                           "that do not fit next to the ones in progress "
+                           "wait in order of arrival, so concurrent jobs "
+                           "do not oversubscribe the node. Runs sharpened "
+                           "by tiles over MPI are not brokered.")
+
         form.addParallelSection(threads=3, mpi=1)
 
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
-        self.inputVolsFn = []
-        objId = self.getInputVol().getObjId()
-        self._insertFunctionStep(self.convertStep, objId)
-        self._insertFunctionStep(self.refineStep, objId)
-        self._insertFunctionStep(self.createOutputStep, objId)
-
-    # --------------------------- STEPS functions -----------------------------
-    def convertStep(self, objId):
-        tmpFn = self._getTmpPath()
-        vol = self.getInputVol()
-        if vol.hasHalfMaps():
-            for v in vol.getHalfMaps(asList=True):
-                self.inputVolsFn.append(self.convertBinaryVol(v, tmpFn))
-        else:
-            self.inputVolsFn.append(self.convertBinaryVol(vol, tmpFn))
+        self._volsDict = {vol.getObjId(): vol.clone()
+                          for vol in self._iterInputVols()}
+        sharedIds = self._insertSharedSteps()
+        refineIds = [self._insertVolumeSteps(objId, sharedIds)
+                     for objId in self._volsDict]
+        self._insertFunctionStep(self.createOutputStep,
+                                 prerequisites=refineIds, needsGPU=False)
 
+    def _insertSharedSteps(self):
+        """ Insert the steps preparing the inputs shared by all volumes.
+        Return their ids.
+        """
+        # Inputs are prepared in independent steps, so they can run
+        # concurrently; each refine step waits only for the inputs it uses
+        sharedIds = []
         if not self.useNNpredict:
-            if self.refType == REF_PDB:
-                pdbFn = self.refPdb.get().getFileName()
-                self.refPdbFn = self._getTmpPath(os.path.basename(pdbFn))
-                pwutils.createLink(pdbFn, self.refPdbFn)
-            elif self.refType == REF_VOL:
-                self.refVolFn = self.convertBinaryVol(self.refObj.get(), tmpFn)
+            # quick global sharpening does not use the reference
+            useRef = not self.useGlobalSharpening()
+            if useRef and self.refType == REF_PDB:
+                sharedIds.append(self._insertFunctionStep(
+                    self.linkPdbStep, prerequisites=[], needsGPU=False))
+            elif useRef and self.refType == REF_VOL:
+                sharedIds.append(self._insertFunctionStep(
+                    self.convertInputStep, 'refObj', prerequisites=[],
+                    needsGPU=False))
 
             if self.binaryMask.hasValue():
-                self.maskVolFn = self.convertBinaryVol(self.binaryMask.get(), tmpFn)
+                sharedIds.append(self._insertFunctionStep(
+                    self.convertInputStep, 'binaryMask', prerequisites=[],
+                    needsGPU=False))
+        return sharedIds
+
+    def _insertVolumeSteps(self, objId, prerequisites):
+        """ Insert the steps sharpening a volume once the prerequisites
+        are done. Return the id of the step writing its result.
+        """
+        convertIds = [self._insertFunctionStep(self.convertStep, objId, i,
+                                               prerequisites=[],
+                                               needsGPU=False)
+                      for i in range(len(self.getVolInputs(objId)))]
+        prerequisites = convertIds + prerequisites
+        # only EMmerNet uses the GPU, other steps must not wait for its slot
+        needsGPU = self.sharpeningNeedsGpu()
+        if self.useTiles and self.distributeTiles:
+            tilesId = self._insertFunctionStep(self.distributeTilesStep, objId,
+                                               prerequisites=prerequisites,
+                                               needsGPU=needsGPU)
+            return self._insertFunctionStep(self.stitchStep, objId,
+                                            prerequisites=[tilesId],
+                                            needsGPU=False)
+        elif self.useTiles:
+            tileIds = [self._insertFunctionStep(self.sharpenTileStep, objId, i,
+                                                prerequisites=prerequisites,
+                                                needsGPU=needsGPU)
+                       for i in range(len(self.getTileGrid(objId)))]
+            return self._insertFunctionStep(self.stitchStep, objId,
+                                            prerequisites=tileIds,
+                                            needsGPU=False)
+        else:
+            return self._insertFunctionStep(self.refineStep, objId,
+                                            prerequisites=prerequisites,
+                                            needsGPU=needsGPU)
+
+    # --------------------------- STEPS functions -----------------------------
+    def linkPdbStep(self):
+        """ Link the reference atomic model. """
+        pwutils.createLink(self.refPdb.get().getFileName(),
+                           self.getRefPdbFn())
+
+    def convertInputStep(self, paramName):
+        """ Convert an input shared by all maps (reference or mask). """
+        cache = self._getVolumeCache()
+        self.convertBinaryVol(getattr(self, paramName).get(),
+                              self._getTmpPath(), cache)
+        self._updateCacheStats(cache)
+
+    def convertStep(self, objId, index):
+        """ Convert the input map (or one of its half maps) of a volume. """
+        volTmpFn = self._getVolTmpPath(objId)
+        os.makedirs(volTmpFn, exist_ok=True)
+        cache = self._getVolumeCache()
+        self.convertBinaryVol(self.getVolInputs(objId)[index], volTmpFn, cache)
+        self._updateCacheStats(cache)
 
     def refineStep(self, objId):
-        """ Run the LocScale program. """
+        """ Run the LocScale program, unless an identical run is stored
+        in the results cache.
+        """
+        self.refineOrReuse(objId)
+
+    def refineOrReuse(self, objId):
+        """ Sharpen a volume, unless an identical run is stored in the
+        results cache. Return True if the stored result was used.
+        """
+        index = self._getResultIndex()
+        if index is not None:
+            fingerprint = self.getResultFingerprint(objId)
+            record = index.get(fingerprint, self.getOutputFn("extra", objId))
+            self._updateCacheStats(index, 'resultCacheHits',
+                                   'resultCacheMisses')
+            if record is not None:
+                self.info("Using the stored result of an identical run "
+                          "(%s, %s)" % (record['protocol'],
+                                        formatTime(record['wallTime'] or 0)))
+                return True
+
+        start = time.time()
+        self.refineVolume(objId)
+        if index is not None:
+            self.storeResult(index, fingerprint, objId, time.time() - start)
+        return False
+
+    def refineVolume(self, objId):
+        """ Sharpen a volume, in the scratch folder if requested. """
+        staged = self.getCachedModelInputs(objId, self.getStagedInputs(objId),
+                                           self._getVolTmpPath(objId))
+        if not self.useScratch:
+            self.refine(objId, staged)
+            return
+
+        # run in the scratch folder, the files to keep are copied back
+        # also on failure
+        scratchDir = self.getScratchPath('vol_%03d' % objId)
+        keepDir = self._getExtraPath('vol_%03d' % objId)
+        try:
+            self.refine(objId, self.stageToScratch(staged, scratchDir))
+        except Exception:
+            scratch.copyBack(scratchDir, keepDir, self.getScratchPatterns(),
+                             wait=True)
+            raise
+        scratch.copyBack(scratchDir, keepDir, self.getScratchPatterns())
+
+    def refine(self, objId, staged):
+        """ Sharpen the staged inputs of a volume (cropped if requested)
+        and write the result in the extra folder.
+        """
+        box = self.getCropBox(objId, staged)
+        useAsu = box is not None and self.useAsymmetricUnit()
+        if useAsu and self.asymmetricUnitCheck:
+            start = time.time()
+            fullMapFn = self.getResultFn(objId, staged).replace(
+                '.mrc', '_fullmap.mrc')
+            os.replace(self.sharpen(objId, staged), fullMapFn)
+            fullTime = time.time() - start
+
+        start = time.time()
+        if box is not None:
+            (z0, z1), (y0, y1), (x0, x1) = box
+            self.info("Cropping inputs to x: %d-%d, y: %d-%d, z: %d-%d"
+                      % (x0, x1, y0, y1, z0, z1))
+            workDir = staged['workDir']
+            if useAsu:
+                workDir = os.path.join(workDir, 'asymmetric_unit')
+                os.makedirs(workDir, exist_ok=True)
+            inputs = self.cropInputs(staged, box, workDir)
+            # the symmetry centre is not the centre of the asymmetric unit
+            inputs['asymmetricUnit'] = useAsu
+        else:
+            inputs = staged
+
+        fourierSize = self.getFourierCropBox(objId, inputs)
+        if fourierSize is not None:
+            outputFn = self.sharpenFourierCropped(objId, inputs, fourierSize)
+        else:
+            outputFn = self.sharpen(objId, inputs)
+        if not os.path.exists(outputFn):
+            return
+        # model maps generated at the Fourier cropped sampling are not reused
+        if box is None and fourierSize is None and inputs['ref'] is None:
+            self.storeModel(objId, inputs)
+        if useAsu:
+            _, direction = self.getAsymmetricUnitBox(objId, staged)
+            matrices = self.getSymmetryMatrices(objId)
+            expandAsymmetricUnit(outputFn, self.getOutputFn("extra", objId),
+                                 staged['emmaps'][0], box, matrices, direction)
+            report = {'group': self.getVolumeParams(objId)['symmetryGroup'],
+                      'operators': len(matrices),
+                      'box': [readMrcHeader(staged['emmaps'][0])['dims'][0],
+                              box[0][1] - box[0][0]],
+                      'time': time.time() - start}
+            if self.asymmetricUnitCheck:
+                error, corr = getSymmetryError(
+                    self.getOutputFn("extra", objId), fullMapFn,
+                    mask=self.readMask(staged['mask']))
+                report.update(fullTime=fullTime,
+                              speedup=fullTime / report['time'],
+                              error=error, correlation=corr)
+                self.info("Asymmetric unit run %0.1fx faster than the full "
+                          "map, symmetry consistency error %0.4f "
+                          "(correlation %0.4f)"
+                          % (report['speedup'], error, corr))
+            with open(self.getSymmetryReportFn(staged), 'w') as f:
+                json.dump(report, f, indent=2)
+        elif box is not None:
+            pasteVolume(outputFn, self.getOutputFn("extra", objId),
+                        staged['emmaps'][0], box)
+        else:
+            pwutils.moveFile(outputFn, self.getOutputFn("extra", objId))
+        self.compactOutput(objId)
+
+    def sharpenTileStep(self, objId, tileIndex):
+        """ Sharpen a single tile of a volume. """
+        tileDir = self._getTileTmpPath(objId, tileIndex)
+        os.makedirs(tileDir, exist_ok=True)
+        staged = self.getCachedModelInputs(objId, self.getStagedInputs(objId),
+                                           tileDir)
+        box = self.getTileGrid(objId).boxes[tileIndex]
+        self.sharpen(objId, self.cropInputs(staged, box, tileDir))
+
+    def distributeTilesStep(self, objId):
+        """ Sharpen all the tiles of a volume as work units spread over
+        the MPI ranks of the host configuration.
+        """
+        staged = self.getCachedModelInputs(objId, self.getStagedInputs(objId),
+                                           self._getVolTmpPath(objId))
+        units = []
+        for i, box in enumerate(self.getTileGrid(objId).boxes):
+            tileDir = self._getTileTmpPath(objId, i)
+            os.makedirs(tileDir, exist_ok=True)
+            inputs = self.cropInputs(staged, box, tileDir)
+            units.append({'command': self.getSharpenCommand(objId, inputs),
+                          'cwd': os.path.abspath(tileDir)})
+
+        planFn = os.path.abspath(self._getVolTmpPath(objId, 'tiles_plan.json'))
+        writePlan(planFn, units)
+        mpiCmd = self.hostConfig.mpiCommand.get() % {
+            'JOB_NODES': self.numberOfMpi,
+            'COMMAND': f"{sys.executable} {distribute.__file__} {planFn}"}
+        self.runJob(mpiCmd, '', env=Plugin.getEnviron(useCcp4=self.checkCcp4()),
+                    numberOfThreads=1, numberOfMpi=1)
+
+        failed = getFailedUnits(planFn)
+        if failed:
+            raise Exception("Sharpening failed for tiles %s, see unit.log "
+                            "in their folders: %s"
+                            % (failed, self._getTileTmpPath(objId, failed[0])))
+
+    def stitchStep(self, objId):
+        """ Stitch the sharpened tiles of a volume. """
+        grid = self.getTileGrid(objId)
+        staged = self.getStagedInputs(objId)
+        tileFns = [self.getResultFn(objId, dict(staged,
+                                                workDir=self._getTileTmpPath(objId, i)))
+                   for i in range(len(grid))]
+        stitchTiles(grid, tileFns, self.getOutputFn("extra", objId),
+                    staged['emmaps'][0])
+        self.compactOutput(objId)
+
+    def compactOutput(self, objId):
+        """ Store the output of a volume as float16 (MRC mode 12) if
+        requested, unless its values exceed the float16 range or the image
+        library of Scipion cannot read float16 maps.
+        """
+        if not self.outputFloat16:
+            return
+        if not canReadFloat16(self._getTmpPath()):
+            self.warning("The image library of Scipion cannot read float16 "
+                         "maps, the output is kept as float32.")
+            return
+        outputFn = self.getOutputFn("extra", objId)
+        try:
+            normalizeVolume(outputFn, outputFn, mode=MRC_FLOAT16)
+        except ValueError as e:
+            self.warning("%s, the output is kept as float32." % e)
+
+    def sharpen(self, objId, inputs):
+        """ Sharpen the inputs with the selected engine.
+        Return the file name of the result.
+        """
+        if self.useGlobalSharpening():
+            # a quick run of a few seconds, not brokered
+            self.runGlobalSharpening(objId, inputs)
+            return self.getResultFn(objId, inputs)
+
+        with self.reserveResources(inputs) as grant:
+            if self.useNumpyEngine():
+                self.runNumpyEngine(objId, inputs)
+            else:
+                self.runLocscale(objId, inputs, grant)
+        return self.getResultFn(objId, inputs)
+
+    @contextmanager
+    def reserveResources(self, inputs):
+        """ Hold the processes and predicted peak memory of the run of the
+        inputs in the host broker, waiting for them if needed, and yield
+        the grant (None without broker).
+        """
+        if not self.useBroker:
+            yield None
+            return
+
+        voxels, inputBytes = self.getRunSize(inputs['emmaps'])
+        ranks = self.getLocscaleRanks(inputs)
+        threads = self.getLocscaleThreads(inputs)
+        processes = ranks * threads
+        memory = self.getResourcePlanner().predictMemory(voxels, threads,
+                                                         inputBytes, ranks)
+        label = '%s: %s (%s)' % (self.getProject().getShortName(),
+                                 self.getObjLabel() or self.getClassName(),
+                                 os.path.basename(inputs['workDir']))
+        broker = ResourceBroker(Plugin.getBrokerPath())
+        with broker.request(processes, memory, label) as grant:
+            waitTime = grant.waitTime
+            if waitTime >= 1:
+                self.info("Waited %s for %d cores and %s of memory"
+                          % (formatTime(waitTime), processes,
+                             formatBytes(memory)))
+                with self._lock:
+                    self.brokerWaits.set(self.brokerWaits.get() + 1)
+                    self.brokerWaitTime.set(self.brokerWaitTime.get()
+                                            + waitTime)
+                    self._store(self.brokerWaits, self.brokerWaitTime)
+            yield grant
+
+    def sharpenFourierCropped(self, objId, inputs, size):
+        """ Sharpen the inputs Fourier cropped to a box of size, and pad the
+        result back to the box of the inputs. The full box is also
+        sharpened if it is compared. Return the file name of the result.
+        """
+        outputFn = self.getResultFn(objId, inputs)
+        fullSize = readMrcHeader(inputs['emmaps'][0])['dims'][0]
+        apix = self.getInputsSampling(inputs)
+        resol = self.getVolumeParams(objId)['resol']
+        report = {'box': [fullSize, size],
+                  'sampling': [apix, apix * fullSize / size],
+                  'resolution': resol}
+
+        if self.fourierCropCheck:
+            start = time.time()
+            fullBoxFn = outputFn.replace('.mrc', '_fullbox.mrc')
+            os.replace(self.sharpen(objId, inputs), fullBoxFn)
+            report['fullTime'] = time.time() - start
+
+        workDir = os.path.join(inputs['workDir'], 'fourier_crop')
+        os.makedirs(workDir, exist_ok=True)
+        self.info("Fourier cropping inputs from %d to %d px (%0.2f A/px)"
+                  % (fullSize, size, report['sampling'][1]))
+        start = time.time()
+        cropped = self.fourierCropInputs(inputs, size, workDir)
+        croppedFn = self.sharpen(objId, cropped)
+        if not os.path.exists(croppedFn):
+            return outputFn
+        fourierResizeVolume(croppedFn, outputFn, fullSize)
+        report['time'] = time.time() - start
+
+        if self.fourierCropCheck:
+            freqs, fsc = getFsc(outputFn, fullBoxFn)
+            shells = freqs <= 1. / resol
+            report.update(speedup=report['fullTime'] / report['time'],
+                          fscAtResolution=float(
+                              np.interp(1. / resol, freqs, fsc)),
+                          fscMin=float(fsc[shells].min()),
+                          fsc=[[float(f), float(c)]
+                               for f, c in zip(freqs, fsc)])
+            self.info("Fourier cropped run %0.1fx faster than the full box, "
+                      "FSC %0.3f at %s A"
+                      % (report['speedup'], report['fscAtResolution'],
+                         resol))
+
+        with open(self.getFourierReportFn(inputs), 'w') as f:
+            json.dump(report, f, indent=2)
+        return outputFn
+
+    def runLocscale(self, objId, inputs, grant=None):
+        """ Run the LocScale program on the staged inputs. The job is
+        attached to the broker grant, if given, so the resources are held
+        as long as it runs.
+        """
+        onStart = grant.attach if grant is not None else None
+        useMpi = self.getLocscaleRanks(inputs) > 1
+        if self.useWorker and not (useMpi or self.useProfiler):
+            self.runWithWorker(objId, inputs, onStart)
+            return
+
+        profileFn = self.getProfileFn(inputs) if self.useProfiler else None
+        prefix, env = Plugin.getLauncher(useCcp4=self.checkCcp4())
+        cmd, args = self.getLocscaleCommand(objId, inputs, profileFn, prefix)
+        # the output is copied to a file the monitor follows, and pipefail
+        # keeps the exit code of LocScale for the step
+        outputFn = self.getOutputLogFn(inputs)
+        pwutils.cleanPath(outputFn)
+        monitor = JobMonitor(self.getStatsFn(inputs), profile=self.useProfiler,
+                             stacksFn=self.getStacksFn(inputs)
+                             if self.useProfiler else None)
+        monitor.start(cwd=inputs['workDir'], outputFn=outputFn,
+                      onAttach=onStart)
+        try:
+            self.runJob(f"set -o pipefail && {cmd}",
+                        f"{args} 2>&1 | tee {os.path.abspath(outputFn)}",
+                        cwd=inputs['workDir'], env=env, numberOfThreads=1,
+                        numberOfMpi=1, executable='/bin/bash')
+        finally:
+            monitor.stop()
+        self.recordResources(inputs)
+
+    def runWithWorker(self, objId, inputs, onStart=None):
+        """ Run the job in the persistent LocScale worker. onStart is
+        called with the pid of the job. """
+        program, args = self.getLocscaleArgs(objId, inputs)
+        argv = ([program] if program else []) + shlex.split(args)
+        socketFn = Plugin.startWorker()
+        self.info("Running in LocScale worker %s: locscale %s"
+                  % (socketFn, ' '.join(argv)))
+        monitor = JobMonitor(self.getStatsFn(inputs))
+        monitor.start()
+        try:
+            code = worker.runJob(socketFn, argv,
+                                 os.path.abspath(inputs['workDir']),
+                                 Plugin.getWorkerJobEnviron(self.checkCcp4()),
+                                 output=monitor, onStart=onStart)
+        finally:
+            monitor.stop()
+        if code != 0:
+            raise Exception("LocScale failed in the worker with exit code %d"
+                            % code)
+        self.recordResources(inputs)
+
+    def getLocscaleArgs(self, objId, inputs):
+        """ Return the LocScale program and its arguments. """
         if self.isOldVersion():
             program = "run_emmernet" if self.useNNpredict else "run_locscale"
         else:
             program = "feature_enhance" if self.useNNpredict else ""
 
-        args = self.prepareParams()
+        args = self.prepareParams(objId, inputs)
         if self.extraParams.hasValue():
             args += ' ' + self.extraParams.get()
+        return program, args
+
+    def getLocscaleCommand(self, objId, inputs, profileFn=None, prefix=None):
+        """ Return the LocScale command and arguments for the inputs,
+        running under cProfile if profileFn is given (except with MPI).
+        prefix is the one of Plugin.getLauncher, by default the shell
+        activation of the environment.
+        """
+        program, args = self.getLocscaleArgs(objId, inputs)
+        if prefix is None:
+            prefix = f"{Plugin.getActivationCmd()} && "
 
-        if self.numberOfMpi > 1:
+        ranks = self.getLocscaleRanks(inputs)
+        if ranks > 1:
             # insert "mpirun -np X" after conda activation cmd
             mpiCmd = self.hostConfig.mpiCommand.get() % {
-                'JOB_NODES': self.numberOfMpi,
+                'JOB_NODES': ranks,
                 'COMMAND': f"locscale {program}"}
-            cmd = f"{Plugin.getActivationCmd()} && {mpiCmd}"
+            cmd = f"{prefix}{mpiCmd}"
+        elif profileFn:
+            cmd = Plugin.getProfiledProgram(program, os.path.abspath(profileFn),
+                                            prefix)
         else:
-            cmd = Plugin.getProgram(program)
+            cmd = Plugin.getProgram(program, prefix)
 
-        env = Plugin.getEnviron(useCcp4=self.checkCcp4())
-        self.runJob(cmd, args, cwd=self._getTmpPath(),
-                    env=env, numberOfThreads=1, numberOfMpi=1)
+        return cmd, args
 
-        # Move the resulting volume
-        if self.useNNpredict and not self.isOldVersion():
-            outputFn = self.getOutputFn("tmp").replace(".mrc",
-                                                       "_locscale_output.mrc")
-        else:
-            outputFn = self.getOutputFn("tmp")
+    def getSharpenCommand(self, objId, inputs):
+        """ Return a shell command that sharpens the inputs out of this
+        process, with the selected engine. The command runs in the working
+        directory of the inputs, so it only has absolute paths.
+        """
+        if not self.useNumpyEngine():
+            return ' '.join(self.getLocscaleCommand(objId, inputs))
 
-        if os.path.exists(outputFn):
-            pwutils.moveFile(outputFn, self.getOutputFn("extra"))
+        emmaps = ' '.join(os.path.abspath(fn) for fn in inputs['emmaps'])
+        args = [f"--emmaps {emmaps}",
+                f"--ref {os.path.abspath(inputs['ref'])}",
+                f"--output {os.path.abspath(self.getResultFn(objId, inputs))}",
+                f"--apix {self.getSampling()}",
+                f"--processes {self.getLocscaleThreads()}",
+                f"--memory {self.engineMemory.get()}"]
+        if inputs['mask']:
+            args.append(f"--mask {os.path.abspath(inputs['mask'])}")
+        if self.windowSize.get():
+            args.append(f"--window_size {self.windowSize.get()}")
+        # the environment for LocScale does not keep PYTHONPATH
+        pluginPath = os.path.dirname(os.path.dirname(distribute.__file__))
+        return (f"PYTHONPATH={pluginPath} {sys.executable} -m locscale.engine "
+                f"{' '.join(args)}")
 
-    def createOutputStep(self, objId):
-        """ Create the output volume. """
-        outputVolume = Volume()
-        outputVolume.setSamplingRate(self.getSampling())
-        outputVolume.setFileName(self.getOutputFn("extra"))
-        self._defineOutputs(**{outputs.Volume.name: outputVolume})
-        self._defineTransformRelation(self.getInputVol(pointer=True),
-                                      outputVolume)
+    def runGlobalSharpening(self, objId, inputs):
+        """ Sharpen the inputs in-process with a global B-factor. """
+        report = globalSharpen(inputs['emmaps'],
+                               self.getResultFn(objId, inputs),
+                               self.getInputsSampling(inputs),
+                               self.getVolumeParams(objId)['resol'],
+                               maskFn=inputs['mask'],
+                               bfactor=self.globalBfactor.get() or None,
+                               lowResolution=self.guinierLowRes.get(),
+                               workers=self.getLocscaleThreads())
+        self.info("Global B-factor %0.1f A^2 (fitted %0.1f A^2 from %s to "
+                  "%s A), sharpened in %s"
+                  % (report['bfactor'], report['fittedBfactor'],
+                     report['fitRange'][0], report['fitRange'][1],
+                     formatTime(report['time'])))
+        with open(self.getGlobalReportFn(inputs), 'w') as f:
+            json.dump(report, f, indent=2)
+
+    def runNumpyEngine(self, objId, inputs):
+        """ Run the local amplitude scaling in-process. """
+        runLocalScaling(inputs['emmaps'], inputs['ref'],
+                        self.getResultFn(objId, inputs),
+                        self.getInputsSampling(inputs),
+                        maskFn=inputs['mask'], windowSize=self.windowSize.get(),
+                        numberOfProcs=self.getLocscaleThreads(),
+                        memory=self.engineMemory.get())
+
+    @staticmethod
+    def cropInputs(inputs, box, workDir):
+        """ Crop the inputs to box, writing them in workDir.
+        Return the cropped inputs.
+        """
+        def _crop(fn, prefix):
+            cropFn = os.path.join(workDir, prefix + os.path.basename(fn))
+            cropVolume(fn, cropFn, box)
+            return cropFn
+
+        return {'emmaps': [_crop(fn, 'crop_') for fn in inputs['emmaps']],
+                'ref': _crop(inputs['ref'], 'crop_ref_') if inputs['ref'] else None,
+                'mask': _crop(inputs['mask'], 'crop_mask_') if inputs['mask'] else None,
+                'workDir': workDir}
+
+    def fourierCropInputs(self, inputs, size, workDir):
+        """ Fourier crop the inputs to a box of size, writing them in
+        workDir. Return the cropped inputs, with their sampling.
+        """
+        def _crop(fn, prefix, binary=False):
+            cropFn = os.path.join(workDir, prefix + os.path.basename(fn))
+            fourierResizeVolume(fn, cropFn, size, binary=binary)
+            return cropFn
+
+        fullSize = readMrcHeader(inputs['emmaps'][0])['dims'][0]
+        apix = self.getInputsSampling(inputs) * fullSize / size
+        return {'emmaps': [_crop(fn, 'fcrop_') for fn in inputs['emmaps']],
+                'ref': _crop(inputs['ref'], 'fcrop_ref_') if inputs['ref'] else None,
+                'mask': (_crop(inputs['mask'], 'fcrop_mask_', binary=True)
+                         if inputs['mask'] else None),
+                'workDir': workDir, 'apix': apix}
+
+    def stageToScratch(self, inputs, scratchDir):
+        """ Copy the inputs to an empty scratch folder.
+        Return the staged inputs.
+        """
+        self.info("Staging inputs in scratch folder %s" % scratchDir)
+        scratch.createDir(scratchDir)
+        staged = dict(inputs, workDir=scratchDir,
+                      emmaps=scratch.stageFiles(inputs['emmaps'], scratchDir))
+        for key in ['ref', 'mask']:
+            if inputs[key]:
+                staged[key] = scratch.stageFiles([inputs[key]], scratchDir)[0]
+        return staged
+
+    def createOutputStep(self):
+        """ Create the output volume (or set of volumes in batch mode). """
+        scratch.waitCopies(self._getExtraPath())
+        if self.isBatchMode():
+            outputVols = self._createSetOfVolumes()
+            outputVols.setSamplingRate(self.getSampling())
+            for objId in self._volsDict:
+                outputVols.append(self._createOutputVol(objId))
+            self._defineOutputs(**{outputs.Volumes.name: outputVols})
+            self._defineTransformRelation(self.getInputVol(pointer=True),
+                                          outputVols)
+        else:
+            objId = self.getInputVol().getObjId()
+            outputVolume = self._createOutputVol(objId)
+            self._defineOutputs(**{outputs.Volume.name: outputVolume})
+            self._defineTransformRelation(self.getInputVol(pointer=True),
+                                          outputVolume)
 
     # --------------------------- INFO functions ------------------------------
     def _warnings(self):
         warnings = []
 
-        if not self.useNNpredict and not self.checkCcp4():
+        if (not self.useNNpredict and not self.useNumpyEngine()
+                and not self.useGlobalSharpening() and not self.checkCcp4()):
             warnings.append("CCP4 plugin is not installed. "
                             "Refmac5 refinement will be skipped.")
+        if self.useProfiler and self.useLocscaleMpi():
+            warnings.append("LocScale is not run under cProfile with MPI, "
+                            "only its programs are sampled.")
+        if not self.autoResources:
+            memoryWarning = self._checkMemory()
+            if memoryWarning:
+                warnings.append(memoryWarning)
 
         return warnings
 
@@ -220,14 +1103,17 @@ class ProtLocScale(ProtFilterVolumes):
         """ We validate if inputs make sense. """
         errors = []
 
-        if self.useNNpredict and not self.getInputVol().hasHalfMaps():
+        if self.useNNpredict and not all(vol.hasHalfMaps()
+                                         for vol in self._iterInputVols()):
             errors.append("EMmerNet predictions require two halfmaps "
-                          "associated with an input volume.")
+                          "associated with each input volume.")
 
+        # an open set in streaming has no dimensions until its first item
+        # arrives, the checks of the size are skipped until then
         inputSize = self.getInputVol().getDim()
         reference = self.refObj.get()
 
-        if reference is not None:
+        if reference is not None and inputSize is not None:
             refSize = reference.getDim()
             refSamp = reference.getSamplingRate()
 
@@ -235,39 +1121,288 @@ class ProtLocScale(ProtFilterVolumes):
                 errors.append('Input map and reference volume should have '
                               'the same size and sampling rate')
 
-        if (self.binaryMask.hasValue() and
+        if (self.binaryMask.hasValue() and inputSize is not None and
                 self.binaryMask.get().getDim() != inputSize):
             errors.append('Input map and binary mask should be '
                           'of the same size')
 
-        if self.refType == REF_NONE and not self.checkCcp4():
+        if self.cropMode == CROP_MASK and (self.useNNpredict or
+                                           not self.binaryMask.hasValue()):
+            errors.append('Cropping to the mask bounding box requires '
+                          'a 3D mask.')
+
+        if self.useTiles and self.distributeTiles and self.numberOfMpi < 2:
+            errors.append('Distributing tiles requires more than one MPI.')
+
+        if self.useTiles and self.cropMode != CROP_NONE:
+            errors.append('Cropping and tiles cannot be used together.')
+
+        if self.useTiles and self.tileOverlap.get() <= self.getWindowSize():
+            errors.append('The tile overlap should be larger than the '
+                          'LocScale window (%d px), half of it is dropped '
+                          'at each tile edge.' % self.getWindowSize())
+
+        if self.useAsymmetricUnit():
+            try:
+                if len(self.getSymmetryMatrices()) == 1:
+                    errors.append('Sharpening the asymmetric unit requires '
+                                  'a symmetry group other than c1.')
+            except ValueError as e:
+                errors.append('%s. Use Cn, Dn, T, O or I.' % e)
+            if self.useTiles or self.cropMode != CROP_NONE:
+                errors.append('Sharpening the asymmetric unit cannot be '
+                              'combined with tiles or cropping.')
+            elif inputSize is not None and len(set(inputSize)) > 1:
+                errors.append('Sharpening the asymmetric unit requires '
+                              'cubic maps.')
+
+        if self.fourierCrop and not self.useNNpredict:
+            if self.useTiles:
+                errors.append('Fourier cropping and tiles cannot be used '
+                              'together.')
+            elif (self.cropMode == CROP_NONE and inputSize is not None
+                  and len(set(inputSize)) > 1):
+                errors.append('Fourier cropping requires cubic maps.')
+
+        if self.cropMode == CROP_REGION:
+            try:
+                x0, y0, z0, x1, y1, z1 = self.getCropRegion()
+                if not (0 <= x0 < x1 and 0 <= y0 < y1 and 0 <= z0 < z1):
+                    raise ValueError
+            except ValueError:
+                errors.append('Crop region should be six voxel coordinates: '
+                              'x0 y0 z0 x1 y1 z1.')
+
+        if self.useGlobalSharpening() and (self.useTiles or self.fourierCrop
+                                           or self.useAsymmetricUnit()):
+            errors.append('Quick global sharpening cannot be combined with '
+                          'tiles, Fourier cropping or the asymmetric unit.')
+
+        if self.useGlobalSharpening():
+            resol, lowRes = self.resol.get(), self.guinierLowRes.get()
+            if resol >= lowRes:
+                errors.append('The resolution (%g A) should be higher than '
+                              'the low resolution limit of the Guinier fit '
+                              '(%g A).' % (resol, lowRes))
+            elif inputSize is not None:
+                # shells k / (n apix) of the Guinier fit, it needs three
+                extent = max(inputSize) * self.getSampling()
+                nShells = int(extent / resol) - math.ceil(extent / lowRes) + 1
+                if nShells < 3:
+                    errors.append('The Guinier fit from %g to %g A has %d '
+                                  'shells of the box, it needs at least 3. '
+                                  'Increase the low resolution limit.'
+                                  % (lowRes, resol, max(nShells, 0)))
+
+        if (self.refType == REF_NONE and not self.useGlobalSharpening()
+                and not self.checkCcp4()):
             errors.append("Reference type = None requires REFMAC5 refinement. "
                           "CCP4 plugin was not found.")
 
+        # the resources planned automatically must fit in the host, the
+        # ones set by hand only get a warning
+        if not errors and self.autoResources:
+            memoryError = self._checkMemory()
+            if memoryError:
+                errors.append(memoryError)
+
         return errors
 
+    def _checkMemory(self):
+        """ Return a message if the predicted peak memory of the runs does
+        not fit in the available memory of this host. Cropped runs are
+        smaller than the input box, and runs submitted to a queue use the
+        memory of another host, so they are not checked.
+        """
+        if (self.useQueue() or self.useNNpredict or self.useNumpyEngine()
+                or self.useGlobalSharpening() or self.cropMode != CROP_NONE):
+            return
+        inputVol = self.getInputVol()
+        vol = inputVol.getFirstItem() if self.isBatchMode() else inputVol
+        if vol is None:
+            return None
+        inputFns = (vol.getHalfMaps(asList=True) if vol.hasHalfMaps()
+                    else [vol.getFileName()])
+        if not all(os.path.exists(fn) for fn in inputFns):
+            return None
+
+        shape = vol.getDim()[::-1]
+        nTasks = inputVol.getSize() if self.isBatchMode() else 1
+        voxels = shape[0] * shape[1] * shape[2]
+        inputBytes = sum(os.path.getsize(fn) for fn in inputFns)
+        if self.useTiles:
+            grid = self._getShapeTileGrid(shape)
+            nTasks *= len(grid)
+            voxels = max((z1 - z0) * (y1 - y0) * (x1 - x0)
+                         for (z0, z1), (y0, y1), (x0, x1) in grid.boxes)
+            inputBytes = inputBytes * voxels // (shape[0] * shape[1] * shape[2])
+        nConcurrent = (1 if self.useTiles and self.distributeTiles
+                       else self.getConcurrentRuns(nTasks))
+
+        planner = self.getResourcePlanner()
+        maxRanks = self.numberOfMpi.get() if self.useLocscaleMpi() else 1
+        if self.autoResources:
+            plan = planner.plan(voxels, inputBytes, nConcurrent,
+                                maxRanks=maxRanks)
+        else:
+            plan = maxRanks, max(1, self.numberOfThreads.get() // nConcurrent)
+        ranks, threads = plan or (1, 1)
+        memory = nConcurrent * planner.predictMemory(voxels, threads,
+                                                     inputBytes, ranks)
+        available = getHostResources()[1]
+        if plan is None or memory > available:
+            return ("The predicted peak memory of %d concurrent LocScale "
+                    "runs (%s) is larger than the available memory (%s). "
+                    "Process the map in tiles, crop it or use fewer "
+                    "threads, MPI or volumes at once."
+                    % (nConcurrent, formatBytes(memory),
+                       formatBytes(available)))
+        return None
+
     def _summary(self):
         summary = []
-        if not hasattr(self, outputs.Volume.name):
-            summary.append("Output volume not ready yet.")
-        else:
+        if hasattr(self, outputs.Volumes.name):
+            summary.append('We obtained %d locally sharpened volumes from the %s'
+                           % (getattr(self, outputs.Volumes.name).getSize(),
+                              self.getObjectTag('inputVolume')))
+        elif hasattr(self, outputs.Volume.name):
             summary.append('We obtained a locally sharpened volume from the %s'
                            % self.getObjectTag('inputVolume'))
+        else:
+            summary.append("Output volume not ready yet.")
+
+        summary.extend(self._summaryStats())
+        summary.extend(self._summaryGlobal())
+        summary.extend(self._summaryFourierCrop())
+        summary.extend(self._summarySymmetry())
+        summary.extend(self._summaryProfile())
+
+        if self.cacheHits > 0 or self.cacheMisses > 0:
+            summary.append("Converted volumes cache: %d hits, %d misses."
+                           % (self.cacheHits, self.cacheMisses))
+        if self.modelCacheHits > 0 or self.modelCacheMisses > 0:
+            summary.append("Model maps cache: %d hits, %d misses."
+                           % (self.modelCacheHits, self.modelCacheMisses))
+        if self.resultCacheHits > 0:
+            summary.append("Results of identical runs reused for %d of %d "
+                           "volumes." % (self.resultCacheHits.get(),
+                                         self.resultCacheHits.get()
+                                         + self.resultCacheMisses.get()))
+        if self.brokerWaits > 0:
+            summary.append("%d runs waited %s in total for host cores and "
+                           "memory." % (self.brokerWaits.get(),
+                                        formatTime(self.brokerWaitTime.get())))
         return summary
 
+    def _summaryGlobal(self):
+        """ Return the B-factor lines of the quick global runs. """
+        lines = []
+        for reportFn in sorted(glob(self._getExtraPath('global_*.json'))):
+            with open(reportFn) as f:
+                report = json.load(f)
+            line = ('Global sharpening %s: B-factor %0.1f A^2 (fitted from '
+                    '%s to %s A), sharpened in %s'
+                    % (os.path.basename(reportFn)[7:-5], report['bfactor'],
+                       report['fitRange'][0], report['fitRange'][1],
+                       formatTime(report['time'])))
+            if report.get('fscResolution'):
+                line += (', half maps FSC 0.143 at %0.2f A'
+                         % report['fscResolution'])
+            lines.append(line)
+        return lines
+
+    def _summaryFourierCrop(self):
+        """ Return the speedup and FSC lines of the Fourier cropped runs. """
+        lines = []
+        for reportFn in sorted(glob(self._getExtraPath('fourier_crop_*.json'))):
+            with open(reportFn) as f:
+                report = json.load(f)
+            (fullBox, box), (_, apix) = report['box'], report['sampling']
+            line = ('Fourier crop %s: %d to %d px (%0.2f A/px), sharpened in %s'
+                    % (os.path.basename(reportFn)[13:-5], fullBox, box, apix,
+                       formatTime(report['time'])))
+            if 'speedup' in report:
+                line += (' (%0.1fx faster than the full box), FSC with the '
+                         'full box %0.3f at %s A, minimum %0.3f'
+                         % (report['speedup'], report['fscAtResolution'],
+                            report.get('resolution', self.resol.get()),
+                            report['fscMin']))
+            lines.append(line)
+        return lines
+
+    def _summarySymmetry(self):
+        """ Return the speedup and error lines of the asymmetric unit runs. """
+        lines = []
+        for reportFn in sorted(glob(self._getExtraPath('symmetry_*.json'))):
+            with open(reportFn) as f:
+                report = json.load(f)
+            line = ('Asymmetric unit %s: %s (%d operators), %d to %d px, '
+                    'sharpened in %s'
+                    % (os.path.basename(reportFn)[9:-5], report['group'],
+                       report['operators'], report['box'][0],
+                       report['box'][1], formatTime(report['time'])))
+            if 'speedup' in report:
+                line += (' (%0.1fx faster than the full map), symmetry '
+                         'consistency error %0.4f, correlation %0.4f'
+                         % (report['speedup'], report['error'],
+                            report['correlation']))
+            lines.append(line)
+        return lines
+
+    def _summaryProfile(self):
+        """ Return the hot functions and programs of the profiled runs. """
+        lines = []
+        for statsFn in sorted(glob(self._getExtraPath('stats_*.json'))):
+            name = os.path.basename(statsFn)[6:-5]
+            stats = readStats(statsFn)
+            if stats and not stats['running'] and 'programs' in stats:
+                lines.append('Programs of %s:' % name)
+                lines.extend(formatPrograms(stats))
+            profileFn = self.getProfileFn(name=name)
+            if os.path.exists(profileFn):
+                lines.append('Hot functions of %s:' % name)
+                try:
+                    lines.extend(formatProfile(profileFn,
+                                               self.profileTop.get()))
+                except Exception as e:
+                    lines.append('   Cannot read %s: %s' % (profileFn, e))
+        return lines
+
+    def _summaryStats(self):
+        """ Return the timing and memory lines of the LocScale runs. """
+        lines, finished = [], []
+        for statsFn in sorted(glob(self._getExtraPath('stats_*.json'))):
+            stats = readStats(statsFn)
+            if stats is None:
+                continue
+            if stats['running']:
+                name = os.path.basename(statsFn)[6:-5]
+                lines.append('%s: %s' % (name, formatStats(stats)[0]))
+            else:
+                finished.append(stats)
+
+        if finished:
+            lines.append('LocScale runs (%d):' % len(finished))
+            lines.extend(formatStats(mergeStats(finished)))
+        return lines
+
     # --------------------------- UTILS functions -----------------------------
-    def prepareParams(self):
-        args = [f"--outfile {os.path.basename(self.getOutputFn('tmp'))}",
+    def prepareParams(self, objId, inputs=None):
+        inputs = inputs or self.getStagedInputs(objId)
+        volParams = self.getVolumeParams(objId)
+        args = [f"--outfile {os.path.basename(self.getOutputFn('tmp', objId))}",
                 "--verbose"]
 
-        inputVols = ' '.join(self.inputVolsFn)
-        if len(self.inputVolsFn) > 1:
+        # input maps are in the working directory of the run
+        inputVolsFn = [os.path.basename(fn) for fn in inputs['emmaps']]
+        inputVols = ' '.join(inputVolsFn)
+        if len(inputVolsFn) > 1:
             args.append(f"--halfmap_paths {inputVols}")
         else:
             args.append(f"--emmap_path {inputVols}")
 
         if self.useNNpredict:
-            model = self.getEnumText('emmernetModel')
+            model = self.getEmmernetModels()[volParams['emmernetModel']]
             args.append(f"--gpu_ids {' '.join(str(i) for i in self.getGpuList())}")
             if self.isOldVersion():
                 args.append(f"-trained_model {model}")
@@ -275,68 +1410,609 @@ class ProtLocScale(ProtFilterVolumes):
                 args.append("--use_low_context_model")
 
         else:
-            args.extend([f"--apix {self.getSampling()}",
-                         f"--ref_resolution {self.resol.get()}"])
+            args.extend([f"--apix {self.getInputsSampling(inputs)}",
+                         f"--ref_resolution {volParams['resol']}"])
 
-            if self.refType == REF_VOL:
-                args.append(f"--model_map {self.refVolFn}")
+            # the reference map is also set for cached model maps; cropped
+            # references and masks are relative to the project folder
+            if inputs['ref']:
+                args.append(f"--model_map {os.path.abspath(inputs['ref'])}")
             elif self.refType == REF_PDB:
-                args.append(f"--model_coordinates {os.path.basename(self.refPdbFn)}")
+                args.append(f"--model_coordinates {os.path.abspath(self.getRefPdbFn())}")
                 if self.incompletePdb:
                     args.append("--complete_model")
 
-            if self.binaryMask.hasValue():
-                args.append(f"--mask {self.maskVolFn}")
+            if inputs['mask']:
+                args.append(f"--mask {os.path.abspath(inputs['mask'])}")
 
-            if self.symmetryGroup.get() != "c1":
-                args.append(f"--symmetry {self.symmetryGroup.get().upper()}")
+            if (volParams['symmetryGroup'] != "c1"
+                    and not inputs.get('asymmetricUnit')):
+                args.append(f"--symmetry {volParams['symmetryGroup'].upper()}")
 
-            if self.numberOfMpi > 1:
+            if self.getLocscaleRanks(inputs) > 1:
                 args.append("--mpi")
 
-            if self.numberOfThreads > 1:
-                args.append(f"--number_processes {self.numberOfThreads.get()}")
+            nProcs = self.getLocscaleThreads(inputs)
+            if nProcs > 1:
+                args.append(f"--number_processes {nProcs}")
 
             if not self.checkCcp4():
                 args.append("--skip_refine")
 
         return " ".join(args)
 
+    def isBatchMode(self):
+        """ Return True if the input is a set of volumes. """
+        return isinstance(self.getInputVol(), SetOfVolumes)
+
     def getInputVol(self, pointer=False):
         return self.inputVolume if pointer else self.inputVolume.get()
 
+    def _iterInputVols(self):
+        """ Iterate over the input volume(s). """
+        if self.isBatchMode():
+            for vol in self.getInputVol().iterItems():
+                yield vol
+        else:
+            yield self.getInputVol()
+
+    def getVolInputs(self, objId):
+        """ Return the half maps of a volume, or the volume itself
+        if it has no half maps associated. """
+        vol = self._volsDict[objId]
+        if vol.hasHalfMaps():
+            return vol.getHalfMaps(asList=True)
+        return [vol]
+
+    def getLocscaleThreads(self, inputs=None):
+        """ Number of processes given to each locscale run (to each MPI
+        rank). In batch or tiled mode the threads are shared among the
+        maps (or tiles) processed at the same time. With automatic
+        resources, the threads of the run of the inputs are planned
+        instead.
+        """
+        if self.autoResources and inputs is not None:
+            return self.planProcesses(inputs)[1]
+        return max(1, self.numberOfThreads.get()
+                   // self.getConcurrentLocscaleRuns())
+
+    def getLocscaleRanks(self, inputs=None):
+        """ Number of MPI ranks of each locscale run, 1 without MPI. With
+        automatic resources, the ranks of the run of the inputs are planned,
+        up to the MPI processes of the protocol.
+        """
+        if self.autoResources and inputs is not None:
+            return self.planProcesses(inputs)[0]
+        return self.numberOfMpi.get() if self.useLocscaleMpi() else 1
+
+    def getConcurrentLocscaleRuns(self):
+        """ Number of locscale runs sharing the host at the same time. """
+        if self.useTiles and self.distributeTiles:
+            # each MPI rank runs a single tile at a time
+            return 1
+        if self.useTiles:
+            return self.getConcurrentRuns(
+                sum(len(self.getTileGrid(objId)) for objId in self._volsDict))
+        return self.getConcurrentRuns(len(self._volsDict))
+
+    def getConcurrentRuns(self, nTasks):
+        """ Number of locscale runs executed at the same time. """
+        if nTasks == 1:
+            return 1
+        # One thread is kept by Scipion to schedule the steps
+        return max(1, min(nTasks, self.numberOfThreads.get() - 1))
+
+    def getHistoryFn(self):
+        """ Return the file recording the resources used by past runs. """
+        return Plugin.getCachePath(
+            self.getProject().getTmpPath('locscale_cache'), 'history.jsonl')
+
+    def getResourcePlanner(self):
+        """ Return the planner calibrated with the recorded runs. It is
+        created once, so all runs of the protocol use the same model.
+        """
+        if getattr(self, '_planner', None) is None:
+            self._planner = ResourcePlanner(readHistory(self.getHistoryFn()))
+        return self._planner
+
+    def planProcesses(self, inputs):
+        """ Return the MPI ranks and threads per rank of the run of the
+        inputs that use the cores of the host and fit in its memory, when
+        the concurrent runs are executed at the same time.
+        """
+        if getattr(self, '_plans', None) is None:
+            self._plans = {}
+        if inputs['workDir'] in self._plans:
+            return self._plans[inputs['workDir']]
+
+        voxels, inputBytes = self.getRunSize(inputs['emmaps'])
+        planner = self.getResourcePlanner()
+        nConcurrent = self.getConcurrentLocscaleRuns()
+        maxRanks = self.numberOfMpi.get() if self.useLocscaleMpi() else 1
+        # runs that do not fit were refused in the validation, unless
+        # submitted to a queue
+        ranks, threads = planner.plan(voxels, inputBytes, nConcurrent,
+                                      maxRanks=maxRanks) or (1, 1)
+        self.info("Resource plan: %d MPI x %d threads x %d concurrent runs, "
+                  "predicted peak memory %s and time %s per run (%s model)"
+                  % (ranks, threads, nConcurrent,
+                     formatBytes(planner.predictMemory(voxels, threads,
+                                                       inputBytes, ranks)),
+                     formatTime(planner.predictTime(voxels, threads, ranks)),
+                     'calibrated' if planner.isCalibrated() else 'default'))
+        self._plans[inputs['workDir']] = ranks, threads
+        return ranks, threads
+
+    @staticmethod
+    def getRunSize(inputFns):
+        """ Return the voxels of the box and the size on disk of the
+        input maps of a run.
+        """
+        nx, ny, nz = readMrcHeader(inputFns[0])['dims']
+        return nx * ny * nz, sum(os.path.getsize(fn) for fn in inputFns)
+
+    def recordResources(self, inputs):
+        """ Record the memory and time of a finished run, to calibrate
+        the resource planner.
+        """
+        stats = readStats(self.getStatsFn(inputs))
+        if stats is None or self.useNNpredict:
+            return
+        voxels, inputBytes = self.getRunSize(inputs['emmaps'])
+        recordRun(self.getHistoryFn(), voxels,
+                  self.getLocscaleThreads(inputs), inputBytes, stats,
+                  ranks=self.getLocscaleRanks(inputs),
+                  version=Plugin.getActiveVersion(),
+                  modelMap=bool(inputs['ref']))
+
     def getSampling(self):
         return self.getInputVol().getSamplingRate()
 
-    def getOutputFn(self, folder):
+    def getInputsSampling(self, inputs):
+        """ Return the sampling of the inputs, which differs from the one
+        of the input volume for Fourier cropped inputs.
+        """
+        return inputs.get('apix', self.getSampling())
+
+    def getFourierCropBox(self, objId, inputs):
+        """ Return the box size of the Fourier cropped inputs of a volume,
+        or None if they are not Fourier cropped.
+        """
+        if not self.fourierCrop or self.useNNpredict:
+            return None
+        size = readMrcHeader(inputs['emmaps'][0])['dims'][0]
+        return getFourierCropSize(size, self.getInputsSampling(inputs),
+                                  self.getVolumeParams(objId)['resol'],
+                                  self.fourierCropMargin.get())
+
+    def getFourierReportFn(self, inputs):
+        """ Return the Fourier crop report of the run in inputs['workDir']. """
+        return self._getExtraPath('fourier_crop_%s.json'
+                                  % self.getWorkDirName(inputs))
+
+    def getGlobalReportFn(self, inputs):
+        """ Return the global sharpening report of the run in
+        inputs['workDir'].
+        """
+        return self._getExtraPath('global_%s.json'
+                                  % self.getWorkDirName(inputs))
+
+    def getOutputFn(self, folder, objId):
         """ Returns the scaled output file name. """
-        outputFnBase = pwutils.removeBaseExt(self.getInputVol().getFileName())
-        return self._getPath(folder, outputFnBase) + '_scaled.mrc'
+        vol = self._volsDict[objId]
+        outputFnBase = pwutils.removeBaseExt(vol.getFileName())
+        if self.isBatchMode():
+            outputFnBase += '_%03d' % objId
+        outputFn = outputFnBase + '_scaled.mrc'
+
+        if folder == "tmp":
+            return self._getVolTmpPath(objId, outputFn)
+        return self._getPath(folder, outputFn)
+
+    def getStagedInputs(self, objId):
+        """ Return the converted files used to sharpen a volume:
+        input maps (or half maps), reference volume and mask, and the
+        working directory where the program runs.
+        """
+        volTmpFn = self._getVolTmpPath(objId)
+        inputs = {'emmaps': [os.path.join(volTmpFn, self.getConvertedFn(v))
+                             for v in self.getVolInputs(objId)],
+                  'ref': None, 'mask': None, 'workDir': volTmpFn}
+        if not self.useNNpredict:
+            if self.refType == REF_VOL and not self.useGlobalSharpening():
+                inputs['ref'] = self.getRefVolFn()
+            inputs['mask'] = self.getVolumeParams(objId)['mask']
+        return inputs
+
+    def getVolumeParams(self, objId):
+        """ Return the parameters of the sharpening of a volume: target
+        resolution, symmetry group, EMmerNet model (index of its choice)
+        and converted mask (None without mask).
+        """
+        return {'resol': self.resol.get(),
+                'symmetryGroup': self.symmetryGroup.get(),
+                'emmernetModel': self.emmernetModel.get(),
+                'mask': (self.getMaskVolFn() if self.binaryMask.hasValue()
+                         else None)}
+
+    def getEmmernetModels(self):
+        """ Return the names of the EMmerNet models of the version. """
+        return self.getParam('emmernetModel').choices
+
+    def getResultFn(self, objId, inputs):
+        """ Return the file written by the sharpening of the inputs. """
+        outputFn = os.path.join(inputs['workDir'],
+                                os.path.basename(self.getOutputFn("tmp", objId)))
+        if self.useNNpredict and not self.isOldVersion():
+            outputFn = outputFn.replace(".mrc", "_locscale_output.mrc")
+        return outputFn
+
+    def getStatsFn(self, inputs):
+        """ Return the statistics file of the run in inputs['workDir']. """
+        return self._getExtraPath('stats_%s.json' % self.getWorkDirName(inputs))
+
+    def getOutputLogFn(self, inputs):
+        """ Return the file with the output of LocScale in
+        inputs['workDir']. """
+        return os.path.join(inputs['workDir'], 'locscale_output.log')
+
+    def getProfileFn(self, inputs=None, name=None):
+        """ Return the cProfile file of the run in inputs['workDir']. """
+        return self._getExtraPath('profile_%s.prof'
+                                  % (name or self.getWorkDirName(inputs)))
+
+    def getStacksFn(self, inputs):
+        """ Return the py-spy stacks file of the run in inputs['workDir']. """
+        return self._getExtraPath('stacks_%s.txt' % self.getWorkDirName(inputs))
+
+    def getWorkDirName(self, inputs):
+        """ Return the name of the run in inputs['workDir'], from its path
+        in the tmp (or scratch) folder of the protocol.
+        """
+        workDir = os.path.abspath(inputs['workDir'])
+        root = os.path.abspath(self._getTmpPath())
+        if self.useScratch and not workDir.startswith(root + os.sep):
+            root = self.getScratchPath()
+        return os.path.relpath(workDir, root).replace(os.sep, '_')
+
+    def getScratchPath(self, *paths):
+        """ Scratch folder of the protocol, in the node-local scratch root. """
+        return os.path.join(Plugin.getScratchRoot(), 'locscale_%s_%d'
+                            % (self.getProject().getShortName(),
+                               self.getObjId()), *paths)
+
+    def getScratchPatterns(self):
+        """ Return the glob patterns of the files copied back from scratch. """
+        return self.scratchCopyBack.get('').split()
+
+    def getTileGrid(self, objId):
+        """ Return the grid of tiles used to sharpen a volume. """
+        return self._getShapeTileGrid(self._volsDict[objId].getDim()[::-1])
+
+    def _getShapeTileGrid(self, shape):
+        tileSize = getTileSize(self.tileMemory.get() * 1024 ** 3,
+                               LOCSCALE_BYTES_PER_VOXEL)
+        return TileGrid(shape, tileSize, self.tileOverlap.get(),
+                        margin=self.getWindowSize() // 2)
+
+    def getWindowSize(self):
+        """ Return the size of the LocScale window in pixels. """
+        return getWindowSize(self.getSampling(), self.windowSize.get())
+
+    def getCropBox(self, objId, inputs):
+        """ Return the region to crop before sharpening a volume, or None. """
+        if self.useAsymmetricUnit():
+            box, _ = self.getAsymmetricUnitBox(objId, inputs)
+        elif self.cropMode == CROP_MASK and inputs['mask']:
+            box = getMaskBox(inputs['mask'], self.cropPadding.get())
+        elif self.cropMode == CROP_REGION:
+            x0, y0, z0, x1, y1, z1 = self.getCropRegion()
+            pad = self.cropPadding.get()
+            box = ((z0 - pad, z1 + pad), (y0 - pad, y1 + pad),
+                   (x0 - pad, x1 + pad))
+        else:
+            return None
+
+        if box is None:
+            return None
+        shape = readMrcHeader(inputs['emmaps'][0])['dims'][::-1]
+        box = tuple((max(start, 0), min(end, dim))
+                    for (start, end), dim in zip(box, shape))
+        box = makeCubicBox(box, shape)
+        if all(end - start == dim for (start, end), dim in zip(box, shape)):
+            return None
+        return box
+
+    def useAsymmetricUnit(self):
+        return self.asymmetricUnit and not self.useNNpredict
+
+    def getSymmetryMatrices(self, objId=None):
+        """ Return the symmetry operators of a volume, or those of the
+        symmetry group of the form if objId is None.
+        """
+        group = (self.symmetryGroup.get() if objId is None
+                 else self.getVolumeParams(objId)['symmetryGroup'])
+        return getSymmetryMatrices(group)
+
+    def getAsymmetricUnitBox(self, objId, inputs):
+        """ Return the box of the asymmetric unit of the inputs of a volume
+        and the direction that defines it.
+        """
+        shape = readMrcHeader(inputs['emmaps'][0])['dims'][::-1]
+        return getAsymmetricUnitBox(shape, self.getSymmetryMatrices(objId),
+                                    self.asymmetricUnitPadding.get(),
+                                    mask=self.readMask(inputs['mask']))
+
+    @staticmethod
+    def readMask(maskFn):
+        """ Return the mask as a boolean array, or None if there is none. """
+        if not maskFn:
+            return None
+        with mrcfile.open(maskFn, mode='r', permissive=True) as mrc:
+            return np.asarray(mrc.data) > 0.5
+
+    def getSymmetryReportFn(self, inputs):
+        """ Return the asymmetric unit report of the run in inputs['workDir']. """
+        return self._getExtraPath('symmetry_%s.json'
+                                  % self.getWorkDirName(inputs))
+
+    def getCropRegion(self):
+        """ Return the user region as integers x0, y0, z0, x1, y1, z1. """
+        return [int(v) for v in self.cropRegion.get().replace(',', ' ').split()]
+
+    def useLocscaleMpi(self):
+        """ Return True if LocScale itself runs with MPI. """
+        return (self.numberOfMpi > 1 and
+                not (self.useTiles and self.distributeTiles))
+
+    def useNumpyEngine(self):
+        return (not self.useNNpredict and self.refType == REF_VOL
+                and self.engine == ENGINE_NUMPY
+                and not self.useGlobalSharpening())
+
+    def sharpeningNeedsGpu(self):
+        """ Return True if the sharpening steps use the GPU. """
+        return bool(self.useNNpredict)
+
+    def useGlobalSharpening(self):
+        return self.globalSharpening and not self.useNNpredict
+
+    def getRefVolFn(self):
+        """ Return the absolute path of the converted reference volume. """
+        refFn = self._getTmpPath(self.getConvertedFn(self.refObj.get()))
+        return os.path.abspath(refFn)
+
+    def getMaskVolFn(self):
+        """ Return the absolute path of the converted mask. """
+        maskFn = self._getTmpPath(self.getConvertedFn(self.binaryMask.get()))
+        return os.path.abspath(maskFn)
+
+    def getRefPdbFn(self):
+        return self._getTmpPath(os.path.basename(self.refPdb.get().getFileName()))
+
+    def _getVolTmpPath(self, objId, *paths):
+        """ Working directory of the locscale run for a given volume. """
+        return self._getTmpPath('vol_%03d' % objId, *paths)
+
+    def _getTileTmpPath(self, objId, tileIndex, *paths):
+        """ Working directory of the locscale run for a tile. """
+        return self._getVolTmpPath(objId, 'tile_%03d' % tileIndex, *paths)
+
+    def _getVolumeCache(self):
+        """ Return the cache of converted volumes, or None if disabled. """
+        if not self.useCache:
+            return None
+        cachePath = Plugin.getCachePath(
+            self.getProject().getTmpPath('locscale_cache'), 'volumes')
+        return FileCache(cachePath, Plugin.getCacheSize(),
+                         contentHash=self.cacheByContent.get())
+
+    def _getModelCache(self):
+        """ Return the cache of model maps, or None if not used. """
+        if (self.useNNpredict or self.refType != REF_PDB
+                or not self.useModelCache or self.useGlobalSharpening()):
+            return None
+        cachePath = Plugin.getCachePath(
+            self.getProject().getTmpPath('locscale_cache'), 'models')
+        return FileCache(cachePath, Plugin.getCacheSize(), contentHash=True)
+
+    def _getResultIndex(self):
+        """ Return the index of stored run results, or None if not used. """
+        if not self.useResultCache or self.useTiles:
+            return None
+        cachePath = Plugin.getCachePath(
+            self.getProject().getTmpPath('locscale_cache'), 'results')
+        return ResultIndex(cachePath, Plugin.getCacheSize())
+
+    def getResultParams(self, objId):
+        """ Return the values of the parameters that affect the result
+        of a volume. """
+        values = {name: getattr(self, name).get()
+                  for name in self._resultParams}
+        volParams = self.getVolumeParams(objId)
+        values.update((name, volParams[name])
+                      for name in ('resol', 'symmetryGroup', 'emmernetModel'))
+        values.update(sampling=self.getSampling(), ccp4=bool(self.checkCcp4()),
+                      version=Plugin.getActiveVersion())
+        return values
+
+    def getResultFingerprint(self, objId):
+        """ Return the fingerprint of the run of a volume: the content of
+        its staged input maps, reference (volume or atomic model) and mask
+        and the parameters.
+        """
+        inputs = self.getStagedInputs(objId)
+        fns = inputs['emmaps'] + [fn for fn in (inputs['ref'], inputs['mask'])
+                                  if fn]
+        if (not self.useNNpredict and self.refType == REF_PDB
+                and not self.useGlobalSharpening()):
+            fns.append(self.getRefPdbFn())
+        return getFingerprint([fileDigest(fn) for fn in fns],
+                              self.getResultParams(objId))
+
+    def storeResult(self, index, fingerprint, objId, wallTime):
+        """ Store the output of a volume in the results cache, with the
+        time and resources of its LocScale runs.
+        """
+        outputFn = self.getOutputFn("extra", objId)
+        if not os.path.exists(outputFn):
+            return
+        stats = mergeStats(self.getVolumeStats(objId))
+        stats['wallTime'] = wallTime
+        index.put(fingerprint, outputFn, stats,
+                  version=Plugin.getActiveVersion(),
+                  project=self.getProject().getShortName(),
+                  protocol='%s %d' % (self.getClassName(), self.getObjId()),
+                  params=self.getResultParams(objId))
+
+    def getVolumeStats(self, objId):
+        """ Return the statistics of the finished runs of a volume. """
+        name = os.path.basename(self._getVolTmpPath(objId))
+        runs = [readStats(fn) for pattern in ('%s', '%s_*')
+                for fn in glob(self._getExtraPath('stats_%s.json'
+                                                  % (pattern % name)))]
+        return [s for s in runs if s and not s['running']]
+
+    def _updateCacheStats(self, cache, hits='cacheHits', misses='cacheMisses'):
+        """ Add the hits and misses of a cache to the protocol counters. """
+        if cache is None or cache.hits + cache.misses == 0:
+            return
+        hits, misses = getattr(self, hits), getattr(self, misses)
+        with self._lock:
+            hits.set(hits.get() + cache.hits)
+            misses.set(misses.get() + cache.misses)
+            self._store(hits, misses)
+
+    def getModelKey(self, cache, objId, inputs):
+        """ Return the cache key of the model map of a volume. The map is
+        simulated from the model at the sampling, box and resolution of the
+        volume; refinement and completion of the model also use the maps.
+        """
+        volParams = self.getVolumeParams(objId)
+        extra = [self.getSampling(), self._volsDict[objId].getDim(),
+                 volParams['resol'], self.incompletePdb.get(),
+                 self.checkCcp4(), Plugin.getActiveVersion()]
+        if self.incompletePdb or self.checkCcp4():
+            extra.extend(fileDigest(fn) for fn in inputs['emmaps'])
+        if self.incompletePdb:
+            extra.append(volParams['symmetryGroup'])
+            if inputs['mask']:
+                extra.append(fileDigest(inputs['mask']))
+        return cache.getKey(self.getRefPdbFn(), *extra)
+
+    def getCachedModelInputs(self, objId, inputs, workDir):
+        """ Return the inputs with the cached model map of the volume as
+        reference, linked in workDir. Inputs are returned unchanged if the
+        model map is not in the cache.
+        """
+        cache = self._getModelCache()
+        if cache is None:
+            return inputs
+
+        key = self.getModelKey(cache, objId, inputs)
+        modelMapFn = os.path.join(workDir, MODEL_MAP_FN)
+        found = cache.get(key + MODEL_MAP_FN, modelMapFn)
+        self._updateCacheStats(cache, 'modelCacheHits', 'modelCacheMisses')
+        if not found:
+            return inputs
+
+        self.info("Using the cached model map of %s"
+                  % os.path.basename(self.getRefPdbFn()))
+        for ext in ('.pdb', '.cif'):
+            refinedFn = self.getRefinedModelFn(objId, ext)
+            if os.path.exists(refinedFn) or cache.get(key + ext, refinedFn):
+                break
+        return dict(inputs, ref=os.path.abspath(modelMapFn))
+
+    def storeModel(self, objId, inputs):
+        """ Store the model map (and refined model) generated by LocScale
+        for the inputs in the cache.
+        """
+        cache = self._getModelCache()
+        if cache is None:
+            return
+
+        modelMapFn, refinedFn = self.findGeneratedModel(objId, inputs)
+        if modelMapFn is None:
+            self.info("Model map generated by LocScale not found, "
+                      "it will not be cached.")
+            return
+        key = self.getModelKey(cache, objId, inputs)
+        cache.put(key + MODEL_MAP_FN, modelMapFn)
+        if refinedFn is not None:
+            ext = os.path.splitext(refinedFn)[1]
+            cache.put(key + ext, refinedFn)
+            linkOrCopy(refinedFn, self.getRefinedModelFn(objId, ext))
+
+    def getRefinedModelFn(self, objId, ext):
+        """ Return the file of the refined model of a volume. """
+        return self._getExtraPath(MODEL_REFINED + ext)
+
+    def findGeneratedModel(self, objId, inputs):
+        """ Return the model map and refined model written by LocScale
+        in its working directory (None if not found).
+        """
+        stem = pwutils.removeBaseExt(self.getRefPdbFn())
+        exclude = {os.path.abspath(fn) for fn in inputs['emmaps']}
+        exclude.add(os.path.abspath(self.getResultFn(objId, inputs)))
+
+        def _newest(*patterns):
+            fns = [fn for p in patterns
+                   for fn in glob(os.path.join(inputs['workDir'], '**', p),
+                                  recursive=True)
+                   if os.path.abspath(fn) not in exclude]
+            return max(fns, key=os.path.getmtime) if fns else None
+
+        modelMapFn = _newest(f'*{stem}*4locscale.mrc', f'*{stem}*.mrc')
+        refinedFn = _newest(f'*{stem}*refined*.pdb', f'*{stem}*refined*.cif')
+        return modelMapFn, refinedFn
+
+    def _createOutputVol(self, objId):
+        outputVol = Volume()
+        outputVol.setObjId(objId)
+        outputVol.setSamplingRate(self.getSampling())
+        outputVol.setFileName(self.getOutputFn("extra", objId))
+        return outputVol
 
     def checkCcp4(self):
         return Plugin.getCcp4Plugin()
 
     @staticmethod
-    def convertBinaryVol(vol, outputDir):
-        """ Convert binary volume to mrc format.
+    def convertBinaryVol(vol, outputDir, cache=None):
+        """ Convert binary volume to mrc format. Inputs are normalised to
+        float32 maps, only those already in float32 mrc files are linked.
         Params:
             vol: input volume object to be converted.
             outputDir: where to put the converted file(s)
+            cache: optional FileCache of previously converted volumes.
         Return:
             new file name of the volume (converted or not).
         """
+        fn = cleanFileName(vol if isinstance(vol, str) else vol.getFileName())
+        newFn = os.path.join(outputDir, ProtLocScale.getConvertedFn(fn))
 
-        ih = ImageHandler()
-        fn = vol if isinstance(vol, str) else vol.getFileName()
-        newFn = os.path.join(outputDir, pwutils.replaceBaseExt(fn, 'mrc'))
-
-        if not fn.endswith('.mrc'):
-            ih.convert(fn, newFn)
-        else:
+        isMrc = isMrcCompatible(fn)
+        if isMrc and readMrcHeader(fn)['mode'] == MRC_FLOAT32:
             pwutils.createAbsLink(os.path.abspath(fn), newFn)
+        else:
+            samplingRate = None if isinstance(vol, str) else vol.getSamplingRate()
+            key = cache.getKey(fn, samplingRate) if cache else None
+            if cache is None or not cache.get(key, newFn):
+                if isMrc:
+                    normalizeVolume(fn, newFn)
+                else:
+                    convertVolume(fn, newFn, samplingRate)
+                if cache is not None:
+                    cache.put(key, newFn)
 
         return os.path.basename(newFn)
 
+    @staticmethod
+    def getConvertedFn(vol):
+        """ Return the base name of a volume once converted to mrc. """
+        fn = vol if isinstance(vol, str) else vol.getFileName()
+        return pwutils.replaceBaseExt(cleanFileName(fn), 'mrc')
+
     def isOldVersion(self):
         """ Version 2.1 has a different API. """
         return Plugin.getActiveVersion() == V2_1
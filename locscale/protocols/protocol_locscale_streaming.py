@@ -0,0 +1,160 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+from pwem.objects import SetOfVolumes
+from pyworkflow.protocol import params, ProtStreamingBase
+from pyworkflow.object import Set
+
+from locscale import scratch
+from locscale.protocols.protocol_locscale import ProtLocScale, outputs
+
+
+class ProtLocScaleStreaming(ProtLocScale, ProtStreamingBase):
+    """ Local sharpening of the volumes of a set in streaming. Volumes are
+    sharpened as soon as they are added to the input set, and appended to
+    the output set, which is closed when the input set is closed.
+    """
+    _label = 'local sharpening (streaming)'
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        ProtLocScale._defineParams(self, form)
+        form.getParam('inputVolume').pointerClass.set('SetOfVolumes')
+        self._defineStreamingParams(form)
+        form.addParam('parallelVolumes', params.IntParam, default=1,
+                      label='Volumes sharpened at once',
+                      help="Maximum number of volumes sharpened at the same "
+                           "time. The threads not used to follow the input "
+                           "are shared among them.")
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        ProtStreamingBase._insertAllSteps(self)
+
+    def stepsGeneratorStep(self):
+        """ Insert the steps of the new volumes of the input set until it
+        is closed. Sharpening steps are chained in as many lanes as
+        volumes sharpened at once.
+        """
+        self._volsDict = {}
+        sharedIds = self._insertSharedSteps()
+        outputVols = getattr(self, outputs.Volumes.name, None)
+        doneIds = set(outputVols.getIdSet()) if outputVols is not None else set()
+        nLanes = self.parallelVolumes.get()
+        laneIds = []
+        outputIds = []
+
+        while True:
+            inputVols = self._loadInputSet()
+            closed = inputVols.isStreamClosed()
+            newVols = [vol.clone() for vol in inputVols.iterItems()
+                       if vol.getObjId() not in self._volsDict]
+            inputVols.close()
+
+            for vol in newVols:
+                objId = vol.getObjId()
+                self._volsDict[objId] = vol
+                if objId in doneIds:
+                    continue
+                lane = len(outputIds) % nLanes
+                prerequisites = sharedIds + laneIds[lane:lane + 1]
+                stepId = self._insertVolumeSteps(objId, prerequisites)
+                laneIds[lane:lane + 1] = [stepId]
+                outputIds.append(self._insertFunctionStep(
+                    self.outputVolumeStep, objId, prerequisites=[stepId],
+                    needsGPU=False))
+
+            if closed:
+                break
+            self._streamingSleepOnWait()
+
+        self._insertFunctionStep(self.closeOutputStep,
+                                 prerequisites=outputIds, needsGPU=False)
+
+    # --------------------------- STEPS functions -----------------------------
+    def outputVolumeStep(self, objId):
+        """ Append the sharpened volume to the output set. """
+        with self._lock:
+            outputVols = self._getOutputSet()
+            outputVols.append(self._createOutputVol(objId))
+            outputVols.write()
+            self._store(outputVols)
+
+    def closeOutputStep(self):
+        """ Close the output set, once all volumes have been sharpened. """
+        scratch.waitCopies(self._getExtraPath())
+        with self._lock:
+            outputVols = self._getOutputSet()
+            outputVols.setStreamState(Set.STREAM_CLOSED)
+            outputVols.write()
+            self._store(outputVols)
+
+    # --------------------------- INFO functions ------------------------------
+    def _validate(self):
+        errors = ProtLocScale._validate(self)
+        self._validateThreads(errors)
+        if self.useTiles:
+            errors.append('Tiles are not available in streaming.')
+        return errors
+
+    # --------------------------- UTILS functions -----------------------------
+    def _loadInputSet(self):
+        """ Load the input set from its database, to see the volumes added
+        by the producer protocol since it was last read.
+        """
+        inputVols = SetOfVolumes(filename=self.getInputVol().getFileName())
+        inputVols.loadAllProperties()
+        return inputVols
+
+    def _getOutputSet(self):
+        """ Return the output set, created open for append the first time. """
+        outputVols = getattr(self, outputs.Volumes.name, None)
+        if outputVols is None:
+            outputVols = self._createSetOfVolumes()
+            outputVols.setSamplingRate(self.getSampling())
+            outputVols.setStreamState(Set.STREAM_OPEN)
+            self._defineOutputs(**{outputs.Volumes.name: outputVols})
+            self._defineTransformRelation(self.getInputVol(pointer=True),
+                                          outputVols)
+        else:
+            outputVols.enableAppend()
+        return outputVols
+
+    def getLocscaleThreads(self, inputs=None):
+        """ Threads given to each locscale run: one thread follows the input
+        and one schedules the steps, the rest are shared by the volumes
+        sharpened at the same time.
+        """
+        if self.autoResources and inputs is not None:
+            return self.planProcesses(inputs)[1]
+        nThreads = self.numberOfThreads.get() - 2
+        return max(1, nThreads // self.parallelVolumes.get())
+
+    def getConcurrentRuns(self, nTasks):
+        return max(1, min(nTasks, self.parallelVolumes.get()))
+
+    def getConcurrentLocscaleRuns(self):
+        return self.parallelVolumes.get()
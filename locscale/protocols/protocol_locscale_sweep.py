@@ -0,0 +1,367 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import json
+import time
+import itertools
+from glob import glob
+
+from pwem.objects import Volume
+from pyworkflow.protocol import params
+import pyworkflow.utils as pwutils
+
+from locscale.constants import REF_PDB, MODEL_MAP_FN, MODEL_REFINED
+from locscale import scratch
+from locscale.monitor import mergeStats, formatTime, formatBytes
+from locscale.symmetry import getSymmetryMatrices
+from locscale.protocols.protocol_locscale import ProtLocScale, outputs
+
+
+class ProtLocScaleSweep(ProtLocScale):
+    """ Local sharpening of a map with every combination of lists of
+    resolutions, symmetry groups, masks and EMmerNet models, to compare
+    their results. Each variant is sharpened as a volume of the protocol,
+    whose id is the variant id. The inputs are converted once, variants
+    that need the same model map wait for the first one to generate it,
+    and the rest run concurrently. The sharpened maps are a set of
+    volumes labelled with their parameters.
+    """
+    _label = 'local sharpening (parameter sweep)'
+
+    # --------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        ProtLocScale._defineParams(self, form)
+        form.getParam('inputVolume').pointerClass.set('Volume')
+        # the worker keeps LocScale loaded between the variants
+        form.getParam('useWorker').default.set(True)
+
+        form.addSection(label='Sweep')
+        form.addParam('sweepResol', params.StringParam, default='',
+                      condition='not useNNpredict',
+                      label='Target resolutions (A)',
+                      help="Resolutions of the variants, separated by "
+                           "spaces (e.g. 3 4 6). If empty, the target "
+                           "resolution of the Input tab is used.")
+        form.addParam('sweepSymmetry', params.StringParam, default='',
+                      condition='not useNNpredict',
+                      label='Symmetry groups',
+                      help="Symmetry groups of the variants, separated by "
+                           "spaces (e.g. c1 d7). If empty, the symmetry of "
+                           "the Input tab is used.")
+        form.addParam('sweepMasks', params.MultiPointerParam,
+                      pointerClass='VolumeMask', allowsNull=True,
+                      condition='not useNNpredict',
+                      label='Masks',
+                      help="Masks of the variants. If empty, the mask of "
+                           "the Extra tab (if any) is used.")
+        form.addParam('sweepNoMask', params.BooleanParam, default=False,
+                      condition='not useNNpredict',
+                      label='Also without mask?',
+                      help="Add variants without mask to those of the "
+                           "masks.")
+        form.addParam('sweepModels', params.StringParam, default='',
+                      condition='useNNpredict',
+                      label='EMmerNet models',
+                      help="Names of the EMmerNet models of the variants, "
+                           "separated by spaces (e.g. high_context "
+                           "low_context). If empty, the model of the Input "
+                           "tab is used.")
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        vol = self.getInputVol()
+        self._variants = self.getVariants()
+        self._volsDict = {variantId: vol.clone()
+                          for variantId in self._variants}
+
+        sharedIds = self._insertSharedSteps()
+        sharedIds += [self._insertFunctionStep(self.convertMapStep, i,
+                                               prerequisites=[],
+                                               needsGPU=False)
+                      for i in range(len(self.getMapInputs()))]
+        sharedIds += [self._insertFunctionStep(self.convertMaskStep, i,
+                                               prerequisites=[],
+                                               needsGPU=False)
+                      for i, _ in enumerate(self.sweepMasks)]
+
+        # variants sharing a model map run after the first one, which
+        # stores it in the cache
+        leaders = {}
+        variantIds = []
+        needsGPU = self.sharpeningNeedsGpu()
+        for variantId, variant in self._variants.items():
+            key = self.getSharedModelKey(variant)
+            prerequisites = sharedIds + ([leaders[key]] if key in leaders
+                                         else [])
+            stepId = self._insertFunctionStep(self.sharpenVariantStep,
+                                              variantId,
+                                              prerequisites=prerequisites,
+                                              needsGPU=needsGPU)
+            if key is not None:
+                leaders.setdefault(key, stepId)
+            variantIds.append(stepId)
+        self._insertFunctionStep(self.createOutputStep,
+                                 prerequisites=variantIds, needsGPU=False)
+
+    # --------------------------- STEPS functions -----------------------------
+    def convertMapStep(self, index):
+        """ Convert the input map (or one of its half maps), shared by the
+        variants. """
+        mapsDir = self._getTmpPath('maps')
+        os.makedirs(mapsDir, exist_ok=True)
+        cache = self._getVolumeCache()
+        self.convertBinaryVol(self.getMapInputs()[index], mapsDir, cache)
+        self._updateCacheStats(cache)
+
+    def convertMaskStep(self, index):
+        """ Convert one of the masks of the sweep. """
+        maskDir = self._getTmpPath('mask_%02d' % index)
+        os.makedirs(maskDir, exist_ok=True)
+        cache = self._getVolumeCache()
+        self.convertBinaryVol(self.sweepMasks[index].get(), maskDir, cache)
+        self._updateCacheStats(cache)
+
+    def sharpenVariantStep(self, variantId):
+        """ Sharpen the map with the parameters of a variant, as the
+        volume with the variant id.
+        """
+        variant = self._variants[variantId]
+        self.linkVariantInputs(variantId)
+        self.info("Variant %d: %s" % (variantId, self.getVariantLabel(variant)))
+
+        start = time.time()
+        reused = self.refineOrReuse(variantId)
+        wallTime = time.time() - start
+
+        report = {'variant': variant,
+                  'label': self.getVariantLabel(variant),
+                  'wallTime': wallTime,
+                  'reused': reused,
+                  # the cached model map is linked in the working directory
+                  'modelCacheHit': os.path.exists(
+                      self._getVolTmpPath(variantId, MODEL_MAP_FN))}
+        stats = self.getVolumeStats(variantId)
+        if stats:
+            report['stats'] = mergeStats(stats)
+        with open(self.getVariantReportFn(variantId), 'w') as f:
+            json.dump(report, f, indent=2)
+        pwutils.cleanPath(self._getVolTmpPath(variantId))
+
+    def createOutputStep(self):
+        """ Create the set of sharpened maps, labelled with their
+        parameters and wall time.
+        """
+        scratch.waitCopies(self._getExtraPath())
+        outputVols = self._createSetOfVolumes()
+        outputVols.setSamplingRate(self.getSampling())
+        for variantId in self._variants:
+            with open(self.getVariantReportFn(variantId)) as f:
+                report = json.load(f)
+            vol = Volume()
+            vol.setObjId(variantId)
+            vol.setSamplingRate(self.getSampling())
+            vol.setFileName(self.getOutputFn('extra', variantId))
+            vol.setObjLabel(report['label'])
+            vol.setObjComment('Sharpened in %s' % formatTime(report['wallTime']))
+            outputVols.append(vol)
+        self._defineOutputs(**{outputs.Volumes.name: outputVols})
+        self._defineTransformRelation(self.getInputVol(pointer=True),
+                                      outputVols)
+
+    # --------------------------- INFO functions ------------------------------
+    def _validate(self):
+        errors = ProtLocScale._validate(self)
+        if self.useTiles:
+            errors.append('Tiles are not available in a parameter sweep.')
+        inputSize = self.getInputVol().getDim()
+        for pointer in self.sweepMasks:
+            if pointer.get().getDim() != inputSize:
+                errors.append('Input map and mask %s should be of the same '
+                              'size' % pointer.get().getObjLabel())
+        try:
+            variants = self.getVariants()
+        except ValueError as e:
+            errors.append(str(e))
+            return errors
+
+        if self.useAsymmetricUnit():
+            for group in {v['symmetryGroup'] for v in variants.values()}:
+                try:
+                    if len(getSymmetryMatrices(group)) == 1:
+                        errors.append('Sharpening the asymmetric unit '
+                                      'requires symmetry groups other than '
+                                      'c1.')
+                except ValueError as e:
+                    errors.append('%s. Use Cn, Dn, T, O or I.' % e)
+        return errors
+
+    def _summary(self):
+        summary = ProtLocScale._summary(self)
+        reports = sorted(glob(self._getExtraPath('variant_*.json')))
+        if reports:
+            summary.append('Variants (%d):' % len(reports))
+        for reportFn in reports:
+            with open(reportFn) as f:
+                report = json.load(f)
+            line = '   %s: %s' % (report['label'],
+                                  formatTime(report['wallTime']))
+            if report['reused']:
+                line += ' (result of an identical run)'
+            elif 'stats' in report:
+                line += ', peak memory %s' % formatBytes(
+                    report['stats']['peakRss'])
+            if report['modelCacheHit']:
+                line += ', shared model map'
+            summary.append(line)
+        return summary
+
+    # --------------------------- UTILS functions -----------------------------
+    def getVariants(self):
+        """ Return the variants of the sweep by id: the combinations of the
+        listed values whose LocScale runs differ. EMmerNet runs only depend
+        on the model, the other runs on the resolution, symmetry and mask.
+        """
+        if self.useNNpredict:
+            models = self.getEmmernetModels()
+            names = self.sweepModels.get('').split() or [
+                self.getEnumText('emmernetModel')]
+            unknown = [name for name in names if name not in models]
+            if unknown:
+                raise ValueError('Unknown EMmerNet models %s, use %s'
+                                 % (' '.join(unknown), ' '.join(models)))
+            combinations = [dict(resol=None, symmetryGroup=None, mask=None,
+                                 emmernetModel=models.index(name))
+                            for name in names]
+        else:
+            try:
+                resols = [int(r) for r in self.sweepResol.get('').split()]
+            except ValueError:
+                raise ValueError('Target resolutions should be integer '
+                                 'values separated by spaces.')
+            groups = [g.lower() for g in self.sweepSymmetry.get('').split()]
+            masks = list(range(len(self.sweepMasks)))
+            if not masks:
+                masks = [-1] if self.binaryMask.hasValue() else [None]
+            elif self.sweepNoMask:
+                masks.append(None)
+            combinations = [dict(resol=r, symmetryGroup=g, mask=m,
+                                 emmernetModel=None)
+                            for r, g, m in itertools.product(
+                                resols or [self.resol.get()],
+                                groups or [self.symmetryGroup.get().lower()],
+                                masks)]
+
+        variants = {}
+        for variant in combinations:
+            if variant not in variants.values():
+                variants[len(variants) + 1] = variant
+        return variants
+
+    def getSharedModelKey(self, variant):
+        """ Return the key of the model map generated for a variant, equal
+        for the variants that can share it, or None if it is not cached.
+        """
+        if (self.useNNpredict or self.refType != REF_PDB
+                or not self.useModelCache or self.useGlobalSharpening()):
+            return None
+        if self.incompletePdb:
+            return variant['resol'], variant['symmetryGroup'], variant['mask']
+        return variant['resol'],
+
+    def getVariantLabel(self, variant):
+        """ Return a label with the parameters of a variant. """
+        if variant['emmernetModel'] is not None:
+            return 'EMmerNet %s' % self.getEmmernetModels()[variant['emmernetModel']]
+        mask = self.getVariantMask(variant)
+        maskLabel = ('no mask' if mask is None else 'mask %s' % (
+            mask.getObjLabel() or pwutils.removeBaseExt(mask.getFileName())))
+        return '%d A, %s, %s' % (variant['resol'],
+                                 variant['symmetryGroup'].upper(), maskLabel)
+
+    def getVariantMask(self, variant):
+        """ Return the mask object of a variant, or None. """
+        mask = variant['mask']
+        if mask is None:
+            return None
+        return self.binaryMask.get() if mask < 0 else self.sweepMasks[mask].get()
+
+    def getVariantMaskFn(self, variant):
+        """ Return the converted mask of a variant, or None. """
+        mask = variant['mask']
+        if mask is None:
+            return None
+        if mask < 0:
+            return self.getMaskVolFn()
+        return os.path.abspath(self._getTmpPath(
+            'mask_%02d' % mask,
+            self.getConvertedFn(self.sweepMasks[mask].get())))
+
+    def getVolumeParams(self, variantId):
+        """ Return the parameters of a variant, those not swept are the
+        ones of the form.
+        """
+        volParams = ProtLocScale.getVolumeParams(self, variantId)
+        variant = self._variants[variantId]
+        for name in ('resol', 'symmetryGroup', 'emmernetModel'):
+            if variant[name] is not None:
+                volParams[name] = variant[name]
+        volParams['mask'] = self.getVariantMaskFn(variant)
+        return volParams
+
+    def getMapInputs(self):
+        """ Return the half maps of the input map, or the map itself if it
+        has no half maps associated. """
+        vol = self.getInputVol()
+        return vol.getHalfMaps(asList=True) if vol.hasHalfMaps() else [vol]
+
+    def linkVariantInputs(self, variantId):
+        """ Link the maps converted by the sweep to the working directory
+        of a variant, where LocScale expects them.
+        """
+        volTmpPath = self._getVolTmpPath(variantId)
+        os.makedirs(volTmpPath, exist_ok=True)
+        for vol in self.getMapInputs():
+            fn = self.getConvertedFn(vol)
+            mapFn = os.path.abspath(self._getTmpPath('maps', fn))
+            pwutils.createAbsLink(mapFn, os.path.join(volTmpPath, fn))
+
+    def getOutputFn(self, folder, objId):
+        """ Return the scaled output file name of a variant, named after
+        the variant id as the volumes in batch mode.
+        """
+        outputFn = '%s_%03d_scaled.mrc' % (pwutils.removeBaseExt(
+            self.getInputVol().getFileName()), objId)
+        if folder == "tmp":
+            return self._getVolTmpPath(objId, outputFn)
+        return self._getPath(folder, outputFn)
+
+    def getRefinedModelFn(self, objId, ext):
+        """ Return the file of the refined model of a variant. """
+        return self._getExtraPath('%s_%03d%s' % (MODEL_REFINED, objId, ext))
+
+    def getVariantReportFn(self, variantId):
+        return self._getExtraPath('variant_%03d.json' % variantId)
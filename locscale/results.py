@@ -0,0 +1,245 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Cache of the results of whole LocScale runs. Every completed run is
+recorded in a SQLite index with the fingerprint of its inputs and
+parameters, the stored output map, its timings and resource use. A later
+run with the same fingerprint takes the stored map instead of running
+LocScale again.
+
+The index can be queried for reports, also from the command line:
+    python -m locscale.results <results folder> [--limit N]
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import sqlite3
+import hashlib
+import argparse
+
+from locscale.cache import linkOrCopy, replaceFile
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    fingerprint TEXT PRIMARY KEY,
+    file TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    lastUsed REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    wallTime REAL,
+    cpuTime REAL,
+    peakRss INTEGER,
+    version TEXT,
+    host TEXT,
+    project TEXT,
+    protocol TEXT,
+    params TEXT
+)
+"""
+COLUMNS = ['fingerprint', 'file', 'size', 'created', 'lastUsed', 'hits',
+           'wallTime', 'cpuTime', 'peakRss', 'version', 'host', 'project',
+           'protocol', 'params']
+
+
+def getFingerprint(fileDigests, params):
+    """ Return the fingerprint of a run from the digests of its input
+    files and the values of the parameters that affect its result.
+    """
+    text = json.dumps([list(fileDigests), params], sort_keys=True,
+                      default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class ResultIndex:
+    """ Folder of output maps indexed by run fingerprint in a SQLite
+    database, with a size limit. The least recently used maps are removed
+    when the limit is reached. SQLite locks the database, so several
+    protocols can use the same folder at the same time.
+    """
+    DATABASE = 'results.sqlite'
+
+    def __init__(self, path, maxSize):
+        """
+        Params:
+            path: results folder, created if it does not exist.
+            maxSize: maximum size of the stored maps in bytes.
+        """
+        self.path = path
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+        db = self._connect()
+        try:
+            with db:
+                db.execute(SCHEMA)
+        finally:
+            db.close()
+
+    def _connect(self):
+        db = sqlite3.connect(os.path.join(self.path, self.DATABASE),
+                             timeout=600, isolation_level='IMMEDIATE')
+        db.row_factory = sqlite3.Row
+        return db
+
+    def get(self, fingerprint, outputFn):
+        """ Link the stored map of the fingerprint to outputFn.
+        Return the record of the run on a hit, None otherwise.
+        """
+        db = self._connect()
+        try:
+            with db:
+                row = db.execute('SELECT * FROM runs WHERE fingerprint = ?',
+                                 (fingerprint,)).fetchone()
+                storedFn = os.path.join(self.path, row['file']) if row else None
+                if storedFn is None or not os.path.exists(storedFn):
+                    db.execute('DELETE FROM runs WHERE fingerprint = ?',
+                               (fingerprint,))
+                    self.misses += 1
+                    return None
+
+                linkOrCopy(storedFn, outputFn)
+                db.execute('UPDATE runs SET lastUsed = ?, hits = hits + 1 '
+                           'WHERE fingerprint = ?', (time.time(), fingerprint))
+                self.hits += 1
+                return dict(row)
+        finally:
+            db.close()
+
+    def put(self, fingerprint, fn, stats=None, **info):
+        """ Store a copy of the output map fn of a completed run.
+        Params:
+            stats: wallTime, cpuTime and peakRss of the run.
+            info: version, project, protocol and params of the run.
+        """
+        storedName = fingerprint[:32] + os.path.splitext(fn)[1]
+        storedFn = os.path.join(self.path, storedName)
+        replaceFile(fn, storedFn)
+
+        stats = stats or {}
+        now = time.time()
+        record = dict(fingerprint=fingerprint, file=storedName,
+                      size=os.path.getsize(storedFn), created=now,
+                      lastUsed=now, hits=0, wallTime=stats.get('wallTime'),
+                      cpuTime=stats.get('cpuTime'),
+                      peakRss=stats.get('peakRss'),
+                      version=info.get('version'), host=socket.gethostname(),
+                      project=info.get('project'),
+                      protocol=info.get('protocol'),
+                      params=json.dumps(info.get('params'), default=str))
+        db = self._connect()
+        try:
+            with db:
+                db.execute('INSERT OR REPLACE INTO runs (%s) VALUES (%s)'
+                           % (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                           [record[c] for c in COLUMNS])
+                self._evict(db)
+        finally:
+            db.close()
+
+    def _evict(self, db):
+        """ Remove the least recently used maps until the stored ones fit
+        in the maximum size.
+        """
+        total = db.execute('SELECT COALESCE(SUM(size), 0) FROM runs'
+                           ).fetchone()[0]
+        if total <= self.maxSize:
+            return
+        for row in db.execute('SELECT fingerprint, file, size FROM runs '
+                              'ORDER BY lastUsed').fetchall():
+            if total <= self.maxSize:
+                break
+            storedFn = os.path.join(self.path, row['file'])
+            if os.path.exists(storedFn):
+                os.remove(storedFn)
+            db.execute('DELETE FROM runs WHERE fingerprint = ?',
+                       (row['fingerprint'],))
+            total -= row['size']
+
+    def query(self, orderBy='lastUsed', limit=None, **where):
+        """ Return the records of the stored runs as dicts, most recent
+        first, optionally filtered by column values (e.g. version='2.2.3').
+        """
+        for column in list(where) + [orderBy]:
+            if column not in COLUMNS:
+                raise ValueError("Unknown column %s" % column)
+        sql = 'SELECT * FROM runs'
+        if where:
+            sql += ' WHERE ' + ' AND '.join('%s = ?' % c for c in where)
+        sql += ' ORDER BY %s DESC' % orderBy
+        if limit:
+            sql += ' LIMIT %d' % limit
+        db = self._connect()
+        try:
+            return [dict(row) for row in db.execute(sql, list(where.values()))]
+        finally:
+            db.close()
+
+    def getReport(self):
+        """ Return the number of stored runs, their size in bytes, the
+        number of hits and the run time saved by them (seconds).
+        """
+        db = self._connect()
+        try:
+            row = db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), '
+                'COALESCE(SUM(hits), 0), '
+                'COALESCE(SUM(hits * COALESCE(wallTime, 0)), 0) FROM runs'
+            ).fetchone()
+        finally:
+            db.close()
+        return {'runs': row[0], 'size': row[1], 'hits': row[2],
+                'savedTime': row[3]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Report the LocScale runs stored in a results folder.")
+    parser.add_argument('path', help="results folder (results inside the "
+                                     "LocScale cache folder)")
+    parser.add_argument('--limit', type=int, default=20,
+                        help="number of runs listed")
+    args = parser.parse_args(argv)
+
+    index = ResultIndex(args.path, float('inf'))
+    report = index.getReport()
+    print("%d runs, %.2f GB, %d hits saving %.1f hours"
+          % (report['runs'], report['size'] / 1024 ** 3, report['hits'],
+             report['savedTime'] / 3600))
+    for run in index.query(limit=args.limit):
+        print("%s  %s  %-8s %4d hits  %8.0f s  %s %s"
+              % (run['fingerprint'][:12],
+                 time.strftime('%Y-%m-%d %H:%M', time.localtime(run['created'])),
+                 run['version'], run['hits'], run['wallTime'] or 0,
+                 run['project'], run['protocol']))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Working directories on a node-local scratch disk. Inputs are copied to
+the scratch directory, the program runs there and the files to keep are
+copied back to the project in a background thread, which then removes
+the scratch directory.
+"""
+
+import os
+import shutil
+import threading
+from glob import glob
+
+# Copy-back threads in progress and errors of the finished ones, by
+# target directory, so each protocol only waits for its own copies.
+# Threads end with their copy, since Scipion joins all threads after the
+# steps.
+_pending = {}
+_errors = {}
+_lock = threading.Lock()
+
+
+def createDir(path):
+    """ Create an empty scratch directory, removing the one left by a
+    previous run that did not finish.
+    """
+    if os.path.exists(path):
+        shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def stageFiles(fns, path):
+    """ Copy files (following links) to the scratch directory.
+    Return the new file names.
+    """
+    stagedFns = []
+    for fn in fns:
+        stagedFn = os.path.join(path, os.path.basename(fn))
+        shutil.copyfile(fn, stagedFn)
+        stagedFns.append(stagedFn)
+    return stagedFns
+
+
+def _copyBack(path, targetDir, patterns):
+    try:
+        for pattern in patterns:
+            for fn in glob(os.path.join(path, pattern), recursive=True):
+                targetFn = os.path.join(targetDir, os.path.relpath(fn, path))
+                os.makedirs(os.path.dirname(targetFn), exist_ok=True)
+                if os.path.isdir(fn):
+                    shutil.copytree(fn, targetFn, dirs_exist_ok=True)
+                else:
+                    shutil.copy2(fn, targetFn)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+        try:  # the folder of the protocol, once all its runs are done
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+
+def copyBack(path, targetDir, patterns, wait=False):
+    """ Copy the files of the scratch directory matching the glob patterns
+    to targetDir, keeping their relative paths, and remove the scratch
+    directory (and its parent, if empty). Unless wait is True, the copy
+    runs in the background and waitCopies() waits for it.
+    """
+    if wait:
+        _copyBack(path, targetDir, patterns)
+        return
+
+    key = os.path.abspath(targetDir)
+
+    def _run():
+        try:
+            _copyBack(path, targetDir, patterns)
+        except Exception as e:
+            with _lock:
+                _errors.setdefault(key, []).append(e)
+
+    thread = threading.Thread(target=_run, name='locscale-copy-back')
+    with _lock:
+        _pending.setdefault(key, []).append(thread)
+    thread.start()
+
+
+def _isUnder(path, root):
+    return root is None or path == root or path.startswith(root + os.sep)
+
+
+def waitCopies(root=None):
+    """ Wait for the copies in progress to root or its subdirectories
+    (all the copies if None). Raise the error of the first of them that
+    failed; errors are only reported once.
+    """
+    root = os.path.abspath(root) if root is not None else None
+    with _lock:
+        keys = [key for key in _pending if _isUnder(key, root)]
+        threads = [thread for key in keys for thread in _pending.pop(key)]
+    for thread in threads:
+        thread.join()
+    with _lock:
+        keys = [key for key in _errors if _isUnder(key, root)]
+        errors = [error for key in keys for error in _errors.pop(key)]
+    if errors:
+        raise errors[0]
@@ -0,0 +1,257 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Quick global sharpening of maps with a single B-factor, without the
+LocScale program. The B-factor is fitted to the Guinier plot (logarithm
+of the radially averaged amplitude against the squared frequency) of the
+map between a low resolution limit and the target resolution. With half
+maps, the shells are also weighted by the FSC of the halves (Rosenthal
+and Henderson 2003). The filter is applied to the real FFT of the map,
+with vectorised shell binning over slabs of planes, which bounds the
+temporary arrays.
+"""
+
+import time
+import argparse
+
+import numpy as np
+import mrcfile
+from scipy import fft
+
+from locscale.constants import GUINIER_LOW_RES
+from locscale.convert import updateHeaderStats
+
+# FSC threshold of the resolution reported for half maps
+FSC_THRESHOLD = 0.143
+# Width of the cosine edge of the low-pass filter, in shells
+LOWPASS_EDGE = 3
+# Planes of the Fourier transform binned at once
+SLAB_SIZE = 16
+
+
+def getShells(shape):
+    """ Return the shell of every coefficient of the real FFT of a map of
+    shape (z, y, x), with shells 1 / (n apix) wide for n the largest side,
+    and the number of shells up to Nyquist. Coefficients beyond Nyquist
+    (corners of the box) are in an extra shell.
+    """
+    n = max(shape)
+    fz, fy = [(np.fft.fftfreq(m) * n).astype(np.float32) for m in shape[:2]]
+    fx = (np.fft.rfftfreq(shape[2]) * n).astype(np.float32)
+    radius = np.sqrt(fz[:, None, None] ** 2 + fy[None, :, None] ** 2
+                     + fx[None, None, :] ** 2)
+    nShells = n // 2 + 1
+    np.rint(radius, out=radius)
+    np.minimum(radius, nShells, out=radius)
+    return radius.astype(np.int32), nShells
+
+
+def _shellSum(term, shells, nShells, *fts):
+    """ Return the sum per shell of term(*fts), evaluated by slabs. """
+    total = np.zeros(nShells + 1)
+    for z in range(0, shells.shape[0], SLAB_SIZE):
+        values = term(*[ft[z:z + SLAB_SIZE] for ft in fts])
+        total += np.bincount(shells[z:z + SLAB_SIZE].ravel(),
+                             weights=values.ravel(), minlength=nShells + 1)
+    return total[:nShells]
+
+
+def _power(ft):
+    return ft.real ** 2 + ft.imag ** 2
+
+
+def _cross(ft1, ft2):
+    return (ft1 * np.conj(ft2)).real
+
+
+def _readMap(fn):
+    with mrcfile.open(fn, mode='r', permissive=True) as mrc:
+        return np.asarray(mrc.data, dtype=np.float32)
+
+
+def getFscResolution(freqs, fsc, threshold=FSC_THRESHOLD):
+    """ Return the resolution (A) where the FSC drops below threshold,
+    or None if it does not.
+    """
+    below = np.nonzero(fsc[1:] < threshold)[0]
+    if not len(below):
+        return None
+    i = below[0] + 1
+    # linear interpolation between the shells around the crossing
+    f = np.interp(threshold, [fsc[i], fsc[i - 1]], [freqs[i], freqs[i - 1]])
+    return float(1. / f) if f > 0 else None
+
+
+def fitBfactor(freqs, amplitudes, lowResolution, highResolution):
+    """ Return the B-factor (A^2) of the decay of the amplitudes between
+    two resolutions, from a linear fit of the Guinier plot:
+    ln F(s) = a - B s^2 / 4.
+    """
+    fit = ((freqs >= 1. / lowResolution) & (freqs <= 1. / highResolution)
+           & (amplitudes > 0))
+    if np.count_nonzero(fit) < 3:
+        raise ValueError("Too few shells between %s and %s A to fit a "
+                         "B-factor" % (lowResolution, highResolution))
+    slope, _ = np.polyfit(freqs[fit] ** 2, np.log(amplitudes[fit]), 1)
+    return float(-4. * slope)
+
+
+def getSharpeningFilter(freqs, bfactor, resolution, edge, weights=None):
+    """ Return the filter of each shell: exp(-B s^2 / 4) for the (negative)
+    sharpening B-factor, times the weights, low-passed at resolution with
+    a cosine edge of width edge (1/A).
+    """
+    sharpen = np.exp(-bfactor * freqs ** 2 / 4.)
+    cutoff = 1. / resolution
+    lowPass = np.clip((freqs - cutoff) / edge, 0., 1.)
+    sharpen *= 0.5 * (1. + np.cos(np.pi * lowPass))
+    if weights is not None:
+        sharpen *= weights
+    return sharpen
+
+
+def globalSharpen(emmapFns, outputFn, apix, resolution, maskFn=None,
+                  bfactor=None, lowResolution=GUINIER_LOW_RES, workers=1):
+    """ Sharpen a map (or the average of its half maps) with a global
+    B-factor. Return a report of the fit.
+    Params:
+        emmapFns: input map file, or the two half map files.
+        outputFn: output mrc file.
+        apix: sampling rate in A/px.
+        resolution: upper limit of the fit and of the low-pass filter (A).
+        maskFn: optional mask, the spectrum and FSC are computed inside it.
+        bfactor: sharpening B-factor (A^2, negative to sharpen), fitted
+            from the Guinier plot if None.
+        lowResolution: lower limit of the fit (A).
+        workers: threads of the FFTs.
+    """
+    start = time.time()
+    with mrcfile.mmap(emmapFns[0], mode='r', permissive=True) as mrc:
+        shape = mrc.data.shape
+        voxelSize = mrc.voxel_size.copy()
+        origin = mrc.header.origin.copy()
+
+    shells, nShells = getShells(shape)
+    counts = np.maximum(np.bincount(shells.ravel(),
+                                    minlength=nShells + 1)[:nShells], 1)
+    freqs = np.arange(nShells) / (max(shape) * apix)
+    mask = _readMap(maskFn) > 0.5 if maskFn else None
+
+    def _transform(data):
+        return fft.rfftn(data if mask is None else data * mask,
+                         workers=workers)
+
+    report = {'halfMaps': len(emmapFns) == 2}
+    weights = None
+    if len(emmapFns) == 2:
+        ft1, ft2 = [_transform(_readMap(fn)) for fn in emmapFns]
+        cross = _shellSum(_cross, shells, nShells, ft1, ft2)
+        power1 = _shellSum(_power, shells, nShells, ft1)
+        power2 = _shellSum(_power, shells, nShells, ft2)
+        fsc = cross / np.maximum(np.sqrt(power1 * power2),
+                                 np.finfo(float).tiny)
+        ft1 += ft2
+        ft1 *= 0.5
+        del ft2
+        power = _shellSum(_power, shells, nShells, ft1)
+        # FSC of the average of the halves, the full map
+        fscFull = np.clip(2 * fsc / (1 + np.abs(fsc)), 0., 1.)
+        weights = np.sqrt(fscFull)
+        report.update(fscResolution=getFscResolution(freqs, fsc),
+                      fsc=[[float(f), float(c)] for f, c in zip(freqs, fsc)])
+        if mask is None:
+            ft = ft1
+        else:  # the filter is applied to the unmasked map
+            del ft1
+            mask = None
+            ft = _transform(sum(_readMap(fn) for fn in emmapFns) / 2.)
+    else:
+        ft = _transform(_readMap(emmapFns[0]))
+        power = _shellSum(_power, shells, nShells, ft)
+        if mask is not None:
+            mask = None
+            ft = _transform(_readMap(emmapFns[0]))
+
+    amplitudes = np.sqrt(power / counts)
+    fitted = fitBfactor(freqs, amplitudes, lowResolution, resolution)
+    if bfactor is None:
+        bfactor = -fitted
+    report.update(fittedBfactor=fitted, bfactor=bfactor,
+                  fitRange=[lowResolution, resolution],
+                  guinier=[[float(f ** 2), float(np.log(a))]
+                           for f, a in zip(freqs, amplitudes) if a > 0])
+
+    shellFilter = getSharpeningFilter(freqs, bfactor, resolution,
+                                      LOWPASS_EDGE / (max(shape) * apix),
+                                      weights)
+    # coefficients beyond Nyquist are removed
+    shellFilter = np.append(shellFilter, 0.).astype(np.float32)
+    for z in range(0, shells.shape[0], SLAB_SIZE):
+        ft[z:z + SLAB_SIZE] *= shellFilter[shells[z:z + SLAB_SIZE]]
+    del shells
+    sharpened = fft.irfftn(ft, s=shape, workers=workers).astype(np.float32)
+    del ft
+
+    with mrcfile.new(outputFn, overwrite=True) as output:
+        output.set_data(sharpened)
+        output.voxel_size = voxelSize
+        output.header.origin = origin
+        updateHeaderStats(output)
+
+    report['time'] = time.time() - start
+    return report
+
+
+def main():
+    """ Command line entry point, to sharpen a map for a quick look. """
+    parser = argparse.ArgumentParser(description="Global B-factor sharpening")
+    parser.add_argument('--emmaps', nargs='+', required=True,
+                        help="map or the two half maps")
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--apix', type=float, required=True)
+    parser.add_argument('--resolution', type=float, required=True)
+    parser.add_argument('--mask', default=None)
+    parser.add_argument('--bfactor', type=float, default=None)
+    parser.add_argument('--low_resolution', type=float,
+                        default=GUINIER_LOW_RES)
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    report = globalSharpen(args.emmaps, args.output, args.apix,
+                           args.resolution, maskFn=args.mask,
+                           bfactor=args.bfactor,
+                           lowResolution=args.low_resolution,
+                           workers=args.workers)
+    print("B-factor %0.1f A^2 (fitted %0.1f from %s to %s A) in %0.1f s"
+          % (report['bfactor'], report['fittedBfactor'],
+             *report['fitRange'], report['time']))
+    if report.get('fscResolution'):
+        print("FSC %s resolution %0.2f A" % (FSC_THRESHOLD,
+                                             report['fscResolution']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Point group symmetry of maps: rotation matrices of the groups, the box
+of an asymmetric unit and the expansion of the asymmetric unit to the
+full map.
+
+The symmetry centre is the voxel at the centre of the box. Cn and Dn
+have their n-fold axis on z (and a 2-fold on x for Dn). T, O and I have
+2-fold axes on x, y and z, 3-fold axes on the diagonals and, for I,
+5-fold axes in the yz plane (I2 convention of Relion).
+
+The asymmetric unit is the region of the voxels whose symmetry copy
+closest to a reference direction is the voxel itself, so every voxel of
+the map has a single copy in it.
+"""
+
+import numpy as np
+import mrcfile
+from scipy.ndimage import map_coordinates
+
+from locscale.convert import makeCubicBox, updateHeaderStats
+
+# Size of the grid used to find the box of the asymmetric unit
+ASU_GRID_SIZE = 64
+
+
+def _rotation(axis, angle):
+    """ Return the matrix of a rotation of angle (radians) about axis. """
+    x, y, z = np.asarray(axis, dtype=float) / np.linalg.norm(axis)
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([
+        [c + x * x * (1 - c), x * y * (1 - c) - z * s, x * z * (1 - c) + y * s],
+        [y * x * (1 - c) + z * s, c + y * y * (1 - c), y * z * (1 - c) - x * s],
+        [z * x * (1 - c) - y * s, z * y * (1 - c) + x * s, c + z * z * (1 - c)]])
+
+
+def _closure(generators):
+    """ Return all the products of the generators (the group). """
+    group = [np.eye(3)]
+    keys = {tuple(np.round(group[0], 6).ravel())}
+    i = 0
+    while i < len(group):
+        for gen in generators:
+            matrix = gen @ group[i]
+            key = tuple(np.round(matrix, 6).ravel())
+            if key not in keys:
+                keys.add(key)
+                group.append(matrix)
+        i += 1
+    return np.array(group)
+
+
+def getSymmetryMatrices(group):
+    """ Return the rotation matrices (n, 3, 3) acting on (x, y, z)
+    coordinates of a point group: Cn, Dn, T, O or I.
+    """
+    group = group.strip().lower()
+    golden = (1 + np.sqrt(5)) / 2
+    try:
+        if group[0] in 'cd':
+            order = int(group[1:])
+            if order < 1:
+                raise ValueError
+            generators = [_rotation((0, 0, 1), 2 * np.pi / order)]
+            if group[0] == 'd':
+                generators.append(_rotation((1, 0, 0), np.pi))
+        elif group in ('t', 'o', 'i', 'i2'):
+            generators = [_rotation((0, 0, 1), np.pi),
+                          _rotation((1, 0, 0), np.pi),
+                          _rotation((1, 1, 1), 2 * np.pi / 3)]
+            if group == 'o':
+                generators.append(_rotation((0, 0, 1), np.pi / 2))
+            elif group != 't':
+                generators.append(_rotation((0, 1, golden), 2 * np.pi / 5))
+        else:
+            raise ValueError
+    except (ValueError, IndexError):
+        raise ValueError("Unknown symmetry group %s" % group)
+    return _closure(generators)
+
+
+def _getCentre(shape):
+    """ Return the symmetry centre (x, y, z) of a (z, y, x) shape. """
+    return np.array(shape[::-1], dtype=float) // 2
+
+
+def _getOrbit(matrices, direction):
+    """ Return the directions R^T v, whose dot product with x is the one
+    of R x with v.
+    """
+    return np.einsum('nji,j->ni', matrices, direction)
+
+
+def getAsymmetricUnitBox(shape, matrices, padding=0, mask=None):
+    """ Return the cubic box ((z0, z1), (y0, y1), (x0, x1)) of an
+    asymmetric unit inside the sphere of the box (or inside the mask, a
+    boolean array of the shape) padded by padding voxels, and the
+    reference direction that defines it.
+    """
+    centre = _getCentre(shape)
+    step = max(1, max(shape) // ASU_GRID_SIZE)
+    z, y, x = np.mgrid[0:shape[0]:step, 0:shape[1]:step, 0:shape[2]:step]
+    coords = np.stack([x.ravel(), y.ravel(), z.ravel()], axis=1) - centre
+    inside = (np.linalg.norm(coords, axis=1) <= min(shape) / 2. if mask is None
+              else mask[::step, ::step, ::step].ravel())
+    coords = coords[inside]
+
+    best = None
+    # generic directions close to the box diagonals, so the asymmetric
+    # unit falls mostly in one octant
+    for sign in np.ndindex(2, 2, 2):
+        direction = (np.array(sign) * 2 - 1) * np.array([1., 0.93, 0.87])
+        direction /= np.linalg.norm(direction)
+        orbit = _getOrbit(matrices, direction)
+        asu = coords[np.argmax(coords @ orbit.T, axis=1) == 0]
+        if not len(asu):
+            continue
+        low = asu.min(axis=0) + centre - padding - step
+        high = asu.max(axis=0) + centre + padding + step + 1
+        box = tuple((int(max(lo, 0)), int(min(hi, dim)))
+                    for lo, hi, dim in zip(low[::-1], high[::-1], shape))
+        box = makeCubicBox(box, shape)
+        size = max(end - start for start, end in box)
+        if best is None or size < best[0]:
+            best = (size, box, direction)
+    return best[1], best[2]
+
+
+def expandAsymmetricUnit(cropFn, outputFn, templateFn, box, matrices,
+                         direction):
+    """ Write a full size map, with the shape, sampling and origin of
+    templateFn, whose voxels are interpolated from their symmetry copies
+    in the asymmetric unit sharpened in cropFn (the region box).
+    """
+    with mrcfile.mmap(templateFn, mode='r', permissive=True) as template:
+        shape = template.data.shape
+        voxelSize = template.voxel_size.copy()
+        origin = template.header.origin.copy()
+    with mrcfile.open(cropFn, mode='r', permissive=True) as crop:
+        cropData = np.asarray(crop.data, dtype=np.float32)
+
+    centre = _getCentre(shape)
+    orbit = _getOrbit(matrices, direction)
+    start = np.array([start for start, _ in box[::-1]], dtype=float)
+    y, x = np.mgrid[0:shape[1], 0:shape[2]]
+    sectionCoords = np.stack([x.ravel(), y.ravel(), np.zeros(x.size)],
+                             axis=1) - centre
+
+    with mrcfile.new_mmap(outputFn, shape=shape, mrc_mode=2,
+                          overwrite=True) as output:
+        for z in range(shape[0]):
+            coords = sectionCoords.copy()
+            coords[:, 2] = z - centre[2]
+            ops = np.argmax(coords @ orbit.T, axis=1)
+            # copy of each voxel in the asymmetric unit, in crop voxels
+            asu = np.einsum('nij,nj->ni', matrices[ops], coords) + centre - start
+            output.data[z] = map_coordinates(
+                cropData, asu[:, ::-1].T, order=1, cval=0.).reshape(shape[1:])
+        output.voxel_size = voxelSize
+        output.header.origin = origin
+        updateHeaderStats(output)
+
+
+def getSymmetryError(fn1, fn2, mask=None):
+    """ Return the relative RMS difference and correlation of two maps
+    inside the sphere of the box (or inside the mask).
+    """
+    with mrcfile.open(fn1, mode='r', permissive=True) as mrc:
+        data1 = np.asarray(mrc.data, dtype=np.float64)
+    with mrcfile.open(fn2, mode='r', permissive=True) as mrc:
+        data2 = np.asarray(mrc.data, dtype=np.float64)
+    if mask is None:
+        z, y, x = np.indices(data1.shape)
+        centre = _getCentre(data1.shape)
+        mask = ((x - centre[0]) ** 2 + (y - centre[1]) ** 2
+                + (z - centre[2]) ** 2) <= (min(data1.shape) / 2.) ** 2
+    data1, data2 = data1[mask], data2[mask]
+    error = np.sqrt(np.mean((data1 - data2) ** 2) / np.mean(data2 ** 2))
+    return float(error), float(np.corrcoef(data1, data2)[0, 1])
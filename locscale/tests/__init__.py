@@ -25,3 +25,4 @@
 # **************************************************************************
 
 from .test_protocol_locscale import TestProtLocscale
+from .test_benchmark_locscale import TestBenchmarkLocscale
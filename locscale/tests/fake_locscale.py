@@ -0,0 +1,130 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Stand-in for the locscale program, used by the benchmarks to measure the
+staging and orchestration done by the plugin without the real LocScale
+environment. It accepts the locscale command line, prints the stages of
+a real run and writes the average of the input maps as output. The
+reference map and mask are read, and must have the box of the input maps.
+
+Simulated costs are read from the environment:
+    FAKE_LOCSCALE_STARTUP: seconds spent importing modules.
+    FAKE_LOCSCALE_MODEL: seconds spent building the model map (skipped
+        when --model_map is given). The model map and refined model are
+        written in processing_files, as LocScale does.
+    FAKE_LOCSCALE_SCALING: seconds per million voxels spent scaling.
+    FAKE_LOCSCALE_MEMORY: bytes per voxel allocated while scaling.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import mrcfile
+
+
+def getCost(name, default=0.):
+    return float(os.environ.get('FAKE_LOCSCALE_%s' % name, default))
+
+
+def main(argv):
+    program = None
+    if argv and not argv[0].startswith('-'):
+        program, argv = argv[0], argv[1:]
+
+    parser = argparse.ArgumentParser(prog='locscale')
+    parser.add_argument('--emmap_path')
+    parser.add_argument('--halfmap_paths', nargs=2)
+    parser.add_argument('--outfile', required=True)
+    parser.add_argument('--model_map')
+    parser.add_argument('--model_coordinates')
+    parser.add_argument('--mask')
+    parser.add_argument('--skip_refine', action='store_true')
+    args, _ = parser.parse_known_args(argv)
+
+    print("Starting locscale %s" % (program or ''), flush=True)
+    time.sleep(getCost('STARTUP'))
+
+    inputFns = args.halfmap_paths or [args.emmap_path]
+    with mrcfile.mmap(inputFns[0], mode='r', permissive=True) as mrc:
+        shape = mrc.data.shape
+        voxelSize = mrc.voxel_size.copy()
+
+    for option, fn in [('--model_map', args.model_map),
+                       ('--mask', args.mask)]:
+        if not fn:
+            continue
+        if not os.path.exists(fn):
+            sys.exit("%s: file %s not found" % (option, fn))
+        with mrcfile.mmap(fn, mode='r', permissive=True) as mrc:
+            if mrc.data.shape != shape:
+                sys.exit("%s: box %s differs from the one of the input maps "
+                         "%s" % (option, mrc.data.shape, shape))
+
+    if args.model_coordinates and not args.model_map:
+        print("Simulating model map from %s" % args.model_coordinates,
+              flush=True)
+        time.sleep(getCost('MODEL'))
+        os.makedirs('processing_files', exist_ok=True)
+        stem = os.path.splitext(os.path.basename(args.model_coordinates))[0]
+        if not args.skip_refine:
+            with open(args.model_coordinates) as fIn, open(os.path.join(
+                    'processing_files', stem + '_servalcat_refined.pdb'),
+                    'w') as fOut:
+                fOut.write(fIn.read())
+        with mrcfile.new(os.path.join('processing_files',
+                                      stem + '_4locscale.mrc'),
+                         overwrite=True) as mrc:
+            mrc.set_data(np.zeros(shape, dtype=np.float32))
+            mrc.voxel_size = voxelSize
+
+    print("Local scaling of %s" % 'x'.join(map(str, shape)), flush=True)
+    buffer = np.ones(int(np.prod(shape) * getCost('MEMORY')), dtype=np.uint8)
+    scalingTime = getCost('SCALING') * np.prod(shape) / 1e6
+    for i in range(0, 101, 25):
+        print("%3d%%|%s| %d/100 [00:00<00:%02d, 1it/s]"
+              % (i, '#' * (i // 10), i, int(scalingTime * (100 - i) / 100)),
+              flush=True)
+        time.sleep(scalingTime / 4 if i < 100 else 0)
+    del buffer
+
+    outputFn = args.outfile
+    if program == 'feature_enhance':
+        outputFn = outputFn.replace('.mrc', '_locscale_output.mrc')
+    with mrcfile.new_mmap(outputFn, shape=shape, mrc_mode=2, fill=0,
+                          overwrite=True) as output:
+        for fn in inputFns:
+            with mrcfile.mmap(fn, mode='r', permissive=True) as mrc:
+                for z in range(shape[0]):
+                    output.data[z] += mrc.data[z] / len(inputFns)
+        output.voxel_size = voxelSize
+    print("Written %s" % outputFn, flush=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
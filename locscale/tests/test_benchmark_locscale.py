@@ -0,0 +1,317 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Offline benchmarks of the staging and orchestration done by the plugin.
+Synthetic maps, half maps, masks and models are generated at several box
+sizes and sharpened with a stand-in locscale program (fake_locscale.py),
+so no LocScale environment or test dataset is needed.
+
+Results are written to a JSON file and compared with the stored baseline
+(benchmark_baseline.json). Environment variables:
+    LOCSCALE_BENCHMARK_BOXES: box sizes to run (default "32 64 128").
+    LOCSCALE_BENCHMARK_RESULTS: results file (default in the project).
+    LOCSCALE_BENCHMARK_UPDATE: if set, store the results as new baseline.
+    FAKE_LOCSCALE_*: simulated costs of the stand-in (see fake_locscale.py).
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import tracemalloc
+
+import numpy as np
+import mrcfile
+import psutil
+
+from pyworkflow.tests import BaseTest, setupTestProject
+from pyworkflow.utils import magentaStr
+from pwem.protocols import ProtImportVolumes, ProtImportPdb, ProtImportMask
+
+from locscale import Plugin, __version__
+from locscale.constants import (LOCSCALE_ENV_ACTIVATION,
+                                LOCSCALE_DEFAULT_VER_NUM, REF_PDB, REF_VOL,
+                                CROP_MASK)
+from locscale.protocols import ProtLocScale
+from locscale.monitor import readStats
+
+BENCHMARK_BOXES = 'LOCSCALE_BENCHMARK_BOXES'
+BENCHMARK_RESULTS = 'LOCSCALE_BENCHMARK_RESULTS'
+BENCHMARK_UPDATE = 'LOCSCALE_BENCHMARK_UPDATE'
+BASELINE_FN = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+
+DEFAULT_BOXES = '32 64 128'
+APIX = 1.2
+PREPARE_PARAMS_CALLS = 100
+FAKE_COSTS = {'FAKE_LOCSCALE_STARTUP': '0.5',
+              'FAKE_LOCSCALE_MODEL': '1',
+              'FAKE_LOCSCALE_SCALING': '0.5',
+              'FAKE_LOCSCALE_MEMORY': '40'}
+# Allowed ratio to the baseline, and absolute differences below which the
+# small cases are not considered regressions (timer and allocator noise)
+TOLERANCES = {'wallTime': (2., 1.),
+              'ioBytes': (1.1, 1024 ** 2),
+              'peakMemory': (1.5, 64 * 1024 ** 2)}
+
+
+def writeSyntheticData(path, box, apix=APIX, seed=0):
+    """ Write a synthetic map made of gaussian atoms, its noisy half maps,
+    a spherical mask and the atomic model. Return a dict with the file names.
+    """
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    coords = rng.uniform(0.25 * box, 0.75 * box, (box ** 3 // 200, 3))
+    density = np.histogramdd(coords[:, ::-1], bins=(box,) * 3,
+                             range=[(0, box)] * 3)[0]
+
+    k = np.fft.fftfreq(box)
+    kx = np.fft.rfftfreq(box)
+    k2 = k[:, None, None] ** 2 + k[None, :, None] ** 2 + kx ** 2
+    sigma = 1.5 / apix  # atoms of 1.5 A
+    ft = np.fft.rfftn(density) * np.exp(-2 * np.pi ** 2 * sigma ** 2 * k2)
+    vol = np.fft.irfftn(ft, s=density.shape).astype(np.float32)
+
+    files = {'map': os.path.join(path, 'map.mrc'),
+             'mask': os.path.join(path, 'mask.mrc'),
+             'pdb': os.path.join(path, 'model.pdb')}
+    mrcfile.write(files['map'], vol, voxel_size=apix, overwrite=True)
+
+    for i in (1, 2):
+        files['half%d' % i] = os.path.join(path, 'half%d.mrc' % i)
+        noise = rng.normal(0, vol.std(), vol.shape).astype(np.float32)
+        mrcfile.write(files['half%d' % i], vol + noise, voxel_size=apix,
+                      overwrite=True)
+
+    r = np.sqrt(((np.indices(vol.shape) - box / 2.) ** 2).sum(axis=0))
+    mrcfile.write(files['mask'], (r < 0.4 * box).astype(np.float32),
+                  voxel_size=apix, overwrite=True)
+
+    with open(files['pdb'], 'w') as f:
+        for i, (x, y, z) in enumerate(coords * apix):
+            f.write("ATOM  %5d  CA  ALA %s%4d    %8.3f%8.3f%8.3f  1.00 20.00"
+                    "           C\n" % (i % 100000, 'ABCDEFGH'[i // 10000 % 8],
+                                        i % 10000, x, y, z))
+        f.write("END\n")
+    return files
+
+
+def writeFakeLocscale(path):
+    """ Install the stand-in locscale program in path and return the
+    command that activates it, in place of the LocScale environment.
+    """
+    binPath = os.path.join(path, 'bin')
+    os.makedirs(binPath, exist_ok=True)
+    program = os.path.join(binPath, 'locscale')
+    fakeFn = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'fake_locscale.py')
+    with open(program, 'w') as f:
+        # a Python script, like the entry point of LocScale
+        f.write('#!%s\nimport runpy\nrunpy.run_path(%r, run_name="__main__")\n'
+                % (sys.executable, fakeFn))
+    os.chmod(program, 0o755)
+
+    activateFn = os.path.join(path, 'activate')
+    with open(activateFn, 'w') as f:
+        f.write('export PATH=%s:$PATH\n' % binPath)
+    # the last word keeps the version of the environment name
+    return 'source %s locscale-%s' % (activateFn, LOCSCALE_DEFAULT_VER_NUM)
+
+
+def getDirSize(path):
+    """ Return the bytes of the files under path, not following links. """
+    size = 0
+    for root, _, files in os.walk(path):
+        for fn in files:
+            fn = os.path.join(root, fn)
+            if not os.path.islink(fn):
+                size += os.path.getsize(fn)
+    return size
+
+
+class Measure:
+    """ Measure wall time, I/O bytes and peak Python memory (which
+    includes the numpy arrays) of the code run in this process.
+    """
+    def __enter__(self):
+        tracemalloc.start()
+        self._io = self._ioBytes()
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.result = {'wallTime': time.time() - self._start,
+                       'ioBytes': self._ioBytes() - self._io,
+                       'peakMemory': tracemalloc.get_traced_memory()[1]}
+        tracemalloc.stop()
+
+    @staticmethod
+    def _ioBytes():
+        counters = psutil.Process().io_counters()
+        # read_chars and write_chars include the page cache (Linux only)
+        return (getattr(counters, 'read_chars', counters.read_bytes) +
+                getattr(counters, 'write_chars', counters.write_bytes))
+
+
+def compareResults(results, baseline):
+    """ Return the regressions of results with respect to the baseline. """
+    regressions = []
+    for case, metrics in sorted(results.items()):
+        for metric, (ratio, minDiff) in TOLERANCES.items():
+            ref = baseline.get(case, {}).get(metric)
+            value = metrics.get(metric)
+            if ref is None or value is None:
+                continue
+            if value > ref * ratio and value - ref > minDiff:
+                regressions.append("%s %s: %s (baseline %s)"
+                                   % (case, metric, value, ref))
+    return regressions
+
+
+class TestBenchmarkLocscale(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.dataPath = os.path.abspath(cls.proj.getTmpPath('benchmark'))
+        # the stand-in replaces LocScale for this test only
+        cls.savedEnviron = {var: os.environ.get(var)
+                            for var in [LOCSCALE_ENV_ACTIVATION, *FAKE_COSTS]}
+        os.environ[LOCSCALE_ENV_ACTIVATION] = writeFakeLocscale(cls.dataPath)
+        Plugin.invalidateCache()
+        Plugin._defineVariables()
+        for var, value in FAKE_COSTS.items():
+            os.environ.setdefault(var, value)
+        cls.results = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        for var, value in cls.savedEnviron.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+        Plugin.invalidateCache()
+        Plugin._defineVariables()
+
+    def importData(self, files):
+        protVol = self.newProtocol(ProtImportVolumes,
+                                   filesPath=files['map'],
+                                   samplingRate=APIX, setHalfMaps=True,
+                                   half1map=files['half1'],
+                                   half2map=files['half2'])
+        self.launchProtocol(protVol)
+        protMask = self.newProtocol(ProtImportMask, maskPath=files['mask'],
+                                    samplingRate=APIX)
+        self.launchProtocol(protMask)
+        protPdb = self.newProtocol(ProtImportPdb, inputPdbData=1,
+                                   pdbFile=files['pdb'])
+        self.launchProtocol(protPdb)
+        return (protVol.outputVolume, protMask.outputMask,
+                protPdb.outputPdb)
+
+    def benchmarkProtocol(self, label, vol, mask, pdb, **kwargs):
+        """ Run the whole protocol and return its metrics. The peak memory
+        is the one of the sharpening program, recorded by the protocol.
+        kwargs override the parameters of the protocol.
+        """
+        # the runs are measured, identical runs are not taken from the
+        # results cache
+        params = dict(inputVolume=vol, refType=REF_PDB, refPdb=pdb,
+                      binaryMask=mask, resol=3., useResultCache=False)
+        params.update(kwargs)
+        prot = self.newProtocol(ProtLocScale, objLabel='benchmark ' + label,
+                                **params)
+        start = time.time()
+        self.launchProtocol(prot)
+        wallTime = time.time() - start
+
+        peakMemory = 0
+        for fn in os.listdir(prot._getExtraPath()):
+            if fn.startswith('stats_'):
+                stats = readStats(prot._getExtraPath(fn))
+                peakMemory = max(peakMemory, stats['peakRss'])
+        self.assertIsNotNone(getattr(prot, 'Volume', None))
+        return prot, {'wallTime': wallTime,
+                      'ioBytes': getDirSize(prot.getWorkingDir()),
+                      'peakMemory': peakMemory}
+
+    def benchmarkBox(self, box):
+        label = 'box%03d' % box
+        print(magentaStr("\n==> Benchmark %s:" % label))
+        files = writeSyntheticData(os.path.join(self.dataPath, label), box)
+        vol, mask, pdb = self.importData(files)
+
+        prot, self.results[label + '/protocol'] = self.benchmarkProtocol(
+            label, vol, mask, pdb)
+        # the model map of the first run is taken from the cache
+        protCached, self.results[label + '/protocolCached'] = \
+            self.benchmarkProtocol(label + ' cached', vol, mask, pdb)
+        self.assertEqual(protCached.modelCacheHits.get(), 1)
+        # cropped inputs are written in the run folder, the reference map
+        # and mask are given to LocScale from there
+        _, self.results[label + '/protocolCropped'] = self.benchmarkProtocol(
+            label + ' cropped', vol, mask, pdb, refType=REF_VOL, refObj=vol,
+            cropMode=CROP_MASK, cropPadding=0)
+
+        # Steps run again in this process, on the finished protocol
+        prot._volsDict = {v.getObjId(): v.clone()
+                          for v in prot._iterInputVols()}
+        prot.useCache.set(False)
+        objId = next(iter(prot._volsDict))
+        with Measure() as m:
+            for i in range(len(prot.getVolInputs(objId))):
+                prot.convertStep(objId, i)
+        self.results[label + '/convertStep'] = m.result
+
+        with Measure() as m:
+            for _ in range(PREPARE_PARAMS_CALLS):
+                prot.prepareParams(objId)
+        self.results[label + '/prepareParams'] = m.result
+
+    def testBenchmark(self):
+        boxes = os.environ.get(BENCHMARK_BOXES, DEFAULT_BOXES)
+        for box in boxes.split():
+            self.benchmarkBox(int(box))
+
+        report = {'version': __version__, 'host': socket.gethostname(),
+                  'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                  'costs': {var: os.environ[var] for var in FAKE_COSTS},
+                  'results': self.results}
+        resultsFn = os.path.abspath(os.environ.get(
+            BENCHMARK_RESULTS, self.proj.getPath('benchmark_results.json')))
+        for fn in [resultsFn] + ([BASELINE_FN] if os.environ.get(
+                BENCHMARK_UPDATE) else []):
+            with open(fn, 'w') as f:
+                json.dump(report, f, indent=1, sort_keys=True)
+        print("Benchmark results written to %s" % resultsFn)
+
+        with open(BASELINE_FN) as f:
+            baseline = json.load(f)
+        if baseline['costs'] != report['costs']:
+            self.skipTest("Simulated costs differ from the baseline ones.")
+        regressions = compareResults(self.results, baseline['results'])
+        self.assertFalse(regressions, "Regressions against the baseline:\n"
+                         + "\n".join(regressions))
@@ -0,0 +1,98 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import subprocess
+import multiprocessing
+
+from locscale.broker import ResourceBroker
+
+
+def _holdAndDie(path):
+    """ Take all the cores and end without releasing them. """
+    broker = ResourceBroker(path, cores=4, memory=10 ** 9)
+    with broker.request(4, 10 ** 6, 'crashed'):
+        os._exit(1)
+
+
+class TestResourceBroker(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'broker')
+        self.broker = ResourceBroker(self.path, cores=4, memory=10 ** 9)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def testGrants(self):
+        with self.broker.request(3, 10 ** 8, 'first') as grant:
+            self.assertLess(grant.waitTime, 1)
+            status = self.broker.getStatus()
+            self.assertEqual([g['label'] for g in status['grants']],
+                             ['first'])
+            # a request that does not fit waits for the first one
+            waited = []
+
+            def _second():
+                with self.broker.request(2, 10 ** 8, 'second') as g:
+                    waited.append(g.waitTime)
+
+            thread = threading.Thread(target=_second)
+            thread.start()
+            thread.join(1.5)
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(len(self.broker.getStatus()['queue']), 1)
+        thread.join()
+        self.assertGreater(waited[0], 1)
+        self.assertEqual(self.broker.getStatus()['grants'], [])
+
+    def testCrashedProcess(self):
+        """ The grant of a process that ended is released. """
+        process = multiprocessing.Process(target=_holdAndDie,
+                                          args=(self.path,))
+        process.start()
+        process.join()
+        self.assertEqual(self.broker.getStatus()['grants'], [])
+        with self.broker.request(4, 10 ** 6) as grant:
+            self.assertLess(grant.waitTime, 1)
+
+    def testAttachedProcess(self):
+        """ The grant is held while an attached process is running. """
+        with self.broker.request(4, 10 ** 6, 'job') as grant:
+            child = subprocess.Popen(['sleep', '30'])
+            grant.attach(child.pid)
+        try:
+            status = self.broker.getStatus()
+            self.assertEqual(len(status['grants']), 1)
+            self.assertEqual(status['grants'][0]['processes'][0][0],
+                             child.pid)
+        finally:
+            child.kill()
+            child.wait()
+        self.assertEqual(self.broker.getStatus()['grants'], [])
@@ -0,0 +1,98 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from locscale.cache import FileCache, fileDigest, fileStatKey, linkOrCopy
+
+
+class TestFileCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.tmpDir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _write(self, name, content):
+        fn = os.path.join(self.tmpDir, name)
+        with open(fn, 'wb') as f:
+            f.write(content)
+        return fn
+
+    def testKeys(self):
+        fn1 = self._write('a.mrc', b'x' * 100)
+        fn2 = self._write('b.mrc', b'x' * 100)
+        self.assertEqual(fileDigest(fn1), fileDigest(fn2))
+        self.assertNotEqual(fileStatKey(fn1), fileStatKey(fn2))
+        cache = FileCache(self.cacheDir, 1000, contentHash=True)
+        self.assertEqual(cache.getKey(fn1), cache.getKey(fn2))
+        self.assertNotEqual(cache.getKey(fn1, 1.5), cache.getKey(fn1, 2))
+
+    def testGetPut(self):
+        cache = FileCache(self.cacheDir, 1000)
+        fn = self._write('a.mrc', b'a' * 100)
+        outputFn = os.path.join(self.tmpDir, 'out.mrc')
+        self.assertFalse(cache.get('key', outputFn))
+        cache.put('key', fn)
+        self.assertTrue(cache.get('key', outputFn))
+        with open(outputFn, 'rb') as f:
+            self.assertEqual(f.read(), b'a' * 100)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.getSize(), (1, 100))
+
+    def testEviction(self):
+        cache = FileCache(self.cacheDir, 250)
+        for i in range(3):
+            cache.put('key%d' % i, self._write('%d.mrc' % i, b'a' * 100))
+        self.assertEqual(cache.getSize(), (2, 200))
+        self.assertFalse(cache.get('key0', os.path.join(self.tmpDir, 'o')))
+
+    def testConcurrentPut(self):
+        """ Threads storing the same key never see a partial file. """
+        cache = FileCache(self.cacheDir, 10 ** 6)
+        fns = [self._write('%d.mrc' % i, bytes([65 + i]) * 1000)
+               for i in range(8)]
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda fn: cache.put('key', fn), fns))
+        outputFn = os.path.join(self.tmpDir, 'out.mrc')
+        self.assertTrue(cache.get('key', outputFn))
+        with open(outputFn, 'rb') as f:
+            content = f.read()
+        self.assertEqual(len(content), 1000)
+        self.assertEqual(len(set(content)), 1)
+        # no temporary files are left behind
+        self.assertEqual(len(os.listdir(self.cacheDir)), 3)
+
+    def testLinkOrCopy(self):
+        fn = self._write('a.mrc', b'a')
+        dst = self._write('b.mrc', b'old')
+        linkOrCopy(fn, dst)
+        self.assertEqual(os.stat(fn).st_ino, os.stat(dst).st_ino)
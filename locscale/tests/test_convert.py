@@ -0,0 +1,130 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import mrcfile
+
+from locscale.convert import (cleanFileName, readMrcHeader, isMrcCompatible,
+                              normalizeVolume, getMaskBox, makeCubicBox,
+                              cropVolume, pasteVolume, canReadFloat16,
+                              MRC_FLOAT16)
+
+
+class TestConvert(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.data = np.random.default_rng(0).normal(
+            size=(10, 12, 14)).astype(np.float32)
+        self.fn = self._write('map.map', self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _write(self, name, data, voxelSize=1.5):
+        fn = os.path.join(self.tmpDir, name)
+        with mrcfile.new(fn, data) as mrc:
+            mrc.voxel_size = voxelSize
+            mrc.header.origin = (1., 2., 3.)
+        return fn
+
+    def testHeader(self):
+        self.assertEqual(cleanFileName(self.fn + ':mrc'), self.fn)
+        header = readMrcHeader(self.fn)
+        self.assertEqual(header['dims'], (14, 12, 10))
+        self.assertEqual(header['mode'], 2)
+        self.assertTrue(isMrcCompatible(self.fn))
+        # truncated data
+        truncatedFn = os.path.join(self.tmpDir, 'truncated.mrc')
+        with open(self.fn, 'rb') as f, open(truncatedFn, 'wb') as out:
+            out.write(f.read()[:-4])
+        self.assertFalse(isMrcCompatible(truncatedFn))
+        notMapFn = os.path.join(self.tmpDir, 'map.txt')
+        with open(notMapFn, 'w') as f:
+            f.write('x' * 2048)
+        self.assertIsNone(readMrcHeader(notMapFn))
+
+    def testNormalize(self):
+        outputFn = os.path.join(self.tmpDir, 'half.mrc')
+        normalizeVolume(self.fn, outputFn, mode=MRC_FLOAT16)
+        with mrcfile.open(outputFn) as mrc:
+            self.assertEqual(mrc.data.dtype, np.float16)
+            np.testing.assert_allclose(mrc.data, self.data, atol=1e-2)
+            self.assertAlmostEqual(float(mrc.voxel_size.x), 1.5)
+        hugeFn = self._write('huge.mrc', self.data * 1e6)
+        with self.assertRaises(ValueError):
+            normalizeVolume(hugeFn, hugeFn, mode=MRC_FLOAT16)
+        # the input is left untouched
+        with mrcfile.open(hugeFn) as mrc:
+            self.assertEqual(mrc.data.dtype, np.float32)
+
+    def testReadFloat16(self):
+        """ The probe agrees with the image library on float16 maps. """
+        from pwem.emlib.image import ImageHandler
+
+        outputFn = os.path.join(self.tmpDir, 'half.mrc')
+        normalizeVolume(self.fn, outputFn, mode=MRC_FLOAT16)
+        try:
+            data = ImageHandler().read(outputFn + ':mrc').getData()
+            readable = np.allclose(data, self.data, atol=1e-2)
+        except Exception:
+            readable = False
+        files = sorted(os.listdir(self.tmpDir))
+        self.assertEqual(canReadFloat16(self.tmpDir), readable)
+        # the probe map is removed
+        self.assertEqual(sorted(os.listdir(self.tmpDir)), files)
+
+    def testMaskBox(self):
+        mask = np.zeros((10, 12, 14), dtype=np.float32)
+        mask[2:5, 3:9, 4:6] = 1
+        maskFn = self._write('mask.mrc', mask)
+        box = getMaskBox(maskFn, padding=1)
+        self.assertEqual(box, ((1, 6), (2, 10), (3, 7)))
+        self.assertEqual(makeCubicBox(box, mask.shape),
+                         ((0, 8), (2, 10), (1, 9)))
+        self.assertIsNone(getMaskBox(self._write('empty.mrc', mask * 0)))
+
+    def testCropPaste(self):
+        box = ((2, 6), (3, 9), (1, 5))
+        cropFn = os.path.join(self.tmpDir, 'crop.mrc')
+        cropVolume(self.fn, cropFn, box)
+        with mrcfile.open(cropFn) as mrc:
+            np.testing.assert_array_equal(mrc.data, self.data[2:6, 3:9, 1:5])
+            # the crop keeps its position in space
+            self.assertAlmostEqual(float(mrc.header.origin.x), 1. + 1.5)
+            self.assertAlmostEqual(float(mrc.header.origin.z), 3. + 3.)
+
+        pastedFn = os.path.join(self.tmpDir, 'pasted.mrc')
+        pasteVolume(cropFn, pastedFn, self.fn, box)
+        expected = np.zeros_like(self.data)
+        expected[2:6, 3:9, 1:5] = self.data[2:6, 3:9, 1:5]
+        with mrcfile.open(pastedFn) as mrc:
+            np.testing.assert_array_equal(mrc.data, expected)
+            self.assertAlmostEqual(float(mrc.header.origin.x), 1.)
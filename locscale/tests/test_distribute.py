@@ -0,0 +1,108 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyworkflow.tests import BaseTest, setupTestProject
+from pwem.protocols import ProtImportVolumes, ProtImportMask
+
+from locscale.constants import REF_VOL, ENGINE_NUMPY
+from locscale.distribute import writePlan, runPlan, getFailedUnits
+from locscale.protocols import ProtLocScale
+from locscale.tests.test_benchmark_locscale import writeSyntheticData, APIX
+
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.planFn = os.path.join(self.tmpDir, 'plan.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testRunPlan(self):
+        units = []
+        for i, command in enumerate(['pwd > out.txt', 'exit 3']):
+            unitDir = os.path.join(self.tmpDir, 'unit%d' % i)
+            os.makedirs(unitDir)
+            units.append({'command': command, 'cwd': unitDir})
+        writePlan(self.planFn, units)
+        self.assertEqual(runPlan(self.planFn), 2)
+        # claimed units are not run again
+        self.assertEqual(runPlan(self.planFn), 0)
+        self.assertEqual(getFailedUnits(self.planFn), [1])
+        with open(os.path.join(units[0]['cwd'], 'out.txt')) as f:
+            self.assertEqual(f.read().strip(),
+                             os.path.realpath(units[0]['cwd']))
+
+
+class TestTileUnits(BaseTest):
+    """ Work units of the tiles run in their own folder, not in the
+    project one.
+    """
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        files = writeSyntheticData(
+            os.path.abspath(cls.proj.getTmpPath('data')), 32)
+        protVol = cls.newProtocol(ProtImportVolumes, filesPath=files['map'],
+                                  samplingRate=APIX)
+        cls.launchProtocol(protVol)
+        protMask = cls.newProtocol(ProtImportMask, maskPath=files['mask'],
+                                   samplingRate=APIX)
+        cls.launchProtocol(protMask)
+        cls.vol, cls.mask = protVol.outputVolume, protMask.outputMask
+
+    def testNumpyEngineUnit(self):
+        prot = self.newProtocol(ProtLocScale, inputVolume=self.vol,
+                                refType=REF_VOL, refObj=self.vol,
+                                binaryMask=self.mask, engine=ENGINE_NUMPY,
+                                resol=3., useResultCache=False)
+        self.launchProtocol(prot)
+
+        # the steps of a tile run again on the finished protocol
+        prot._volsDict = {v.getObjId(): v.clone()
+                          for v in prot._iterInputVols()}
+        objId = next(iter(prot._volsDict))
+        os.makedirs(prot._getTmpPath(), exist_ok=True)
+        prot.convertInputStep('refObj')
+        prot.convertInputStep('binaryMask')
+        prot.convertStep(objId, 0)
+        tileDir = prot._getTileTmpPath(objId, 0)
+        os.makedirs(tileDir, exist_ok=True)
+        inputs = prot.cropInputs(prot.getStagedInputs(objId),
+                                 ((0, 24), (0, 24), (8, 32)), tileDir)
+
+        planFn = os.path.abspath(prot._getVolTmpPath(objId, 'plan.json'))
+        writePlan(planFn, [{'command': prot.getSharpenCommand(objId, inputs),
+                            'cwd': os.path.abspath(tileDir)}])
+        runPlan(planFn)
+        self.assertEqual(getFailedUnits(planFn), [],
+                         "see %s" % os.path.join(tileDir, 'unit.log'))
+        self.assertTrue(os.path.exists(prot.getResultFn(objId, inputs)))
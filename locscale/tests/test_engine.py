@@ -0,0 +1,109 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import mrcfile
+
+from locscale.engine import ShellOperator, runLocalScaling
+
+
+def _fullShells(wn):
+    f = np.fft.fftfreq(wn) * wn
+    return np.round(np.sqrt(f[:, None, None] ** 2 + f[None, :, None] ** 2
+                            + f[None, None, :] ** 2)).astype(int).ravel()
+
+
+def _fullProfile(ft, shells):
+    """ Radial amplitude profile of a full FFT, by brute force. """
+    return (np.bincount(shells, np.abs(ft).ravel())
+            / np.bincount(shells))
+
+
+class TestShellOperator(unittest.TestCase):
+    """ The rfft shortcuts of the engine against full FFTs. """
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.wn = 12
+        self.em = rng.normal(size=(3,) + (self.wn,) * 3)
+        self.ref = rng.normal(size=(3,) + (self.wn,) * 3)
+
+    def testProfile(self):
+        operator = ShellOperator(self.wn)
+        profile = operator.profile(operator.transform(self.em))
+        shells = _fullShells(self.wn)
+        for window, windowProfile in zip(self.em, profile):
+            np.testing.assert_allclose(
+                windowProfile, _fullProfile(np.fft.fftn(window), shells),
+                rtol=1e-5)
+
+    def testScaleCentre(self):
+        operator = ShellOperator(self.wn)
+        centres = operator.scaleCentre(self.em, self.ref)
+        shells = _fullShells(self.wn)
+        c = self.wn // 2
+        for em, ref, centre in zip(self.em, self.ref, centres):
+            emFt, refFt = np.fft.fftn(em), np.fft.fftn(ref)
+            scale = _fullProfile(refFt, shells) / _fullProfile(emFt, shells)
+            scaled = np.fft.ifftn(emFt * scale[shells].reshape(emFt.shape))
+            self.assertAlmostEqual(float(centre), scaled.real[c, c, c],
+                                   delta=1e-4 * np.abs(scaled).max())
+
+
+class TestLocalScaling(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        rng = np.random.default_rng(1)
+        self.em = os.path.join(self.path, 'em.mrc')
+        self.ref = os.path.join(self.path, 'ref.mrc')
+        for fn in (self.em, self.ref):
+            mrcfile.write(fn, rng.normal(size=(16,) * 3).astype(np.float32),
+                          voxel_size=1.)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testConcurrentRuns(self):
+        """ In-process runs in threads, as the steps of a protocol. """
+        def _run(i):
+            outputFn = os.path.join(self.path, 'out%d.mrc' % i)
+            runLocalScaling([self.em], self.ref, outputFn, 1., windowSize=10)
+            with mrcfile.open(outputFn) as mrc:
+                return mrc.data.copy()
+
+        with ThreadPoolExecutor(3) as pool:
+            outputs = list(pool.map(_run, range(3)))
+        for output in outputs[1:]:
+            np.testing.assert_array_equal(output, outputs[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+from locscale import Plugin
+from locscale.environment import resolveEnviron, diffEnviron, applyEnviron
+
+
+class TestEnvironment(unittest.TestCase):
+    def setUp(self):
+        python = os.path.dirname(sys.executable)
+        self.environ = {'PATH': os.pathsep.join(['/scipion/bin', '/old/bin',
+                                                 python, '/usr/bin', '/bin']),
+                        'BAR': 'bar', 'HOME': os.environ.get('HOME', '/')}
+
+    def testResolve(self):
+        """ An activation replacing an entry in the middle of PATH, as conda
+        does from the scipion environment.
+        """
+        activation = ("export PATH=\"${PATH/\\/old\\/bin/\\/env\\/bin}\" && "
+                      "export FOO=foo && unset BAR")
+        changes = resolveEnviron(activation, self.environ)
+        self.assertEqual(changes['paths']['PATH'],
+                         {'add': ['/env/bin'], 'remove': ['/old/bin']})
+        self.assertEqual(changes['set']['FOO'], 'foo')
+        self.assertEqual(changes['unset'], ['BAR'])
+
+    def testApplyAfterOtherChanges(self):
+        """ Entries added to PATH by other environments (CCP4) are kept. """
+        changes = diffEnviron(self.environ, dict(
+            self.environ, PATH=self.environ['PATH'].replace('/old', '/env'),
+            LD_LIBRARY_PATH='/env/lib'))
+        environ = applyEnviron(dict(self.environ, PATH='/ccp4/bin' + os.pathsep
+                                    + self.environ['PATH']), changes)
+        entries = environ['PATH'].split(os.pathsep)
+        self.assertEqual(entries[0], '/env/bin')
+        self.assertIn('/ccp4/bin', entries)
+        self.assertNotIn('/old/bin', entries)
+        self.assertEqual(environ['LD_LIBRARY_PATH'], '/env/lib')
+
+        ccp4 = diffEnviron(environ, dict(environ, PATH='/refmac/bin'
+                                         + os.pathsep + environ['PATH'],
+                                         CCP4='/ccp4'))
+        environ = applyEnviron(environ, ccp4)
+        self.assertEqual(environ['PATH'].split(os.pathsep)[:2],
+                         ['/refmac/bin', '/env/bin'])
+        self.assertEqual(environ['CCP4'], '/ccp4')
+
+    def testLauncherCcp4(self):
+        """ The LocScale environment shadows the CCP4 programs. """
+        base = {'PATH': os.pathsep.join(['/usr/bin', '/bin'])}
+
+        def getEnviron(useCcp4=False):
+            if useCcp4:
+                return dict(base, PATH='/ccp4/bin' + os.pathsep + base['PATH'])
+            return dict(base)
+
+        resolved = diffEnviron(base, dict(
+            base, PATH='/conda/env/bin' + os.pathsep + base['PATH']))
+        with mock.patch.object(Plugin, 'getEnviron', side_effect=getEnviron), \
+                mock.patch.object(Plugin, 'getEnvironFn'), \
+                mock.patch.object(Plugin, 'getActivationCmd'), \
+                mock.patch('locscale.environment.getResolvedEnviron',
+                           return_value=resolved):
+            prefix, environ = Plugin.getLauncher(useCcp4=True)
+        self.assertEqual(prefix, '')
+        self.assertEqual(environ['PATH'].split(os.pathsep),
+                         ['/conda/env/bin', '/ccp4/bin', '/usr/bin', '/bin'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import mrcfile
+
+from locscale.fourier import getFourierCropSize, fourierResizeVolume, getFsc
+
+
+class TestFourier(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _write(self, name, data, voxelSize=1.):
+        fn = os.path.join(self.tmpDir, name)
+        with mrcfile.new(fn, data.astype(np.float32)) as mrc:
+            mrc.voxel_size = voxelSize
+        return fn
+
+    def _lowPassMap(self, n, cutoff):
+        """ Random map without frequencies beyond cutoff (in shells). """
+        ft = np.fft.rfftn(np.random.default_rng(0).normal(size=(n,) * 3))
+        f = np.fft.fftfreq(n) * n
+        fx = np.fft.rfftfreq(n) * n
+        radius = np.sqrt(f[:, None, None] ** 2 + f[None, :, None] ** 2
+                         + fx[None, None, :] ** 2)
+        ft[radius > cutoff] = 0
+        return np.fft.irfftn(ft, s=(n,) * 3)
+
+    def testCropSize(self):
+        # 4 A with a margin of 1.5 needs 1.33 A/px
+        self.assertEqual(getFourierCropSize(64, 0.8, 4.), 40)
+        self.assertIsNone(getFourierCropSize(64, 1.5, 4.))
+
+    def testResize(self):
+        """ Cropping the spectrum of a band limited map and padding it back
+        recovers the map. """
+        data = self._lowPassMap(32, 6)
+        fn = self._write('map.mrc', data)
+        cropFn = os.path.join(self.tmpDir, 'crop.mrc')
+        fourierResizeVolume(fn, cropFn, 16)
+        with mrcfile.open(cropFn) as mrc:
+            self.assertEqual(mrc.data.shape, (16,) * 3)
+            self.assertAlmostEqual(float(mrc.voxel_size.x), 2.)
+            self.assertAlmostEqual(float(mrc.data.mean()), data.mean(),
+                                   places=5)
+        paddedFn = os.path.join(self.tmpDir, 'padded.mrc')
+        fourierResizeVolume(cropFn, paddedFn, 32)
+        with mrcfile.open(paddedFn) as mrc:
+            np.testing.assert_allclose(mrc.data, data, atol=1e-4)
+
+    def testFsc(self):
+        data = self._lowPassMap(24, 12)
+        fn = self._write('map.mrc', data, voxelSize=2.)
+        freqs, fsc = getFsc(fn, fn)
+        self.assertEqual(len(freqs), 13)
+        self.assertAlmostEqual(freqs[-1], 0.25)
+        np.testing.assert_allclose(fsc[1:], 1, atol=1e-5)
+        noiseFn = self._write('noise.mrc', self._lowPassMap(24, 12)[::-1])
+        _, fsc = getFsc(fn, noiseFn)
+        self.assertLess(np.abs(fsc[4:]).max(), 0.5)
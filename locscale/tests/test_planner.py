@@ -0,0 +1,103 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from locscale.planner import (ResourcePlanner, recordRun, readHistory,
+                              MIN_RUNS, MEMORY_MARGIN)
+
+
+class TestResourcePlanner(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.historyFn = os.path.join(self.tmpDir, 'history', 'runs.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _memory(self, voxels, processes, inputBytes):
+        """ Peak memory of the synthetic runs. """
+        return 5e8 + 100 * voxels + 20 * voxels * (processes - 1) + inputBytes
+
+    def testCalibration(self):
+        self.assertFalse(ResourcePlanner(readHistory(self.historyFn))
+                         .isCalibrated())
+        runs = [(v, p) for v in (32 ** 3, 64 ** 3, 128 ** 3)
+                for p in (1, 2, 4)]
+        for voxels, processes in runs:
+            stats = {'peakRss': self._memory(voxels, processes, 4 * voxels),
+                     'wallTime': 10 + 1e-4 * voxels / processes}
+            recordRun(self.historyFn, voxels, processes, 4 * voxels, stats,
+                      version='test')
+        with open(self.historyFn, 'a') as f:
+            f.write('not json\n')
+        history = readHistory(self.historyFn)
+        self.assertEqual(len(history), len(runs))
+        self.assertGreaterEqual(len(history), MIN_RUNS)
+
+        planner = ResourcePlanner(history)
+        self.assertTrue(planner.isCalibrated())
+        voxels = 96 ** 3
+        self.assertAlmostEqual(planner.predictMemory(voxels, 3, 4 * voxels),
+                               self._memory(voxels, 3, 4 * voxels), delta=1e3)
+        self.assertAlmostEqual(planner.predictTime(voxels, 2),
+                               10 + 1e-4 * voxels / 2, delta=1e-3)
+
+    def testPlan(self):
+        planner = ResourcePlanner()
+        voxels = 100 ** 3
+        oneProcess = planner.predictMemory(voxels, 1, 0)
+        # memory for one process per run only
+        memory = 2 * oneProcess / MEMORY_MARGIN * 1.01
+        self.assertEqual(planner.plan(voxels, 0, concurrent=2, cores=8,
+                                      memory=memory), (1, 1))
+        self.assertEqual(planner.plan(voxels, 0, concurrent=2, cores=8,
+                                      memory=1e15), (1, 4))
+        self.assertIsNone(planner.plan(voxels, 0, concurrent=2, cores=8,
+                                       memory=oneProcess))
+        # threads share the maps, so they are preferred to ranks
+        self.assertEqual(planner.plan(voxels, 0, cores=8, memory=1e15,
+                                      maxRanks=4), (1, 8))
+
+    def testPlanRanks(self):
+        """ Ranks are chosen when extra threads cost more memory. """
+        planner = ResourcePlanner()
+        planner.memoryModel = np.array([0., 100., 400., 0.])
+        voxels = 100 ** 3
+        # 4 ranks of a thread fit, a rank of 4 threads does not
+        memory = planner.predictMemory(voxels, 1, 0, ranks=4) / MEMORY_MARGIN
+        self.assertEqual(planner.plan(voxels, 0, cores=4, memory=memory,
+                                      maxRanks=4), (4, 1))
+        # without MPI, a single thread fits
+        self.assertEqual(planner.plan(voxels, 0, cores=4, memory=memory),
+                         (1, 1))
+        self.assertAlmostEqual(planner.predictTime(voxels, 1, ranks=4),
+                               planner.predictTime(voxels, 4))
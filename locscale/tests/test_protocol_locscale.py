@@ -21,11 +21,18 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # ***************************************************************************
 
+import os
+from glob import glob
+
+import numpy as np
+import mrcfile
 from pyworkflow.tests import BaseTest, setupTestProject, DataSet
+from pwem.emlib.image import ImageHandler
 from pwem.protocols import ProtImportVolumes, ProtImportPdb
 from pyworkflow.utils import magentaStr
 
-from locscale.protocols import ProtLocScale
+from locscale.protocols import (ProtLocScale, ProtLocScaleStreaming,
+                                ProtLocScaleSweep)
 
 
 class TestProtLocscale(BaseTest):
@@ -63,17 +70,19 @@ class TestProtLocscale(BaseTest):
         cls.launchProtocol(cls.protImportModel)
 
     def testLocscale(self):
-        def launchTest(label, vol, volRef=None, pdbRef=None, useNN=False):
+        def launchTest(label, vol, volRef=None, pdbRef=None, useNN=False,
+                       engine=0, **kwargs):
             print(magentaStr(f"\n==> Testing locscale ({label}):"))
             pLocScale = self.newProtocol(ProtLocScale,
                                          objLabel='locscale - ' + label,
-                                         inputVolume=vol)
+                                         inputVolume=vol, **kwargs)
             if useNN:
                 pLocScale.useNNpredict.set(True)
             else:
                 if volRef is not None:
                     pLocScale.refType.set(2)
                     pLocScale.refObj.set(volRef)
+                    pLocScale.engine.set(engine)
                 elif pdbRef is not None:
                     pLocScale.refType.set(1)
                     pLocScale.refPdb.set(pdbRef)
@@ -94,6 +103,7 @@ class TestProtLocscale(BaseTest):
                              getattr(pLocScale, outputName).getSamplingRate(),
                              "outputVolume has a different sampling rate than "
                              "inputVol for %s test" % label)
+            return pLocScale
 
         inputVol = self.protImportMap.outputVolume
         pdbRef = self.protImportModel.outputPdb
@@ -101,4 +111,124 @@ class TestProtLocscale(BaseTest):
         #launchTest('noRef', vol=inputVol)  # requires CCP4
         #launchTest('volRef', vol=inputVol, volRef=volRef)  # TODO: test reference volume case
         launchTest('pdbRef', vol=inputVol, pdbRef=pdbRef)
+        launchTest('pdbRef Fourier crop', vol=inputVol, pdbRef=pdbRef,
+                   resol=6, fourierCrop=True, fourierCropCheck=True)
+        # identical to the pdbRef run, which is stored in the results cache
+        pReused = launchTest('pdbRef reused', vol=inputVol, pdbRef=pdbRef)
+        self.assertEqual(pReused.resultCacheHits.get(), 1)
+        # the same run with another atomic model is not taken from it
+        otherModelFn = self.proj.getTmpPath('5ni1_other.pdb')
+        with open(self.model) as f, open(otherModelFn, 'w') as other:
+            other.write("REMARK   1 OTHER MODEL\n" + f.read())
+        protOtherModel = self.newProtocol(ProtImportPdb, inputPdbData=1,
+                                          pdbFile=os.path.abspath(otherModelFn))
+        self.launchProtocol(protOtherModel)
+        pOther = launchTest('pdbRef other model', vol=inputVol,
+                            pdbRef=protOtherModel.outputPdb)
+        self.assertEqual(pOther.resultCacheHits.get(), 0)
+        self.assertEqual(pOther.resultCacheMisses.get(), 1)
+        launchTest('pdbRef scratch', vol=inputVol, pdbRef=pdbRef,
+                   useScratch=True, useResultCache=False)
+        launchTest('pdbRef profiled', vol=inputVol, pdbRef=pdbRef,
+                   useProfiler=True, useResultCache=False)
         launchTest('EMmerNet', vol=inputVol, useNN=True)
+        # the input map as its own reference keeps the NumPy engine fast
+        pHalf = launchTest('volRef NumPy', vol=inputVol, volRef=inputVol,
+                           engine=1, outputFloat16=True)
+        # the registered float16 output is read by the image library
+        outputVol = getattr(pHalf, ProtLocScale._possibleOutputs.Volume.name)
+        with mrcfile.open(outputVol.getFileName()) as mrc:
+            np.testing.assert_allclose(
+                ImageHandler().read(outputVol).getData(), mrc.data,
+                atol=1e-3)
+        # global B-factor with FSC weighting of the half maps, in-process
+        pGlobal = launchTest('quick global', vol=inputVol,
+                             globalSharpening=True)
+        self.assertTrue(glob(pGlobal._getExtraPath('global_*.json')),
+                        "The global sharpening report was not written")
+
+    def runImportSet(self):
+        print(magentaStr("\n==> Importing data - set of volumes:"))
+        protImportSet = self.newProtocol(ProtImportVolumes,
+                                         filesPath=self.ds.getFile('volumes'),
+                                         filesPattern='emd_3488_Noisy_half*.vol',
+                                         samplingRate=1.05)
+        self.launchProtocol(protImportSet)
+        return protImportSet.outputVolumes
+
+    def testLocscaleBatch(self):
+        inputSet = self.runImportSet()
+
+        print(magentaStr("\n==> Testing locscale (batch):"))
+        pLocScale = self.newProtocol(ProtLocScale,
+                                     objLabel='locscale - batch',
+                                     inputVolume=inputSet,
+                                     refType=1,
+                                     refPdb=self.protImportModel.outputPdb,
+                                     numberOfThreads=3)
+        self.launchProtocol(pLocScale, wait=True)
+        outputName = ProtLocScale._possibleOutputs.Volumes.name
+        outputSet = getattr(pLocScale, outputName)
+        self.assertIsNotNone(outputSet, "outputVolumes is None for batch test")
+        self.assertEqual(inputSet.getSize(), outputSet.getSize())
+        self.assertEqual(inputSet.getDim(), outputSet.getDim())
+        self.assertEqual(inputSet.getSamplingRate(),
+                         outputSet.getSamplingRate())
+
+    def testLocscaleAutoResources(self):
+        inputSet = self.runImportSet()
+
+        print(magentaStr("\n==> Testing locscale (automatic resources):"))
+        pLocScale = self.newProtocol(ProtLocScale,
+                                     objLabel='locscale - auto resources',
+                                     inputVolume=inputSet,
+                                     refType=1,
+                                     refPdb=self.protImportModel.outputPdb,
+                                     autoResources=True,
+                                     numberOfThreads=3)
+        self.launchProtocol(pLocScale, wait=True)
+        outputName = ProtLocScale._possibleOutputs.Volumes.name
+        self.assertEqual(inputSet.getSize(),
+                         getattr(pLocScale, outputName).getSize())
+        self.assertTrue(os.path.exists(pLocScale.getHistoryFn()),
+                        "The resources of the runs were not recorded")
+
+    def testLocscaleStreaming(self):
+        inputSet = self.runImportSet()
+
+        print(magentaStr("\n==> Testing locscale (streaming):"))
+        pLocScale = self.newProtocol(ProtLocScaleStreaming,
+                                     objLabel='locscale - streaming',
+                                     inputVolume=inputSet,
+                                     refType=1,
+                                     refPdb=self.protImportModel.outputPdb,
+                                     numberOfThreads=3)
+        self.launchProtocol(pLocScale, wait=True)
+        outputName = ProtLocScaleStreaming._possibleOutputs.Volumes.name
+        outputSet = getattr(pLocScale, outputName)
+        self.assertIsNotNone(outputSet,
+                             "outputVolumes is None for streaming test")
+        self.assertEqual(inputSet.getSize(), outputSet.getSize())
+        self.assertTrue(outputSet.isStreamClosed())
+
+    def testLocscaleSweep(self):
+        print(magentaStr("\n==> Testing locscale (parameter sweep):"))
+        pLocScale = self.newProtocol(ProtLocScaleSweep,
+                                     objLabel='locscale - sweep',
+                                     inputVolume=self.protImportMap.outputVolume,
+                                     refType=1,
+                                     refPdb=self.protImportModel.outputPdb,
+                                     sweepResol='3 4 3',
+                                     sweepSymmetry='c1 d7',
+                                     numberOfThreads=3)
+        self.launchProtocol(pLocScale, wait=True)
+        outputName = ProtLocScaleSweep._possibleOutputs.Volumes.name
+        outputSet = getattr(pLocScale, outputName)
+        # the repeated resolution is a single variant
+        self.assertEqual(4, outputSet.getSize())
+        self.assertEqual(['3 A, C1, no mask', '3 A, D7, no mask',
+                          '4 A, C1, no mask', '4 A, D7, no mask'],
+                         [vol.getObjLabel() for vol in outputSet])
+        self.assertEqual(4, len({vol.getFileName() for vol in outputSet}))
+        # each resolution generates its model map once
+        self.assertEqual(2, pLocScale.modelCacheHits.get())
@@ -0,0 +1,81 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from locscale.results import ResultIndex, getFingerprint
+
+
+class TestResultIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.index = ResultIndex(os.path.join(self.tmpDir, 'results'), 250)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _write(self, name, size=100):
+        fn = os.path.join(self.tmpDir, name)
+        with open(fn, 'wb') as f:
+            f.write(b'a' * size)
+        return fn
+
+    def testFingerprint(self):
+        params = {'resol': 3., 'mpi': 1}
+        fingerprint = getFingerprint(['a', 'b'], params)
+        self.assertEqual(fingerprint,
+                         getFingerprint(('a', 'b'), {'mpi': 1, 'resol': 3.}))
+        self.assertNotEqual(fingerprint, getFingerprint(['b', 'a'], params))
+        self.assertNotEqual(fingerprint,
+                            getFingerprint(['a', 'b'], dict(params, resol=4.)))
+
+    def testGetPut(self):
+        outputFn = os.path.join(self.tmpDir, 'out.mrc')
+        self.assertIsNone(self.index.get('f1', outputFn))
+        self.index.put('f1', self._write('run1.mrc'), {'wallTime': 60.},
+                       version='2.2', params={'resol': 3.})
+        record = self.index.get('f1', outputFn)
+        self.assertEqual(record['version'], '2.2')
+        self.assertTrue(os.path.exists(outputFn))
+        self.assertEqual([r['hits'] for r in self.index.query()], [1])
+        self.assertEqual(self.index.query(version='other'), [])
+        with self.assertRaises(ValueError):
+            self.index.query(unknown=1)
+        report = self.index.getReport()
+        self.assertEqual((report['runs'], report['hits'],
+                          report['savedTime']), (1, 1, 60.))
+
+    def testEviction(self):
+        for i in range(3):
+            self.index.put('f%d' % i, self._write('run%d.mrc' % i))
+            self.index.get('f%d' % i, os.path.join(self.tmpDir, 'out.mrc'))
+        self.assertEqual(sorted(r['fingerprint'] for r in self.index.query()),
+                         ['f1', 'f2'])
+        self.assertEqual(len([fn for fn in os.listdir(self.index.path)
+                              if fn.endswith('.mrc')]), 2)
@@ -0,0 +1,99 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from locscale import scratch
+
+
+class TestScratch(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.scratchDir = os.path.join(self.tmpDir, 'scratch', 'run', 'vol')
+        self.targetDir = os.path.join(self.tmpDir, 'target')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _write(self, fn, content='x'):
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn, 'w') as f:
+            f.write(content)
+        return fn
+
+    def testStage(self):
+        self._write(os.path.join(self.scratchDir, 'old.mrc'))
+        scratch.createDir(self.scratchDir)
+        self.assertEqual(os.listdir(self.scratchDir), [])
+        inputFn = self._write(os.path.join(self.tmpDir, 'map.mrc'), 'map')
+        linkFn = os.path.join(self.tmpDir, 'link.mrc')
+        os.symlink(inputFn, linkFn)
+        stagedFn, = scratch.stageFiles([linkFn], self.scratchDir)
+        self.assertFalse(os.path.islink(stagedFn))
+        with open(stagedFn) as f:
+            self.assertEqual(f.read(), 'map')
+
+    def testCopyBack(self):
+        scratch.createDir(self.scratchDir)
+        self._write(os.path.join(self.scratchDir, 'out.mrc'))
+        self._write(os.path.join(self.scratchDir, 'logs', 'run.log'))
+        self._write(os.path.join(self.scratchDir, 'big.tmp'))
+        scratch.copyBack(self.scratchDir, self.targetDir,
+                         ['*.mrc', 'logs'])
+        scratch.waitCopies()
+        self.assertTrue(os.path.exists(os.path.join(self.targetDir,
+                                                    'out.mrc')))
+        self.assertTrue(os.path.exists(os.path.join(self.targetDir, 'logs',
+                                                    'run.log')))
+        self.assertFalse(os.path.exists(os.path.join(self.targetDir,
+                                                     'big.tmp')))
+        # the scratch folder and its empty parent are removed
+        self.assertFalse(os.path.exists(os.path.dirname(self.scratchDir)))
+
+    def testCopyBackError(self):
+        scratch.createDir(self.scratchDir)
+        self._write(os.path.join(self.scratchDir, 'out.mrc'))
+        # the target is a file, so its folder cannot be created
+        self._write(self.targetDir)
+        scratch.copyBack(self.scratchDir, os.path.join(self.targetDir, 'x'),
+                         ['*.mrc'])
+        with self.assertRaises(OSError):
+            scratch.waitCopies()
+        scratch.waitCopies()  # errors are reported once
+
+    def testCopyBackErrorOwner(self):
+        # the error is only reported to the owner of the target folder
+        scratch.createDir(self.scratchDir)
+        self._write(os.path.join(self.scratchDir, 'out.mrc'))
+        self._write(self.targetDir)
+        scratch.copyBack(self.scratchDir, os.path.join(self.targetDir, 'x'),
+                         ['*.mrc'])
+        scratch.waitCopies(os.path.join(self.tmpDir, 'other'))
+        with self.assertRaises(OSError):
+            scratch.waitCopies(self.targetDir)
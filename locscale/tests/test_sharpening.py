@@ -0,0 +1,149 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import mrcfile
+
+from locscale.sharpening import (getShells, getFscResolution, fitBfactor,
+                                 getSharpeningFilter, globalSharpen)
+
+BOX = 64
+APIX = 1.
+BFACTOR = 100.
+
+
+class TestSharpeningFunctions(unittest.TestCase):
+    """ The pure functions of the global sharpening. """
+    def testShells(self):
+        shells, nShells = getShells((8, 10, 12))
+        self.assertEqual(shells.shape, (8, 10, 7))
+        self.assertEqual(nShells, 7)
+        self.assertEqual(shells[0, 0, 0], 0)
+        # frequencies scaled to the largest side
+        self.assertEqual(shells[1, 0, 0], round(12 / 8))
+        self.assertEqual(shells[0, 0, 6], 6)
+        # corners beyond Nyquist are in the extra shell
+        self.assertEqual(shells[4, 5, 6], nShells)
+
+    def testFscResolution(self):
+        freqs = np.linspace(0, 0.5, 11)
+        fsc = np.clip(1.2 - 4 * freqs, 0, 1)
+        # crosses 0.143 at s = 0.26425
+        self.assertAlmostEqual(getFscResolution(freqs, fsc), 1 / 0.26425,
+                               places=6)
+        self.assertIsNone(getFscResolution(freqs, np.ones(11)))
+
+    def testFitBfactor(self):
+        freqs = np.linspace(0, 0.5, 50)
+        amplitudes = 3. * np.exp(-80. * freqs ** 2 / 4)
+        amplitudes[freqs > 1 / 3.] = 0
+        self.assertAlmostEqual(fitBfactor(freqs, amplitudes, 10., 3.), 80.)
+        with self.assertRaises(ValueError):
+            fitBfactor(freqs, amplitudes, 3.1, 3.)
+
+    def testFilter(self):
+        freqs = np.linspace(0, 0.5, 51)
+        sharpen = getSharpeningFilter(freqs, -80., 4., 0.03)
+        # the sharpening B-factor restores the decay up to the low-pass
+        np.testing.assert_allclose(sharpen[:20], np.exp(20. * freqs[:20] ** 2))
+        self.assertAlmostEqual(sharpen[40], 0.)
+        weighted = getSharpeningFilter(freqs, -80., 4., 0.03,
+                                       weights=np.full(51, 0.5))
+        np.testing.assert_allclose(weighted, sharpen * 0.5)
+
+
+def _decayedNoise(rng):
+    """ Map of white noise whose amplitudes decay with BFACTOR. """
+    ft = np.fft.rfftn(rng.normal(size=(BOX,) * 3))
+    f = np.fft.fftfreq(BOX, APIX)
+    fx = np.fft.rfftfreq(BOX, APIX)
+    s2 = f[:, None, None] ** 2 + f[None, :, None] ** 2 + fx[None, None, :] ** 2
+    return np.fft.irfftn(ft * np.exp(-BFACTOR * s2 / 4), s=(BOX,) * 3)
+
+
+def _shellAmplitudes(data):
+    shells, nShells = getShells(data.shape)
+    power = np.abs(np.fft.rfftn(data)) ** 2
+    return np.sqrt(np.bincount(shells.ravel(), power.ravel())[:nShells]
+                   / np.bincount(shells.ravel())[:nShells])
+
+
+class TestGlobalSharpen(unittest.TestCase):
+    """ Sharpening of synthetic maps with a known B-factor. """
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.rng = np.random.default_rng(0)
+        self.outputFn = os.path.join(self.tmpDir, 'sharpened.mrc')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _write(self, name, data):
+        fn = os.path.join(self.tmpDir, name)
+        with mrcfile.new(fn, data.astype(np.float32)) as mrc:
+            mrc.voxel_size = APIX
+        return fn
+
+    def testBfactor(self):
+        """ The fitted B-factor is the decay of the map, positive, and the
+        map is sharpened with its opposite, which flattens the spectrum. """
+        mapFn = self._write('map.mrc', _decayedNoise(self.rng))
+        report = globalSharpen([mapFn], self.outputFn, APIX, 3.)
+        self.assertAlmostEqual(report['fittedBfactor'], BFACTOR,
+                               delta=0.05 * BFACTOR)
+        self.assertEqual(report['bfactor'], -report['fittedBfactor'])
+        self.assertFalse(report['halfMaps'])
+        with mrcfile.open(self.outputFn) as mrc:
+            amplitudes = _shellAmplitudes(mrc.data)
+        freqs = np.arange(len(amplitudes)) / (BOX * APIX)
+        flat = amplitudes[(freqs >= 0.1) & (freqs <= 0.3)]
+        self.assertLess(flat.max() / flat.min(), 1.2)
+        # low-passed beyond the resolution
+        self.assertLess(amplitudes[freqs > 0.4].max(), 1e-3 * flat.min())
+
+        # a given B-factor is used as is
+        report = globalSharpen([mapFn], self.outputFn, APIX, 3.,
+                               bfactor=-50.)
+        self.assertEqual(report['bfactor'], -50.)
+
+    def testHalfMaps(self):
+        """ Half maps with the same signal and independent noise, whose
+        FSC crosses 0.143 at 4 A. """
+        signal = _decayedNoise(self.rng)
+        # signal to noise power of 0.143 / 0.857 at 1/4 A
+        noise = 1. / np.sqrt(0.143 / 0.857 * np.exp(BFACTOR / 4 ** 2 / 2))
+        halfFns = [self._write('half%d.mrc' % i, signal
+                               + self.rng.normal(0, noise, signal.shape))
+                   for i in (1, 2)]
+        report = globalSharpen(halfFns, self.outputFn, APIX, 3.)
+        self.assertTrue(report['halfMaps'])
+        self.assertAlmostEqual(report['fscResolution'], 4., delta=0.2)
+        self.assertLess(report['bfactor'], 0)
@@ -0,0 +1,85 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import mrcfile
+
+from locscale.symmetry import (getSymmetryMatrices, getAsymmetricUnitBox,
+                               expandAsymmetricUnit, getSymmetryError)
+
+
+class TestSymmetry(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _write(self, name, data):
+        fn = os.path.join(self.tmpDir, name)
+        with mrcfile.new(fn, data.astype(np.float32)) as mrc:
+            mrc.voxel_size = 1.
+        return fn
+
+    def testGroups(self):
+        for group, order in [('c1', 1), ('C4', 4), ('d7', 14), ('t', 12),
+                             ('o', 24), ('i', 60)]:
+            matrices = getSymmetryMatrices(group)
+            self.assertEqual(len(matrices), order)
+            for m in matrices:
+                np.testing.assert_allclose(m @ m.T, np.eye(3), atol=1e-8)
+                self.assertAlmostEqual(np.linalg.det(m), 1.)
+        for group in ('x2', 'c0', ''):
+            with self.assertRaises(ValueError):
+                getSymmetryMatrices(group)
+
+    def testExpand(self):
+        """ The asymmetric unit of a symmetric map expands to the map. """
+        n = 24
+        z, y, x = np.indices((n,) * 3) - n // 2
+        # D2 symmetric: even in the three coordinates
+        data = np.exp(-((np.abs(x) - 5) ** 2 + (y ** 2) / 4
+                        + (np.abs(z) - 3) ** 2) / 8.)
+        fn = self._write('map.mrc', data)
+        matrices = getSymmetryMatrices('d2')
+        box, direction = getAsymmetricUnitBox(data.shape, matrices,
+                                              padding=2)
+        sizes = [end - start for start, end in box]
+        self.assertLess(sizes[0], n)
+        self.assertEqual(len(set(sizes)), 1)
+
+        (z0, z1), (y0, y1), (x0, x1) = box
+        cropFn = self._write('crop.mrc', data[z0:z1, y0:y1, x0:x1])
+        outputFn = os.path.join(self.tmpDir, 'expanded.mrc')
+        expandAsymmetricUnit(cropFn, outputFn, fn, box, matrices, direction)
+        error, correlation = getSymmetryError(outputFn, fn)
+        self.assertLess(error, 1e-3)
+        self.assertGreater(correlation, 0.999)
@@ -0,0 +1,117 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import mrcfile
+
+from locscale.tiling import TileGrid, getTileSize, stitchTiles
+
+
+class TestTileGrid(unittest.TestCase):
+    """ Tile layout and feathering weights. """
+    def testCoverage(self):
+        grid = TileGrid((40, 50, 70), 32, 12)
+        for axis, n in enumerate(grid.shape):
+            tiles = grid._axisTiles[axis]
+            self.assertEqual(tiles[0][0], 0)
+            self.assertEqual(sum(tiles[-1]), n)
+            for (s0, n0), (s1, _) in zip(tiles, tiles[1:]):
+                self.assertGreaterEqual(s0 + n0 - s1, 12)
+
+    def testWeights(self):
+        margin = 4
+        grid = TileGrid((40, 50, 70), 32, 12, margin=margin)
+        for axis, n in enumerate(grid.shape):
+            tiles = grid._axisTiles[axis]
+            total = np.zeros(n)
+            for k, ((start, size), w) in enumerate(
+                    zip(tiles, grid._axisWeights(axis))):
+                total[start:start + size] += w
+                # the voxels close to an inner edge are not used
+                if k > 0:
+                    np.testing.assert_array_equal(w[:margin], 0)
+                if k < len(tiles) - 1:
+                    np.testing.assert_array_equal(w[-margin:], 0)
+            np.testing.assert_allclose(total, 1)
+
+    def testTileSize(self):
+        size = getTileSize(64 ** 3 * 100, 100)
+        self.assertEqual(size, 64)
+        self.assertEqual(getTileSize(10, 100), 64)
+
+
+class TestStitchTiles(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _write(self, name, data):
+        fn = os.path.join(self.tmpDir, name)
+        with mrcfile.new(fn, data.astype(np.float32)) as mrc:
+            mrc.voxel_size = 1.5
+        return fn
+
+    def testStitch(self):
+        """ Tiles cut from a map are stitched back to the map, ignoring
+        the corrupted margins of the tiles. """
+        volume = np.random.default_rng(0).normal(size=(30, 40, 36))
+        templateFn = self._write('volume.mrc', volume)
+        margin = 3
+        grid = TileGrid(volume.shape, 20, 10, margin=margin)
+        tileFns = []
+        for i, ((z0, z1), (y0, y1), (x0, x1)) in enumerate(grid.boxes):
+            tile = volume[z0:z1, y0:y1, x0:x1].copy()
+            # values at the borders depend on the tile, like the window
+            # of the sharpening of the border voxels
+            inner = tile[margin:-margin, margin:-margin, margin:-margin]
+            corrupted = np.full_like(tile, 100.)
+            corrupted[margin:-margin, margin:-margin, margin:-margin] = inner
+            border = [(z0 == 0, z1 == volume.shape[0]),
+                      (y0 == 0, y1 == volume.shape[1]),
+                      (x0 == 0, x1 == volume.shape[2])]
+            for axis, (first, last) in enumerate(border):
+                # the edges of the map are not tile edges
+                index = [slice(None)] * 3
+                if first:
+                    index[axis] = slice(0, margin)
+                    corrupted[tuple(index)] = tile[tuple(index)]
+                if last:
+                    index[axis] = slice(-margin, None)
+                    corrupted[tuple(index)] = tile[tuple(index)]
+            tileFns.append(self._write('tile_%d.mrc' % i, corrupted))
+
+        outputFn = os.path.join(self.tmpDir, 'output.mrc')
+        stitchTiles(grid, tileFns, outputFn, templateFn)
+        with mrcfile.open(outputFn) as mrc:
+            np.testing.assert_allclose(mrc.data, volume, atol=1e-5)
+            self.assertAlmostEqual(float(mrc.voxel_size.x), 1.5)
@@ -0,0 +1,145 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Split large maps in overlapping tiles that are sharpened independently
+and stitched back with cosine feathered overlaps.
+"""
+
+import itertools
+
+import numpy as np
+import mrcfile
+
+from locscale.convert import updateHeaderStats
+
+
+def getTileSize(memory, bytesPerVoxel, minSize=64):
+    """ Return the (even) size of cubic tiles that fit in memory (bytes). """
+    size = int((memory / bytesPerVoxel) ** (1. / 3))
+    size = max(size, minSize)
+    return size - size % 2
+
+
+class TileGrid:
+    """ Regular grid of overlapping cubic tiles covering a volume. """
+    def __init__(self, shape, tileSize, overlap, margin=0):
+        """
+        Params:
+            shape: (nz, ny, nx) of the volume.
+            tileSize: size of the tiles in voxels.
+            overlap: minimum overlap between neighbour tiles, in voxels.
+            margin: voxels at the inner edges of the tiles that are not
+                used, usually half the sharpening window, whose values
+                depend on the tile border. The overlap should be larger
+                than twice the margin.
+        """
+        self.shape = tuple(shape)
+        self.overlap = overlap
+        self.margin = margin
+        self._axisTiles = [self._axisStarts(n, tileSize, overlap)
+                           for n in self.shape]
+        self.boxes = [tuple((s, s + size) for s, size in tile)
+                      for tile in itertools.product(*self._axisTiles)]
+
+    @staticmethod
+    def _axisStarts(n, tileSize, overlap):
+        """ Return the (start, size) of the tiles along an axis, evenly
+        distributed so the overlap is at least the requested one.
+        """
+        size = min(tileSize, n)
+        if size == n:
+            return [(0, n)]
+        step = max(size - overlap, 1)
+        nTiles = -(-(n - size) // step) + 1
+        starts = np.round(np.linspace(0, n - size, nTiles)).astype(int)
+        return [(int(s), size) for s in starts]
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def _blendRange(self, previous, tile):
+        """ Return the first and last (excluded) voxels where two neighbour
+        tiles are blended: their overlap without the margin on each side.
+        """
+        first = tile[0] + self.margin
+        last = previous[0] + previous[1] - self.margin
+        return first, max(last, first + 1)
+
+    def _axisWeights(self, axis):
+        """ Return the normalised feathering weights of the tiles along
+        an axis. Weights are zero in the margin of the inner edges, ramp
+        with a squared cosine in the rest of the overlap with each
+        neighbour and add up to one at every voxel.
+        """
+        tiles = self._axisTiles[axis]
+        weights = []
+        for k, (start, size) in enumerate(tiles):
+            w = np.ones(size)
+            if k > 0:
+                first, last = self._blendRange(tiles[k - 1], tiles[k])
+                t = (np.arange(last - first) + 0.5) / (last - first)
+                w[:first - start] = 0
+                w[first - start:last - start] *= np.sin(t * np.pi / 2) ** 2
+            if k < len(tiles) - 1:
+                first, last = self._blendRange(tiles[k], tiles[k + 1])
+                t = (np.arange(last - first) + 0.5) / (last - first)
+                w[first - start:last - start] *= np.cos(t * np.pi / 2) ** 2
+                w[last - start:] = 0
+            weights.append(w)
+
+        total = np.zeros(self.shape[axis])
+        for (start, size), w in zip(tiles, weights):
+            total[start:start + size] += w
+        return [w / total[start:start + size]
+                for (start, size), w in zip(tiles, weights)]
+
+    def getWeights(self):
+        """ Return, for every tile, its (wz, wy, wx) weights. """
+        axisWeights = [self._axisWeights(axis) for axis in range(3)]
+        return list(itertools.product(*axisWeights))
+
+
+def stitchTiles(grid, tileFns, outputFn, templateFn):
+    """ Stitch the sharpened tiles into a memory-mapped output map with
+    the header of templateFn. Only one tile section is in memory at a time.
+    """
+    with mrcfile.mmap(templateFn, mode='r', permissive=True) as template:
+        voxelSize = template.voxel_size.copy()
+        origin = template.header.origin.copy()
+
+    with mrcfile.new_mmap(outputFn, shape=grid.shape, mrc_mode=2,
+                          fill=0, overwrite=True) as output:
+        for box, (wz, wy, wx), tileFn in zip(grid.boxes, grid.getWeights(),
+                                            tileFns):
+            (z0, z1), (y0, y1), (x0, x1) = box
+            wyx = np.outer(wy, wx).astype(np.float32)
+            with mrcfile.mmap(tileFn, mode='r', permissive=True) as tile:
+                for z in range(z0, z1):
+                    output.data[z, y0:y1, x0:x1] += (tile.data[z - z0] * wyx
+                                                     * np.float32(wz[z - z0]))
+        output.voxel_size = voxelSize
+        output.header.origin = origin
+        updateHeaderStats(output)
@@ -0,0 +1,262 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Long-lived LocScale worker. It runs inside the LocScale environment,
+imports the heavy modules once and listens on a Unix socket:
+
+    python worker.py --socket /tmp/locscale.sock
+
+Every job is run in a child forked from the warm worker, so jobs from
+several protocols run concurrently and isolated from each other. The
+output of the job is streamed back through the socket, followed by
+its exit code. Every job runs in its own process group, which is killed
+when the client disconnects (e.g. the protocol is stopped).
+
+TensorFlow is not preloaded: its thread pools and CUDA context do not
+survive a fork, so EMmerNet jobs import it (and load their model) in
+the forked child, as a run outside the worker does.
+
+Only the standard library is used here, since this module runs with the
+python of the LocScale environment and is also imported by the plugin
+as the client side.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import argparse
+import importlib
+import threading
+import traceback
+
+EXIT_MARK = '\0EXIT '
+PID_MARK = '\0PID '
+# only modules that are safe to fork, see the module docstring
+PRELOAD_MODULES = ['numpy', 'scipy', 'mrcfile', 'gemmi', 'sklearn',
+                   'locscale']
+DEFAULT_IDLE_TIMEOUT = 3600  # seconds
+REAP_INTERVAL = 10  # seconds between checks of the running jobs
+KILL_GRACE = 10  # seconds between SIGTERM and SIGKILL of a dropped job
+
+
+# --------------------------- client side -------------------------------------
+def sendRequest(socketFn, request, timeout=None):
+    """ Send a request and return the connected socket. """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    conn.connect(socketFn)
+    conn.sendall((json.dumps(request) + '\n').encode())
+    return conn
+
+
+def isAlive(socketFn):
+    """ Return True if a worker answers on the socket. """
+    try:
+        with sendRequest(socketFn, {'command': 'ping'}, timeout=5) as conn:
+            return conn.makefile().readline().strip() == 'pong'
+    except OSError:
+        return False
+
+
+def stopWorker(socketFn):
+    """ Ask the worker to exit. Running jobs are not interrupted. """
+    if isAlive(socketFn):
+        sendRequest(socketFn, {'command': 'stop'}, timeout=5).close()
+
+
+def runJob(socketFn, argv, cwd, env=None, output=sys.stdout, onStart=None):
+    """ Run a LocScale job in the worker.
+    Params:
+        argv: command line arguments of the locscale program.
+        cwd: working directory of the job.
+        env: variables added to the worker environment. PATH entries
+            are prepended to the worker PATH.
+        output: file where the job output is written.
+        onStart: function called with the pid of the job when it starts.
+    Return:
+        exit code of the job.
+    """
+    request = {'command': 'run', 'argv': argv, 'cwd': cwd, 'env': env or {}}
+    with sendRequest(socketFn, request) as conn:
+        for line in conn.makefile(errors='replace'):
+            if line.startswith(EXIT_MARK):
+                return int(line[len(EXIT_MARK):])
+            if line.startswith(PID_MARK):
+                if onStart is not None:
+                    onStart(int(line[len(PID_MARK):]))
+                continue
+            output.write(line)
+            output.flush()
+    # the job died without reporting its exit code
+    return -1
+
+
+# --------------------------- worker side -------------------------------------
+def getEntryPoint(name='locscale'):
+    """ Return the function of the console script 'name'. """
+    from importlib import metadata
+    entryPoints = metadata.entry_points()
+    if hasattr(entryPoints, 'select'):
+        entryPoints = entryPoints.select(group='console_scripts')
+    else:
+        entryPoints = entryPoints.get('console_scripts', [])
+    for ep in entryPoints:
+        if ep.name == name:
+            return ep.load()
+    raise Exception("Console script %s not found" % name)
+
+
+def preload(modules):
+    """ Import the heavy modules once, before forking the jobs. """
+    for module in modules:
+        t = time.time()
+        try:
+            importlib.import_module(module)
+            print("Preloaded %s in %.1f s" % (module, time.time() - t))
+        except ImportError as e:
+            print("Could not preload %s: %s" % (module, e))
+    sys.stdout.flush()
+
+
+def _watchClient(conn):
+    """ Kill the process group of the job when the client disconnects. """
+    try:
+        while conn.recv(1024):
+            pass
+    except OSError:
+        pass
+    os.killpg(0, signal.SIGTERM)
+    time.sleep(KILL_GRACE)
+    os.killpg(0, signal.SIGKILL)
+
+
+def _runChild(conn, request, entryPoint):
+    """ Run a job in the forked child and report its exit code. """
+    os.setpgid(0, 0)
+    threading.Thread(target=_watchClient, args=(conn,), daemon=True).start()
+    os.dup2(conn.fileno(), 1)
+    os.dup2(conn.fileno(), 2)
+    os.write(1, ('%s%d\n' % (PID_MARK, os.getpid())).encode())
+    code = 0
+    try:
+        os.chdir(request['cwd'])
+        for key, value in request['env'].items():
+            if key == 'PATH':
+                value = value + os.pathsep + os.environ.get('PATH', '')
+            os.environ[key] = value
+        sys.argv = ['locscale'] + request['argv']
+        entryPoint()
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            code = e.code
+        else:
+            code = 0 if e.code is None else 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.write(1, ('\n%s%d\n' % (EXIT_MARK, code)).encode())
+    os._exit(0)
+
+
+def _isRunning(pid):
+    """ Reap the job pid if it ended and return True if it is running. """
+    try:
+        return os.waitpid(pid, os.WNOHANG)[0] == 0
+    except ChildProcessError:
+        return False
+
+
+def serve(socketFn, idleTimeout=DEFAULT_IDLE_TIMEOUT):
+    """ Accept jobs until stopped or idle (no requests and no running
+    jobs) for idleTimeout seconds.
+    """
+    entryPoint = getEntryPoint()
+
+    if os.path.exists(socketFn):
+        os.remove(socketFn)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socketFn)
+    os.chmod(socketFn, 0o600)
+    server.listen(16)
+    server.settimeout(min(idleTimeout, REAP_INTERVAL))
+    print("LocScale worker %d listening on %s" % (os.getpid(), socketFn))
+    sys.stdout.flush()
+
+    jobs = set()
+    lastActivity = time.time()
+    try:
+        while True:
+            jobs = {pid for pid in jobs if _isRunning(pid)}
+            if jobs:
+                lastActivity = time.time()
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                if time.time() - lastActivity >= idleTimeout:
+                    print("Idle for %d s, exiting." % idleTimeout)
+                    break
+                continue
+            lastActivity = time.time()
+            conn.settimeout(None)
+            request = json.loads(conn.makefile().readline())
+            command = request.get('command')
+            if command == 'ping':
+                conn.sendall(b'pong\n')
+            elif command == 'stop':
+                conn.close()
+                break
+            elif command == 'run':
+                pid = os.fork()
+                if pid == 0:
+                    server.close()
+                    _runChild(conn, request, entryPoint)
+                jobs.add(pid)
+            conn.close()
+    finally:
+        server.close()
+        if os.path.exists(socketFn):
+            os.remove(socketFn)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="LocScale worker")
+    parser.add_argument('--socket', required=True)
+    parser.add_argument('--idle_timeout', type=int,
+                        default=DEFAULT_IDLE_TIMEOUT)
+    parser.add_argument('--stop', action='store_true',
+                        help="Stop the worker listening on the socket.")
+    args = parser.parse_args()
+
+    if args.stop:
+        stopWorker(args.socket)
+    else:
+        preload(PRELOAD_MODULES)
+        serve(args.socket, args.idle_timeout)
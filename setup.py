@@ -164,7 +164,8 @@ setup(
     # MANIFEST.in as well.
     # include_package_data=True,
     package_data={  # Optional
-       'locscale': ['locscale_logo.jpg', 'protocols.conf'],
+       'locscale': ['locscale_logo.jpg', 'protocols.conf',
+                    'tests/benchmark_baseline.json'],
     },
 
     # Although 'package_data' is the preferred approach, in some case you may